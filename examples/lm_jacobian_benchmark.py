@@ -0,0 +1,99 @@
+import time
+import numpy as np
+from mot.optimize import minimize
+from mot.lib.cl_function import SimpleCLFunction
+from mot.lib.kernel_data import Array, Struct
+from mot.library_functions import DualNumberJacobian
+
+__author__ = 'Robbert Harms'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def get_objective_function(nmr_observations):
+    """The bi-exponential decay model, returning the residuals in the objective list."""
+    return SimpleCLFunction.from_string('''
+        double biexp_objective(local const mot_float_type* const x,
+                               void* data,
+                               local mot_float_type* objective_list){
+            double sum = 0;
+            double t;
+            double residual;
+            for(uint i = 0; i < ''' + str(nmr_observations) + '''; i++){
+                t = ((_model_data*)data)->times[i];
+                residual = ((_model_data*)data)->observations[i]
+                            - (x[0] * exp(-x[1] * t) + x[2] * exp(-x[3] * t));
+                sum += residual * residual;
+
+                if(objective_list){
+                    objective_list[i] = residual;
+                }
+            }
+            return sum;
+        }
+    ''')
+
+
+def get_dual_residual_function():
+    """The same model as :func:`get_objective_function`, written using dual numbers for a single observation."""
+    return SimpleCLFunction.from_string('''
+        mot_dual biexp_residual(const mot_dual* const x, void* data, uint i){
+            double t = ((_model_data*)data)->times[i];
+            mot_dual model = dual_add(dual_mul(x[0], dual_exp(dual_mul_scalar(x[1], -t))),
+                                      dual_mul(x[2], dual_exp(dual_mul_scalar(x[3], -t))));
+            return dual_add_scalar(dual_neg(model), ((_model_data*)data)->observations[i]);
+        }
+    ''')
+
+
+def simulate_data(nmr_problems, nmr_observations):
+    """Simulate bi-exponential decays with some Gaussian noise.
+
+    Returns:
+        tuple: (times, observations, ground truth parameters)
+    """
+    times = np.linspace(0, 5, nmr_observations)
+    ground_truth = np.column_stack([np.random.uniform(0.5, 1, nmr_problems),
+                                    np.random.uniform(2, 4, nmr_problems),
+                                    np.random.uniform(0.2, 0.5, nmr_problems),
+                                    np.random.uniform(0.1, 0.5, nmr_problems)])
+
+    observations = (ground_truth[:, 0, None] * np.exp(-ground_truth[:, 1, None] * times[None, :])
+                    + ground_truth[:, 2, None] * np.exp(-ground_truth[:, 3, None] * times[None, :]))
+    observations += np.random.normal(scale=0.01, size=observations.shape)
+    return times, observations, ground_truth
+
+
+if __name__ == '__main__':
+    """Compare the Levenberg-Marquardt routine with a numerical and with a dual number Jacobian.
+
+    The numerical Jacobian uses forward differences, costing one extra model evaluation per parameter per iteration.
+    The dual number Jacobian evaluates the exact derivatives with respect to all parameters in one pass.
+    """
+    nmr_problems = 10000
+    nmr_observations = 50
+    nmr_params = 4
+
+    times, observations, ground_truth = simulate_data(nmr_problems, nmr_observations)
+    x0 = np.tile([[1, 1, 0.1, 0.1]], (nmr_problems, 1))
+
+    def get_data():
+        return Struct({'times': Array(times, 'mot_float_type', offset_str='0'),
+                       'observations': Array(observations, 'mot_float_type')}, '_model_data')
+
+    jacobians = {'numerical': None,
+                 'dual numbers': DualNumberJacobian(get_dual_residual_function(), nmr_params, nmr_observations)}
+
+    for name, jacobian_func in jacobians.items():
+        start = time.time()
+        opt_output = minimize(get_objective_function(nmr_observations), x0, data=get_data(),
+                              method='Levenberg-Marquardt', nmr_observations=nmr_observations,
+                              jacobian_func=jacobian_func, return_statistics=True)
+        duration = time.time() - start
+
+        print('{} Jacobian: {:.2f} seconds, {} of {} problems converged, mean number of iterations: {:.1f}, '
+              'median absolute error: {}'.format(
+                name, duration, np.sum(opt_output['status'] != 6), nmr_problems,
+                np.mean(opt_output['nmr_iterations']),
+                np.nanmedian(np.abs(opt_output['x'] - ground_truth), axis=0)))
@@ -1,6 +1,6 @@
 import logging
 from .__version__ import VERSION, VERSION_STATUS, __version__
-from .optimize import minimize, get_minimizer_options
+from .optimize import minimize, get_minimizer_options, fit_with_uncertainty
 
 try:
     from logging import NullHandler
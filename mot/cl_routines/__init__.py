@@ -1,6 +1,10 @@
+import numpy as np
 from mot.lib.cl_function import SimpleCLFunction
 from mot.lib.kernel_data import Array, Zeros
+from mot.lib.utils import hessian_to_covariance
+from mot.library_functions import CholeskyInverse
 from mot.cl_routines.numerical_hessian import numerical_hessian
+from mot.cl_routines.numerical_gradient import numerical_gradient
 
 __author__ = 'Robbert Harms'
 __date__ = "2014-05-21"
@@ -111,3 +115,57 @@ def compute_objective_value(objective_func, parameters, data=None, cl_runtime_in
     """
     return objective_func.evaluate({'data': data, 'parameters': Array(parameters, 'mot_float_type', mode='r')},
                                    parameters.shape[0], use_local_reduction=True, cl_runtime_info=cl_runtime_info)
+
+
+def compute_covariance(hessian, output_singularity=False, cl_runtime_info=None):
+    """Calculate the covariance matrices from the Hessians, inverting the Hessians on the device.
+
+    This is the device counterpart of :func:`mot.lib.utils.hessian_to_covariance`. Every Hessian is inverted by one
+    work item using its Cholesky decomposition, which requires the Hessian to be positive definite, as is the case at
+    a minimum of the objective function. The other Hessians are inverted on the host using
+    :func:`~mot.lib.utils.hessian_to_covariance`.
+
+    Both functions use the same condition threshold, the reciprocal of the machine precision. On the device, we
+    estimate the condition number as the ratio of the largest to the smallest Cholesky pivot and leave the Hessians
+    above the threshold to the host, which marks them as singular. Since this ratio is a lower bound on the
+    condition number, a few Hessians just above the threshold may still be inverted on the device, where the host
+    would have used a pseudo inverse.
+
+    Args:
+        hessian (ndarray): a matrix of shape (n, p, p) where for n problems we have a matrix of shape (p, p) for
+            p parameters, for example as computed by :func:`numerical_hessian`.
+        output_singularity (boolean): if set to True, we additionally output a boolean vector with the location
+            of singular Hessians.
+        cl_runtime_info (mot.configuration.CLRuntimeInfo): the runtime information
+
+    Returns:
+        ndarray or tuple: the covariance matrices, if ``output_singularity`` is set a tuple with the covariance
+            matrices and the boolean vector with the singular Hessians.
+    """
+    nmr_problems, nmr_params = hessian.shape[:2]
+
+    invert_func = SimpleCLFunction.from_string('''
+        int invert_hessian(global double* covariance){
+            if(!cholesky_inverse_global_double(covariance, %(NMR_PARAMS)r)){
+                return 0;
+            }
+            for(uint i = 0; i < %(NMR_PARAMS)r; i++){
+                covariance[i * %(NMR_PARAMS)r + i] = fabs(covariance[i * %(NMR_PARAMS)r + i]);
+            }
+            return 1;
+        }
+    ''' % dict(NMR_PARAMS=nmr_params), dependencies=[CholeskyInverse(memspace='global', memtype='double')])
+
+    kernel_data = {'covariance': Array(np.nan_to_num(hessian), 'double', mode='rw')}
+    is_inverted = invert_func.evaluate(kernel_data, nmr_problems, cl_runtime_info=cl_runtime_info).astype(bool)
+
+    covariance = kernel_data['covariance'].get_data()
+    is_singular = np.zeros(nmr_problems, dtype=bool)
+
+    if np.any(~is_inverted):
+        covariance[~is_inverted], is_singular[~is_inverted] = hessian_to_covariance(
+            hessian[~is_inverted], output_singularity=True)
+
+    if output_singularity:
+        return covariance, is_singular
+    return covariance
@@ -0,0 +1,228 @@
+from numbers import Number
+
+import numpy as np
+from mot.lib.cl_function import SimpleCLFunction
+from mot.configuration import CLRuntimeInfo, config_context, CLRuntimeAction
+from mot.lib.kernel_data import Array, Zeros, LocalMemory
+from mot.cl_routines.numerical_hessian import _get_compute_functions_cl, _get_extrapolation_functions_cl, \
+    _get_initial_step_size, _get_nmr_richardson_convolutions
+
+
+__author__ = 'Robbert Harms'
+__maintainer__ = 'Robbert Harms'
+__email__ = 'robbert.harms@maastrichtuniversity.nl'
+__licence__ = 'LGPL v3'
+
+
+def numerical_gradient(objective_func, parameters, lower_bounds=None, upper_bounds=None, step_ratio=2, nmr_steps=5,
+                       data=None, max_step_sizes=None, step_offset=None, parameter_transform_func=None,
+                       cl_runtime_info=None, parallel_evaluations=False):
+    """Calculate and return the gradient of the given function at the given parameters.
+
+    This calculates the gradient using central differences:
+
+    .. math::
+        \quad (f(x + d_j e_j) - f(x - d_j e_j)) / (2 d_j)
+
+    where :math:`e_j` is a vector where element :math:`j` is one and the rest are zero
+    and :math:`d_j` is a scalar spacing :math:`steps_j`.
+
+    The steps are generated in the same way as for :func:`~mot.cl_routines.numerical_hessian`, exponentially
+    diminishing from the maximum step size. If the number of steps is one, we return the central difference of the
+    first step. For more steps we use a Richardson extrapolation over the steps and return per parameter the
+    extrapolation with the smallest error estimate. The extrapolation is computed on the device, in the same
+    kernel as the central differences.
+
+    This requires ``2 * p * nmr_steps`` evaluations of the objective function per problem, compared to the
+    quadratic number of evaluations of the Hessian. By default, every evaluation uses all the work items of the
+    work group. With ``parallel_evaluations``, the evaluations are instead distributed over the work items.
+
+    Args:
+        objective_func (mot.lib.cl_function.CLFunction): The function we want to differentiate.
+            A CL function with the signature:
+
+            .. code-block:: c
+
+                double <func_name>(local const mot_float_type* const x,
+                                   void* data,
+                                   local mot_float_type* objective_list);
+
+            The objective function has the same signature as the minimization function in MOT. For the numerical
+            gradient, the ``objective_list`` parameter is ignored.
+
+        parameters (ndarray): The parameters at which to evaluate the gradient. A (d, p) matrix with d problems,
+            and p parameters
+        lower_bounds (list or None): a list of length (p,) for p parameters with the lower bounds.
+            Each element of the list can be a scalar, a vector (of the same length as the number of problem instances),
+            or None. For infinity use np.inf, for boundless use None.
+        upper_bounds (list or None): a list of length (p,) for p parameters with the upper bounds.
+            Each element of the list can be a scalar, a vector (of the same length as the number of problem instances),
+            or None. For infinity use np.inf, for boundless use None.
+        step_ratio (float): the ratio at which the steps diminish.
+        nmr_steps (int): the number of steps we will generate. We will calculate the derivative for each of these
+            step sizes and extrapolate the best step size from among them.
+        data (mot.lib.kernel_data.KernelData): the user provided data for the ``void* data`` pointer.
+        max_step_sizes (float or ndarray or None): the maximum step size, or the maximum step size per parameter.
+            If None is given, we use 0.1 for all parameters. If a float is given, we use that for all parameters.
+            If a list is given, it should be of the same length as the number of parameters.
+        step_offset (int): the offset in the steps, if set we start the steps from the given offset.
+        parameter_transform_func (mot.lib.cl_function.CLFunction or None): A transformation that can prepare the
+            parameter plus/minus the proposed step before evaluation, see
+            :func:`~mot.cl_routines.numerical_hessian`. Signature:
+
+            .. code-block:: c
+
+                void <func_name>(void* data, local mot_float_type* x);
+
+        cl_runtime_info (mot.configuration.CLRuntimeInfo): the runtime information
+        parallel_evaluations (boolean): if set, every work item evaluates the objective function on its own copy of
+            the parameters, for one parameter, step and direction at a time. This only works for objective
+            functions which do not use local reduction, see :func:`~mot.cl_routines.numerical_hessian`.
+
+    Returns:
+        ndarray: the gradients, a (d, p) matrix for d problems and p parameters
+    """
+    if len(parameters.shape) == 1:
+        parameters = parameters[None, :]
+    nmr_problems, nmr_params = parameters.shape
+
+    if nmr_steps < 1:
+        raise ValueError('The number of steps should be at least one, {} given.'.format(nmr_steps))
+
+    if max_step_sizes is None:
+        max_step_sizes = 0.1
+    if isinstance(max_step_sizes, Number):
+        max_step_sizes = [max_step_sizes] * nmr_params
+    max_step_sizes = np.array(max_step_sizes)
+
+    if parameter_transform_func is None:
+        parameter_transform_func = SimpleCLFunction.from_string(
+            'void voidTransform(void* data, local mot_float_type* x){}')
+
+    initial_step = _get_initial_step_size(parameters, lower_bounds, upper_bounds, max_step_sizes,
+                                          np.ones(nmr_params))
+    if step_offset:
+        initial_step *= float(step_ratio) ** -step_offset
+
+    nmr_convolutions = _get_nmr_richardson_convolutions(nmr_steps)
+
+    kernel_data = {
+        'data': data,
+        'parameters': Array(parameters, ctype='mot_float_type'),
+        'initial_step': Array(initial_step, ctype='float'),
+        'step_evaluates': Zeros((nmr_problems, nmr_params, nmr_steps), 'double'),
+        'richardson_extrapolations': Zeros((nmr_problems, nmr_params, nmr_convolutions), 'double'),
+        'richardson_errors': Zeros((nmr_problems, nmr_params, nmr_convolutions - 1), 'double'),
+        'gradient': Zeros((nmr_problems, nmr_params), 'double')
+    }
+
+    if parallel_evaluations:
+        kernel_data['perturbed_evaluates'] = Zeros((nmr_problems, nmr_params, nmr_steps, 2), 'double')
+        kernel_data['x_scratch'] = LocalMemory(
+            'mot_float_type',
+            size_func=lambda workgroup_size, dtype: workgroup_size * nmr_params * np.dtype(dtype).itemsize)
+        kernel_func = _parallel_gradient_kernel(objective_func, nmr_params, nmr_steps, step_ratio,
+                                                parameter_transform_func)
+    else:
+        kernel_func = _gradient_kernel(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func)
+
+    with config_context(CLRuntimeAction(cl_runtime_info or CLRuntimeInfo())):
+        kernel_func.evaluate(kernel_data, nmr_problems, use_local_reduction=True)
+
+    return kernel_data['gradient'].get_data()
+
+
+def _gradient_kernel(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func):
+    func = _get_compute_functions_cl(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func)
+    func += _get_extrapolation_functions_cl(nmr_steps, step_ratio)
+    nmr_convolutions = _get_nmr_richardson_convolutions(nmr_steps)
+
+    return SimpleCLFunction.from_string('''
+        void compute(local mot_float_type* parameters,
+                     global float* initial_step,
+                     global double* step_evaluates,
+                     global double* richardson_extrapolations,
+                     global double* richardson_errors,
+                     global double* gradient,
+                     void* data){
+
+            double step;
+            double tmp;
+
+            for(uint px = 0; px < ''' + str(nmr_params) + '''; px++){
+                for(uint step_ind = 0; step_ind < ''' + str(nmr_steps) + '''; step_ind++){
+                    step = initial_step[px] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+
+                    tmp = (  _eval_step(data, parameters, px, step, 0, 0)
+                           - _eval_step(data, parameters, px, -step, 0, 0)) / (2 * step);
+
+                    if(get_local_id(0) == 0){
+                        step_evaluates[px * ''' + str(nmr_steps) + ''' + step_ind] = tmp;
+                    }
+                }
+            }
+
+            if(get_local_id(0) == 0){
+                for(uint px = 0; px < ''' + str(nmr_params) + '''; px++){
+                    gradient[px] = _extrapolate_derivative(
+                        step_evaluates + px * ''' + str(nmr_steps) + ''',
+                        richardson_extrapolations + px * ''' + str(nmr_convolutions) + ''',
+                        richardson_errors + px * ''' + str(nmr_convolutions - 1) + ''');
+                }
+            }
+        }
+    ''', cl_extra=func)
+
+
+def _parallel_gradient_kernel(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func):
+    """Compute the gradient with the function evaluations distributed over the work items.
+
+    Every work item evaluates the objective function for one parameter, step and direction at a time, using its own
+    part of the ``x_scratch`` local memory for the perturbed parameters. The evaluations are stored in
+    ``perturbed_evaluates``, after which the first work item computes the central differences and extrapolations.
+    """
+    func = _get_compute_functions_cl(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func)
+    func += _get_extrapolation_functions_cl(nmr_steps, step_ratio)
+    nmr_convolutions = _get_nmr_richardson_convolutions(nmr_steps)
+
+    return SimpleCLFunction.from_string('''
+        void compute(local mot_float_type* parameters,
+                     global float* initial_step,
+                     global double* step_evaluates,
+                     global double* richardson_extrapolations,
+                     global double* richardson_errors,
+                     global double* gradient,
+                     global double* perturbed_evaluates,
+                     local mot_float_type* x_scratch,
+                     void* data){
+
+            local mot_float_type* x_tmp = x_scratch + get_local_id(0) * ''' + str(nmr_params) + ''';
+            double step;
+
+            for(uint ind = get_local_id(0); ind < ''' + str(2 * nmr_params * nmr_steps) + ''';
+                    ind += get_local_size(0)){
+                step = initial_step[ind / ''' + str(2 * nmr_steps) + ''']
+                        / pown(''' + str(float(step_ratio)) + ''', (ind / 2) % ''' + str(nmr_steps) + ''');
+
+                perturbed_evaluates[ind] = _eval_step_work_item(
+                    data, parameters, x_tmp, ind / ''' + str(2 * nmr_steps) + ''', (ind % 2) ? -step : step, 0, 0);
+            }
+            barrier(CLK_GLOBAL_MEM_FENCE);
+
+            if(get_local_id(0) == 0){
+                for(uint ind = 0; ind < ''' + str(nmr_params * nmr_steps) + '''; ind++){
+                    step = initial_step[ind / ''' + str(nmr_steps) + ''']
+                            / pown(''' + str(float(step_ratio)) + ''', ind % ''' + str(nmr_steps) + ''');
+                    step_evaluates[ind] = (perturbed_evaluates[2 * ind] - perturbed_evaluates[2 * ind + 1])
+                                          / (2 * step);
+                }
+
+                for(uint px = 0; px < ''' + str(nmr_params) + '''; px++){
+                    gradient[px] = _extrapolate_derivative(
+                        step_evaluates + px * ''' + str(nmr_steps) + ''',
+                        richardson_extrapolations + px * ''' + str(nmr_convolutions) + ''',
+                        richardson_errors + px * ''' + str(nmr_convolutions - 1) + ''');
+                }
+            }
+        }
+    ''', cl_extra=func)
@@ -4,7 +4,7 @@ from numbers import Number
 import numpy as np
 from mot.lib.cl_function import SimpleCLFunction
 from mot.configuration import CLRuntimeInfo, config_context, CLRuntimeAction
-from mot.lib.kernel_data import Array, Zeros
+from mot.lib.kernel_data import Array, Zeros, LocalMemory
 from scipy import linalg
 
 
@@ -20,7 +20,8 @@ def numerical_hessian(objective_func, parameters,
                       step_ratio=2, nmr_steps=15, data=None,
                       max_step_sizes=None, scaling_factors=None,
                       step_offset=None, parameter_transform_func=None,
-                      cl_runtime_info=None):
+                      cl_runtime_info=None, parallel_evaluations=False, reuse_evaluations=False,
+                      mode='full', parameter_indices=None, adaptive_tolerance=None, output_nmr_steps=False):
     """Calculate and return the Hessian of the given function at the given parameters.
 
     This calculates the Hessian using central difference (using a 2nd order Taylor expansion) with a Richardson
@@ -104,9 +105,50 @@ def numerical_hessian(objective_func, parameters,
                 void <func_name>(void* data, local mot_float_type* x);
 
         cl_runtime_info (mot.configuration.CLRuntimeInfo): the runtime information
+        parallel_evaluations (boolean): by default, every evaluation of the objective function is done by all the
+            work items of a work group together, allowing the objective function to use local reductions. If the
+            objective function does not use local reduction, i.e. it computes the complete function value in every
+            work item independently and uses no barriers, set this to distribute the Hessian elements and steps
+            over the work items instead. Every work item then evaluates the objective function on its own copy of
+            the parameters. The ``parameter_transform_func`` must then also be independent per work item.
+        reuse_evaluations (boolean): if set, we use a stencil which shares function evaluations between the
+            elements of the Hessian. Per step, the points :math:`x \pm d_j e_j` are evaluated once and used for
+            both the diagonal elements:
+
+            .. math::
+                \quad (f(x + d_j e_j) + f(x - d_j e_j) - 2 f(x)) / d_j^2
+
+            and the off-diagonal elements:
+
+            .. math::
+                \quad (f(x + d_j e_j + d_k e_k) + f(x - d_j e_j - d_k e_k)
+                        - f(x + d_j e_j) - f(x - d_j e_j) - f(x + d_k e_k) - f(x - d_k e_k) + 2 f(x)) /
+                       (2 d_j d_k)
+
+            This takes :math:`p(p+1)` evaluations per step instead of :math:`2p^2`. Both stencils have an
+            error of :math:`\mathcal{O}(d^2)`, but the estimates differ slightly since the diagonal uses a step
+            of :math:`d_j` instead of :math:`2 d_j`.
+        mode (str): either 'full' to compute the complete Hessian (of the parameters in ``parameter_indices``),
+            or 'diagonal' to only compute the diagonal elements. The latter only needs a linear number of
+            derivatives instead of a quadratic number.
+        parameter_indices (list or None): if given, the indices of the parameters for which we compute the Hessian.
+            We then only compute the sub-block of the Hessian of these parameters, while keeping the other
+            parameters fixed.
+        adaptive_tolerance (float or None): if set, we evaluate the steps progressively on the device and stop per
+            element of the Hessian once the error estimate of the Richardson extrapolation drops below this
+            tolerance, relative to the extrapolated value, or once the error estimate starts to grow. We then return
+            per element the extrapolation with the smallest error estimate among the evaluated steps, instead of
+            the Wynn and median extrapolation over all the steps. The ``nmr_steps`` then act as the maximum number
+            of steps and should be at least four. This can not be combined with ``reuse_evaluations``, since that
+            stencil evaluates the steps of all the elements at once.
+        output_nmr_steps (boolean): if set, we also output per element the number of steps which were evaluated.
+            Without an ``adaptive_tolerance`` this is always ``nmr_steps``.
 
     Returns:
-        ndarray: the gradients for each of the parameters for each of the problems
+        ndarray or tuple: for mode 'full' a matrix of (d, k, k) and for mode 'diagonal' a matrix of (d, k), for d
+            problems and k parameters, with k the number of ``parameter_indices`` or all p parameters if not given.
+            If ``output_nmr_steps`` is set, we return a tuple with the Hessian and, in the same layout,
+            the number of steps evaluated per element.
     """
     if len(parameters.shape) == 1:
         parameters = parameters[None, :]
@@ -124,14 +166,54 @@ def numerical_hessian(objective_func, parameters,
         scaling_factors = [scaling_factors] * nmr_params
     scaling_factors = np.array(scaling_factors)
 
+    if mode not in ('full', 'diagonal'):
+        raise ValueError('The mode should be one of "full" or "diagonal", "{}" given.'.format(mode))
+
+    if parameter_indices is None:
+        parameter_indices = range(nmr_params)
+    parameter_indices = list(parameter_indices)
+
+    if adaptive_tolerance is not None:
+        if nmr_steps < 4:
+            raise ValueError('The adaptive step count needs at least four steps, {} given.'.format(nmr_steps))
+        if reuse_evaluations:
+            raise ValueError('The adaptive step count can not be combined with reusing the evaluations.')
+
+    if mode == 'diagonal':
+        coords = [(ind, ind) for ind in parameter_indices]
+    else:
+        coords = list(itertools.combinations_with_replacement(parameter_indices, 2))
+
+    def to_output_layout(vectors):
+        if mode == 'diagonal':
+            return vectors
+        return _results_vector_to_matrix(vectors, len(parameter_indices))
+
     def finalize_derivatives(derivatives):
         """Transforms the derivatives from vector to matrix and apply the parameter scalings."""
-        return _results_vector_to_matrix(derivatives, nmr_params) * np.outer(scaling_factors, scaling_factors)
+        scalings = scaling_factors[parameter_indices]
+        if mode == 'diagonal':
+            hessian = derivatives * scalings ** 2
+        else:
+            hessian = to_output_layout(derivatives) * np.outer(scalings, scalings)
+
+        if output_nmr_steps:
+            return hessian, to_output_layout(nmr_steps_used)
+        return hessian
 
     with config_context(CLRuntimeAction(cl_runtime_info or CLRuntimeInfo())):
         derivatives = _compute_derivatives(objective_func, parameters, step_ratio, step_offset, nmr_steps,
                                            lower_bounds, upper_bounds, max_step_sizes, scaling_factors, data=data,
-                                           parameter_transform_func=parameter_transform_func)
+                                           parameter_transform_func=parameter_transform_func,
+                                           parallel_evaluations=parallel_evaluations,
+                                           reuse_evaluations=reuse_evaluations, coords=coords,
+                                           adaptive_tolerance=adaptive_tolerance)
+
+        if adaptive_tolerance is not None:
+            derivatives, nmr_steps_used = derivatives
+            return finalize_derivatives(derivatives)
+
+        nmr_steps_used = np.full(derivatives.shape[:2], nmr_steps, dtype=np.uint32)
 
         if nmr_steps == 1:
             return finalize_derivatives(derivatives[..., 0])
@@ -153,7 +235,8 @@ def numerical_hessian(objective_func, parameters,
 
 def _compute_derivatives(objective_func, parameters, step_ratio, step_offset, nmr_steps,
                          lower_bounds, upper_bounds, max_step_sizes, scaling_factors, data=None,
-                         parameter_transform_func=None):
+                         parameter_transform_func=None, parallel_evaluations=False, reuse_evaluations=False,
+                         coords=None, adaptive_tolerance=None):
     """Compute the lower triangular elements of the Hessian using the central difference method.
 
     This will compute the elements of the Hessian multiple times with decreasing step sizes.
@@ -179,9 +262,25 @@ def _compute_derivatives(objective_func, parameters, step_ratio, step_offset, nm
             .. code-block:: c
 
                 void <func_name>(void* data, local mot_float_type* x);
+
+        parallel_evaluations (boolean): if set, we distribute the Hessian elements and steps over the work items,
+            with a copy of the parameters per work item.
+        reuse_evaluations (boolean): if set, we use the stencil which evaluates every point on the parameter axes
+            once per step and reuses it for all the elements.
+        coords (list): the (row, column) indices of the elements of the Hessian to compute. Defaults to
+            all the lower triangular elements.
+        adaptive_tolerance (float or None): if set, we evaluate the steps progressively per element and stop once the
+            relative error estimate of the Richardson extrapolation drops below this tolerance or starts to grow.
+
+    Returns:
+        ndarray or tuple: by default the (n, d, s) derivatives for every problem, element and step. With an
+            adaptive tolerance, a tuple with the (n, d) extrapolated derivatives and the (n, d) number of
+            steps evaluated per element.
     """
     nmr_params = parameters.shape[1]
-    nmr_derivatives = (nmr_params ** 2 - nmr_params) // 2 + nmr_params
+    if coords is None:
+        coords = list(itertools.combinations_with_replacement(range(nmr_params), 2))
+    nmr_derivatives = len(coords)
 
     if parameter_transform_func is None:
         parameter_transform_func = SimpleCLFunction.from_string(
@@ -196,11 +295,38 @@ def _compute_derivatives(objective_func, parameters, step_ratio, step_offset, nm
         'parameters': Array(parameters, ctype='mot_float_type'),
         'parameter_scalings_inv': Array(1. / scaling_factors, ctype='float', offset_str='0'),
         'initial_step': Array(initial_step, ctype='float'),
-        'step_evaluates': Zeros((parameters.shape[0], nmr_derivatives, nmr_steps), 'double'),
     }
 
-    _derivation_kernel(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func).evaluate(
-        kernel_data, parameters.shape[0], use_local_reduction=True)
+    if parallel_evaluations:
+        kernel_data['x_scratch'] = LocalMemory(
+            'mot_float_type',
+            size_func=lambda workgroup_size, dtype: workgroup_size * nmr_params * np.dtype(dtype).itemsize)
+
+    if adaptive_tolerance is not None:
+        kernel_data['derivatives'] = Zeros((parameters.shape[0], nmr_derivatives), 'double')
+        kernel_data['nmr_steps_used'] = Zeros((parameters.shape[0], nmr_derivatives), 'uint')
+
+        kernel_func = _adaptive_derivation_kernel(objective_func, nmr_params, nmr_steps, step_ratio,
+                                                  parameter_transform_func, coords, adaptive_tolerance,
+                                                  parallel_evaluations)
+        kernel_func.evaluate(kernel_data, parameters.shape[0], use_local_reduction=True)
+        return kernel_data['derivatives'].get_data(), kernel_data['nmr_steps_used'].get_data()
+
+    kernel_data['step_evaluates'] = Zeros((parameters.shape[0], nmr_derivatives, nmr_steps), 'double')
+
+    if reuse_evaluations:
+        if parallel_evaluations:
+            kernel_data['axis_evaluates'] = Zeros((parameters.shape[0], nmr_steps, 2 * nmr_params), 'double')
+        kernel_func = _shared_stencil_derivation_kernel(objective_func, nmr_params, nmr_steps, step_ratio,
+                                                        parameter_transform_func, coords, parallel_evaluations)
+    elif parallel_evaluations:
+        kernel_func = _parallel_derivation_kernel(objective_func, nmr_params, nmr_steps, step_ratio,
+                                                  parameter_transform_func, coords)
+    else:
+        kernel_func = _derivation_kernel(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func,
+                                         coords)
+
+    kernel_func.evaluate(kernel_data, parameters.shape[0], use_local_reduction=True)
 
     return kernel_data['step_evaluates'].get_data()
 
@@ -269,8 +395,7 @@ def _wynn_extrapolate(derivatives):
 def _median_outlier_extrapolation(derivatives, errors):
     """Add an error to outliers and afterwards return the derivatives with the lowest errors.
 
-    This seems to be the slowest function in the library. Perhaps one day update this to OpenCL as well.
-    Some ideas are in: http://krstn.eu/np.nanpercentile()-there-has-to-be-a-faster-way/
+    This is vectorized over all problems and derivatives, see :func:`_nanpercentiles` for the percentiles.
     """
     def _get_median_outliers_errors(der, trim_fact=10):
         """Discards any estimate that differs wildly from the median of the estimates (of that derivative).
@@ -278,7 +403,7 @@ def _median_outlier_extrapolation(derivatives, errors):
         A factor of 10 to 1 in either direction . The actual trimming factor is
         defined as a parameter.
         """
-        p25, median, p75 = np.nanpercentile(der, q=[25, 50, 75], axis=2)[..., None]
+        p25, median, p75 = _nanpercentiles(der, [25, 50, 75])[..., None]
         iqr = np.abs(p75 - p25)
 
         a_median = np.abs(median)
@@ -305,6 +430,39 @@ def _median_outlier_extrapolation(derivatives, errors):
     return derivatives_final, errors_final
 
 
+def _nanpercentiles(values, percentiles):
+    """Compute the percentiles over the last axis, while ignoring NaNs.
+
+    This gives the same results as ``np.nanpercentile`` with linear interpolation, but is vectorized over all the
+    other axes. We sort every row, which places the NaNs at the end, and interpolate between the sorted values
+    using the number of valid values per row. Rows without valid values get NaN as percentiles.
+
+    Args:
+        values (ndarray): the values, with the samples in the last axis
+        percentiles (list): the percentiles to compute, between 0 and 100
+
+    Returns:
+        ndarray: the percentiles, with the percentiles in the first axis and the other axes of the values after that
+    """
+    sorted_values = np.sort(values, axis=-1)
+    nmr_valid = np.sum(~np.isnan(values), axis=-1)
+
+    results = []
+    for percentile in percentiles:
+        position = np.maximum(nmr_valid - 1, 0) * (percentile / 100.)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+
+        lower_values = np.take_along_axis(sorted_values, lower[..., None], axis=-1)[..., 0]
+        upper_values = np.take_along_axis(sorted_values, upper[..., None], axis=-1)[..., 0]
+
+        result = lower_values + (upper_values - lower_values) * (position - lower)
+        result[upper == lower] = lower_values[upper == lower]
+        result[nmr_valid == 0] = np.nan
+        results.append(result)
+    return np.array(results)
+
+
 def _results_vector_to_matrix(vectors, nmr_params):
     """Transform for every problem (and optionally every step size) the vector results to a square matrix.
 
@@ -317,15 +475,9 @@ def _results_vector_to_matrix(vectors, nmr_params):
     """
     matrices = np.zeros(vectors.shape[:-1] + (nmr_params, nmr_params), dtype=vectors.dtype)
 
-    ltr_ind = 0
-    for px in range(nmr_params):
-        matrices[..., px, px] = vectors[..., ltr_ind]
-        ltr_ind += 1
-
-        for py in range(px + 1, nmr_params):
-            matrices[..., px, py] = vectors[..., ltr_ind]
-            matrices[..., py, px] = vectors[..., ltr_ind]
-            ltr_ind += 1
+    rows, columns = np.triu_indices(nmr_params)
+    matrices[..., rows, columns] = vectors
+    matrices[..., columns, rows] = vectors
     return matrices
 
 
@@ -452,6 +604,48 @@ def _get_compute_functions_cl(objective_func, nmr_params, nmr_steps, step_ratio,
             return _calculate_function(data, x_tmp);
         }
         
+        /**
+         * Compute one element of the Hessian for one step.
+         * 
+         * This uses the initial steps in the data structure, indexed by the parameters to change (px, py).
+         */
+        double _compute_step(void* data, local mot_float_type* x_input, mot_float_type f_x_input,
+                             uint px, uint py, uint step_ind,
+                             global float* parameter_scalings_inv,
+                             global float* initial_step){
+            
+            double step_x = initial_step[px] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+            double step_y;
+            
+            if(px == py){
+                return (
+                      _eval_step(data, x_input,
+                                 px, 2 * (step_x * parameter_scalings_inv[px]),
+                                 0, 0)
+                    + _eval_step(data, x_input,
+                                 px, -2 * (step_x * parameter_scalings_inv[px]),
+                                 0, 0)
+                    - 2 * f_x_input
+                ) / (4 * step_x * step_x);
+            }
+            
+            step_y = initial_step[py] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+            return (
+                  _eval_step(data, x_input,
+                             px, step_x * parameter_scalings_inv[px],
+                             py, step_y * parameter_scalings_inv[py])
+                - _eval_step(data, x_input,
+                             px, step_x * parameter_scalings_inv[px],
+                             py, -step_y * parameter_scalings_inv[py])
+                - _eval_step(data, x_input,
+                             px, -step_x * parameter_scalings_inv[px],
+                             py, step_y * parameter_scalings_inv[py])
+                + _eval_step(data, x_input,
+                             px, -step_x * parameter_scalings_inv[px],
+                             py, -step_y * parameter_scalings_inv[py])
+            ) / (4 * step_x * step_y);
+        }
+        
         /**
          * Compute one element of the Hessian for a number of steps.
          * 
@@ -461,56 +655,78 @@ def _get_compute_functions_cl(objective_func, nmr_params, nmr_steps, step_ratio,
                             uint px, uint py, global double* step_evaluates, 
                             global float* parameter_scalings_inv,
                             global float* initial_step){
-            
-            double step_x;
-            double step_y;
             double tmp;
-            bool is_first_workitem = get_local_id(0) == 0;
             
-            if(px == py){
-                for(uint step_ind = 0; step_ind < ''' + str(nmr_steps) + '''; step_ind++){
-                    step_x = initial_step[px] / pown(''' + str(float(step_ratio)) + ''', step_ind);
-                    
-                    tmp = (
-                          _eval_step(data, x_input,
-                                     px, 2 * (step_x * parameter_scalings_inv[px]),
-                                     0, 0)
-                        + _eval_step(data, x_input,
-                                     px, -2 * (step_x * parameter_scalings_inv[px]),
-                                     0, 0)
-                        - 2 * f_x_input
-                    ) / (4 * step_x * step_x);
-                    
-                    if(is_first_workitem){
-                        step_evaluates[step_ind] = tmp;
-                    }
+            for(uint step_ind = 0; step_ind < ''' + str(nmr_steps) + '''; step_ind++){
+                tmp = _compute_step(data, x_input, f_x_input, px, py, step_ind, parameter_scalings_inv, 
+                                    initial_step);
+                
+                if(get_local_id(0) == 0){
+                    step_evaluates[step_ind] = tmp;
                 }
             }
-            else{
-                for(uint step_ind = 0; step_ind < ''' + str(nmr_steps) + '''; step_ind++){
-                    step_x = initial_step[px] / pown(''' + str(float(step_ratio)) + ''', step_ind);
-                    step_y = initial_step[py] / pown(''' + str(float(step_ratio)) + ''', step_ind);
-                    
-                    tmp = (
-                          _eval_step(data, x_input,
-                                     px, step_x * parameter_scalings_inv[px],
-                                     py, step_y * parameter_scalings_inv[py])
-                        - _eval_step(data, x_input,
-                                     px, step_x * parameter_scalings_inv[px],
-                                     py, -step_y * parameter_scalings_inv[py])
-                        - _eval_step(data, x_input,
-                                     px, -step_x * parameter_scalings_inv[px],
-                                     py, step_y * parameter_scalings_inv[py])
-                        + _eval_step(data, x_input,
-                                     px, -step_x * parameter_scalings_inv[px],
-                                     py, -step_y * parameter_scalings_inv[py])
-                    ) / (4 * step_x * step_y);
-
-                    if(is_first_workitem){
-                        step_evaluates[step_ind] = tmp;
-                    }                       
-                }
+        }
+        
+        /**
+         * Evaluate the model with a perturbation in two dimensions, using only the current work item.
+         *
+         * This is the counterpart of ``_eval_step`` for objective functions which do not use local reduction. The
+         * perturbed parameters are stored in ``x_tmp``, which should be specific to the current work item.
+         */
+        double _eval_step_work_item(void* data, local mot_float_type* x_input, local mot_float_type* x_tmp,
+                                    uint perturb_dim_0, mot_float_type perturb_0,
+                                    uint perturb_dim_1, mot_float_type perturb_1){
+
+            for(uint i = 0; i < ''' + str(nmr_params) + '''; i++){
+                x_tmp[i] = x_input[i];
             }
+            x_tmp[perturb_dim_0] += perturb_0;
+            x_tmp[perturb_dim_1] += perturb_1;
+
+            ''' + parameter_transform_func.get_cl_function_name() + '''(data, x_tmp);
+            return _calculate_function(data, x_tmp);
+        }
+        
+        /**
+         * Compute one element of the Hessian for one step, using only the current work item.
+         *
+         * This is the counterpart of ``_compute_steps`` for objective functions which do not use local reduction.
+         */
+        double _compute_step_work_item(void* data, local mot_float_type* x_input, local mot_float_type* x_tmp,
+                                       mot_float_type f_x_input, uint px, uint py, uint step_ind,
+                                       global float* parameter_scalings_inv,
+                                       global float* initial_step){
+            
+            double step_x = initial_step[px] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+            double step_y;
+
+            if(px == py){
+                return (
+                      _eval_step_work_item(data, x_input, x_tmp,
+                                           px, 2 * (step_x * parameter_scalings_inv[px]),
+                                           0, 0)
+                    + _eval_step_work_item(data, x_input, x_tmp,
+                                           px, -2 * (step_x * parameter_scalings_inv[px]),
+                                           0, 0)
+                    - 2 * f_x_input
+                ) / (4 * step_x * step_x);
+            }
+
+            step_y = initial_step[py] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+            return (
+                  _eval_step_work_item(data, x_input, x_tmp,
+                                       px, step_x * parameter_scalings_inv[px],
+                                       py, step_y * parameter_scalings_inv[py])
+                - _eval_step_work_item(data, x_input, x_tmp,
+                                       px, step_x * parameter_scalings_inv[px],
+                                       py, -step_y * parameter_scalings_inv[py])
+                - _eval_step_work_item(data, x_input, x_tmp,
+                                       px, -step_x * parameter_scalings_inv[px],
+                                       py, step_y * parameter_scalings_inv[py])
+                + _eval_step_work_item(data, x_input, x_tmp,
+                                       px, -step_x * parameter_scalings_inv[px],
+                                       py, -step_y * parameter_scalings_inv[py])
+            ) / (4 * step_x * step_y);
         }
     '''
 
@@ -609,8 +825,76 @@ def _get_error_estimate_functions_cl(nmr_steps, nmr_convolutions,
     return func
 
 
-def _derivation_kernel(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func):
-    coords = [(x, y) for x, y in itertools.combinations_with_replacement(range(nmr_params), 2)]
+def _get_nmr_richardson_convolutions(nmr_steps):
+    """Get the number of Richardson extrapolations computed for the given number of steps.
+
+    Args:
+        nmr_steps (int): the number of steps
+
+    Returns:
+        int: the number of extrapolations computed by ``_apply_richardson_convolution``. The number of errors
+            computed by ``_compute_richardson_errors`` is one less.
+    """
+    return nmr_steps - (min(nmr_steps, 3) - 2)
+
+
+def _get_extrapolation_functions_cl(nmr_steps, step_ratio):
+    """Get the CL code for extrapolating the derivatives of multiple steps to a single estimate, on the device.
+
+    This defines the function ``_extrapolate_derivative``, which returns the derivative of the first step if we have
+    only one step, and else the Richardson extrapolation with the smallest error estimate. The arrays for the
+    extrapolations and the errors should hold room for respectively ``_get_nmr_richardson_convolutions(nmr_steps)``
+    elements and one element less.
+
+    Args:
+        nmr_steps (int): the number of steps
+        step_ratio (float): the ratio at which the steps diminish
+
+    Returns:
+        str: the CL code
+    """
+    nmr_convolutions = _get_nmr_richardson_convolutions(nmr_steps)
+
+    func = ''
+    if nmr_steps > 1:
+        func += _get_error_estimate_functions_cl(
+            nmr_steps, nmr_convolutions, _get_richardson_coefficients(step_ratio, min(nmr_steps, 3) - 1))
+
+    return func + '''
+        /**
+         * Extrapolate the derivatives computed with decreasing step sizes to a single estimate.
+         */
+        double _extrapolate_derivative(global double* step_evaluates,
+                                       global double* richardson_extrapolations,
+                                       global double* richardson_errors){
+            #if %(NMR_STEPS)r == 1
+                return step_evaluates[0];
+            #else
+                uint i;
+                uint best = 0;
+
+                for(i = 0; i < %(NMR_CONVOLUTIONS)r; i++){
+                    richardson_extrapolations[i] = 0;
+                }
+                _apply_richardson_convolution(step_evaluates, richardson_extrapolations);
+
+                #if %(NMR_STEPS)r > 3
+                    _compute_richardson_errors(step_evaluates, richardson_extrapolations, richardson_errors);
+
+                    for(i = 1; i < %(NMR_CONVOLUTIONS)r - 1; i++){
+                        if(richardson_errors[i] < richardson_errors[best] || isnan(richardson_errors[best])){
+                            best = i;
+                        }
+                    }
+                #endif
+                return richardson_extrapolations[best];
+            #endif
+        }
+
+    ''' % dict(NMR_STEPS=nmr_steps, NMR_CONVOLUTIONS=nmr_convolutions)
+
+
+def _derivation_kernel(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func, coords):
     func = _get_compute_functions_cl(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func)
 
     return SimpleCLFunction.from_string('''
@@ -635,6 +919,370 @@ def _derivation_kernel(objective_func, nmr_params, nmr_steps, step_ratio, parame
     ''', cl_extra=func)
 
 
+def _parallel_derivation_kernel(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func,
+                                coords):
+    """Compute the steps of the Hessian elements with the elements and steps distributed over the work items.
+
+    Every work item computes the steps of the elements assigned to it, using its own part of the ``x_scratch``
+    local memory for the perturbed parameters.
+    """
+    func = _get_compute_functions_cl(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func)
+
+    return SimpleCLFunction.from_string('''
+        void compute(local mot_float_type* parameters,
+                     global float* parameter_scalings_inv,
+                     global float* initial_step,
+                     global double* step_evaluates,
+                     local mot_float_type* x_scratch,
+                     void* data){
+            
+            local mot_float_type* x_tmp = x_scratch + get_local_id(0) * ''' + str(nmr_params) + ''';
+            double f_x_input = _calculate_function(data, parameters);
+            
+            uint coords[''' + str(len(coords)) + '''][2] = {
+                ''' + ', '.join('{{{}, {}}}'.format(*c) for c in coords)  + '''
+            };
+            
+            uint coord_ind;
+            for(uint ind = get_local_id(0); ind < ''' + str(len(coords) * nmr_steps) + '''; 
+                    ind += get_local_size(0)){
+                coord_ind = ind / ''' + str(nmr_steps) + ''';
+                
+                step_evaluates[ind] = _compute_step_work_item(
+                    data, parameters, x_tmp, f_x_input, coords[coord_ind][0], coords[coord_ind][1], 
+                    ind % ''' + str(nmr_steps) + ''', parameter_scalings_inv, initial_step);
+            }
+        }
+    ''', cl_extra=func)
+
+
+def _shared_stencil_derivation_kernel(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func,
+                                      coords, parallel_evaluations):
+    """Compute the steps of the Hessian elements using the stencil sharing the evaluations on the parameter axes.
+
+    Per step, we first evaluate the function at the points :math:`x \pm d_j e_j` for every parameter in the
+    coordinates, and then
+    assemble the diagonal elements from these, and the off-diagonal elements from these plus two evaluations per
+    element. Without parallel evaluations, the axis evaluations are kept in private memory, with parallel
+    evaluations they are distributed over the work items and shared through the global ``axis_evaluates``.
+    """
+    axis_indices = sorted(set(itertools.chain.from_iterable(coords)))
+    func = _get_compute_functions_cl(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func)
+
+    func += '''
+        /**
+         * Assemble one element of the Hessian for one step from the evaluations on the parameter axes.
+         *
+         * Args:
+         *  axis_evaluates: for every parameter the function value at x plus and x minus the step of that parameter
+         *  pair_plus: the function value at x plus the steps of both parameters, not used on the diagonal
+         *  pair_minus: the function value at x minus the steps of both parameters, not used on the diagonal
+         */
+        double _assemble_shared_stencil(double* axis_evaluates, double f_x_input, 
+                                        uint px, uint py, uint step_ind, double pair_plus, double pair_minus, 
+                                        global float* initial_step){
+            double step_x = initial_step[px] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+            double step_y = initial_step[py] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+
+            if(px == py){
+                return (axis_evaluates[2 * px] + axis_evaluates[2 * px + 1] - 2 * f_x_input) / (step_x * step_x);
+            }
+            return (pair_plus + pair_minus 
+                    - axis_evaluates[2 * px] - axis_evaluates[2 * px + 1]
+                    - axis_evaluates[2 * py] - axis_evaluates[2 * py + 1] 
+                    + 2 * f_x_input) / (2 * step_x * step_y);
+        }
+    '''
+
+    if not parallel_evaluations:
+        return SimpleCLFunction.from_string('''
+            void compute(local mot_float_type* parameters,
+                         global float* parameter_scalings_inv,
+                         global float* initial_step,
+                         global double* step_evaluates,
+                         void* data){
+                
+                double f_x_input = _calculate_function(data, parameters);
+                double axis_evaluates[''' + str(2 * nmr_params) + '''];
+                double pair_plus = 0;
+                double pair_minus = 0;
+                double step_x;
+                double step_y;
+                double tmp;
+                uint px, py;
+                
+                uint coords[''' + str(len(coords)) + '''][2] = {
+                    ''' + ', '.join('{{{}, {}}}'.format(*c) for c in coords)  + '''
+                };
+                uint axis_indices[''' + str(len(axis_indices)) + '''] = {
+                    ''' + ', '.join(map(str, axis_indices)) + '''
+                };
+                
+                for(uint step_ind = 0; step_ind < ''' + str(nmr_steps) + '''; step_ind++){
+                    for(uint axis_ind = 0; axis_ind < ''' + str(len(axis_indices)) + '''; axis_ind++){
+                        px = axis_indices[axis_ind];
+                        step_x = initial_step[px] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+                        axis_evaluates[2 * px] = _eval_step(
+                            data, parameters, px, step_x * parameter_scalings_inv[px], 0, 0);
+                        axis_evaluates[2 * px + 1] = _eval_step(
+                            data, parameters, px, -step_x * parameter_scalings_inv[px], 0, 0);
+                    }
+                    
+                    for(uint coord_ind = 0; coord_ind < ''' + str(len(coords)) + '''; coord_ind++){
+                        px = coords[coord_ind][0];
+                        py = coords[coord_ind][1];
+                        
+                        if(px != py){
+                            step_x = initial_step[px] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+                            step_y = initial_step[py] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+                            
+                            pair_plus = _eval_step(data, parameters,
+                                                   px, step_x * parameter_scalings_inv[px],
+                                                   py, step_y * parameter_scalings_inv[py]);
+                            pair_minus = _eval_step(data, parameters,
+                                                    px, -step_x * parameter_scalings_inv[px],
+                                                    py, -step_y * parameter_scalings_inv[py]);
+                        }
+                        
+                        tmp = _assemble_shared_stencil(axis_evaluates, f_x_input, px, py, step_ind, 
+                                                       pair_plus, pair_minus, initial_step);
+                        if(get_local_id(0) == 0){
+                            step_evaluates[coord_ind * ''' + str(nmr_steps) + ''' + step_ind] = tmp;
+                        }
+                    }
+                }
+            }
+        ''', cl_extra=func)
+
+    return SimpleCLFunction.from_string('''
+        void compute(local mot_float_type* parameters,
+                     global float* parameter_scalings_inv,
+                     global float* initial_step,
+                     global double* step_evaluates,
+                     global double* axis_evaluates,
+                     local mot_float_type* x_scratch,
+                     void* data){
+            
+            local mot_float_type* x_tmp = x_scratch + get_local_id(0) * ''' + str(nmr_params) + ''';
+            double f_x_input = _calculate_function(data, parameters);
+            double axis_evaluates_step[''' + str(2 * nmr_params) + '''];
+            double pair_plus = 0;
+            double pair_minus = 0;
+            double step_x;
+            double step_y;
+            uint px, py, step_ind, coord_ind;
+            
+            uint coords[''' + str(len(coords)) + '''][2] = {
+                ''' + ', '.join('{{{}, {}}}'.format(*c) for c in coords)  + '''
+            };
+            uint axis_indices[''' + str(len(axis_indices)) + '''] = {
+                ''' + ', '.join(map(str, axis_indices)) + '''
+            };
+            
+            for(uint ind = get_local_id(0); ind < ''' + str(nmr_steps * 2 * len(axis_indices)) + '''; 
+                    ind += get_local_size(0)){
+                step_ind = ind / ''' + str(2 * len(axis_indices)) + ''';
+                px = axis_indices[(ind % ''' + str(2 * len(axis_indices)) + ''') / 2];
+                step_x = initial_step[px] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+                
+                axis_evaluates[step_ind * ''' + str(2 * nmr_params) + ''' + 2 * px + ind % 2] = 
+                    _eval_step_work_item(data, parameters, x_tmp, 
+                                         px, (ind % 2 ? -1 : 1) * step_x * parameter_scalings_inv[px], 0, 0);
+            }
+            barrier(CLK_GLOBAL_MEM_FENCE);
+            
+            for(uint ind = get_local_id(0); ind < ''' + str(len(coords) * nmr_steps) + '''; 
+                    ind += get_local_size(0)){
+                coord_ind = ind / ''' + str(nmr_steps) + ''';
+                step_ind = ind % ''' + str(nmr_steps) + ''';
+                px = coords[coord_ind][0];
+                py = coords[coord_ind][1];
+                
+                if(px != py){
+                    step_x = initial_step[px] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+                    step_y = initial_step[py] / pown(''' + str(float(step_ratio)) + ''', step_ind);
+                    
+                    pair_plus = _eval_step_work_item(data, parameters, x_tmp,
+                                                     px, step_x * parameter_scalings_inv[px],
+                                                     py, step_y * parameter_scalings_inv[py]);
+                    pair_minus = _eval_step_work_item(data, parameters, x_tmp,
+                                                      px, -step_x * parameter_scalings_inv[px],
+                                                      py, -step_y * parameter_scalings_inv[py]);
+                }
+                
+                for(uint i = 0; i < ''' + str(2 * nmr_params) + '''; i++){
+                    axis_evaluates_step[i] = axis_evaluates[step_ind * ''' + str(2 * nmr_params) + ''' + i];
+                }
+                
+                step_evaluates[ind] = _assemble_shared_stencil(axis_evaluates_step, f_x_input, px, py, step_ind,
+                                                               pair_plus, pair_minus, initial_step);
+            }
+        }
+    ''', cl_extra=func)
+
+
+def _adaptive_derivation_kernel(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func,
+                                coords, tolerance, parallel_evaluations):
+    """Compute the Hessian elements with a progressive number of steps per element.
+
+    Per element, we evaluate the steps one by one, keeping the derivatives in private memory. From the third step
+    onwards we compute a second order Richardson extrapolation over the last three steps, and from the fourth step
+    onwards the error estimate of the previous extrapolation, in the same way as ``_compute_richardson_errors``.
+    We stop once this error, relative to the extrapolation, drops below the tolerance, or once the error starts to
+    grow, and return the extrapolation with the smallest error together with the number of steps evaluated.
+
+    Without parallel evaluations all the work items evaluate the elements together, and every work item runs
+    the same stopping logic on the same function values. With parallel evaluations the elements are distributed
+    over the work items.
+    """
+    func = _get_compute_functions_cl(objective_func, nmr_params, nmr_steps, step_ratio, parameter_transform_func)
+    richardson_coefficients = _get_richardson_coefficients(step_ratio, 2)
+
+    if parallel_evaluations:
+        x_tmp_arg = 'local mot_float_type* x_tmp, '
+        compute_step = '_compute_step_work_item(data, x_input, x_tmp, '
+    else:
+        x_tmp_arg = ''
+        compute_step = '_compute_step(data, x_input, '
+
+    func += '''
+        /**
+         * Compute one element of the Hessian with a progressive number of steps.
+         *
+         * Args:
+         *  nmr_steps_used: output, the number of steps evaluated for this element
+         *
+         * Returns:
+         *  the Richardson extrapolation with the smallest error estimate among the evaluated steps
+         */
+        double _adaptive_derivative(void* data, local mot_float_type* x_input, ''' + x_tmp_arg + '''
+                                    mot_float_type f_x_input, uint px, uint py,
+                                    global float* parameter_scalings_inv,
+                                    global float* initial_step,
+                                    uint* nmr_steps_used){
+            
+            double convolution_kernel[3] = {''' + ', '.join(map(str, richardson_coefficients)) + '''};
+            
+            // See _compute_richardson_errors for the magic number
+            double fact = max(
+                (mot_float_type)''' + str(12.7062047361747 * np.sqrt(np.sum(richardson_coefficients**2))) + ''',
+                (mot_float_type)MOT_EPSILON * 10);
+            
+            double derivatives[''' + str(nmr_steps) + '''];
+            double extrapolations[''' + str(nmr_steps - 2) + '''];
+            double error;
+            double error_tolerance;
+            double best_error = INFINITY;
+            uint best = 0;
+            uint conv_ind;
+            
+            for(uint step_ind = 0; step_ind < ''' + str(nmr_steps) + '''; step_ind++){
+                derivatives[step_ind] = ''' + compute_step + '''f_x_input, px, py, step_ind, 
+                    parameter_scalings_inv, initial_step);
+                *nmr_steps_used = step_ind + 1;
+                
+                if(step_ind < 2){
+                    continue;
+                }
+                
+                conv_ind = step_ind - 2;
+                extrapolations[conv_ind] = convolution_kernel[0] * derivatives[conv_ind] 
+                                           + convolution_kernel[1] * derivatives[conv_ind + 1] 
+                                           + convolution_kernel[2] * derivatives[conv_ind + 2];
+                
+                if(conv_ind == 0){
+                    continue;
+                }
+                
+                // the error of the previous extrapolation, which needed the current one
+                conv_ind--;
+                error_tolerance = max(fabs(extrapolations[conv_ind + 1]), 
+                                      fabs(extrapolations[conv_ind])) * MOT_EPSILON * fact;
+                error = fabs(extrapolations[conv_ind] - extrapolations[conv_ind + 1]) * fact;
+                
+                if(error <= error_tolerance){
+                    error += error_tolerance * 10;
+                }
+                else{
+                    error += fabs(extrapolations[conv_ind] - derivatives[conv_ind + 2]) * fact;
+                }
+                
+                if(isnan(error)){
+                    continue;
+                }
+                if(error > best_error){
+                    break;
+                }
+                
+                best = conv_ind;
+                best_error = error;
+                
+                if(error <= ''' + repr(float(tolerance)) + ''' * fabs(extrapolations[conv_ind])){
+                    break;
+                }
+            }
+            return extrapolations[best];
+        }
+    '''
+
+    if not parallel_evaluations:
+        return SimpleCLFunction.from_string('''
+            void compute(local mot_float_type* parameters,
+                         global float* parameter_scalings_inv,
+                         global float* initial_step,
+                         global double* derivatives,
+                         global uint* nmr_steps_used,
+                         void* data){
+                
+                double f_x_input = _calculate_function(data, parameters);
+                double tmp;
+                uint nmr_steps_element;
+                
+                uint coords[''' + str(len(coords)) + '''][2] = {
+                    ''' + ', '.join('{{{}, {}}}'.format(*c) for c in coords)  + '''
+                };
+                
+                for(uint coord_ind = 0; coord_ind < ''' + str(len(coords)) + '''; coord_ind++){
+                    tmp = _adaptive_derivative(data, parameters, f_x_input, 
+                                               coords[coord_ind][0], coords[coord_ind][1],
+                                               parameter_scalings_inv, initial_step, &nmr_steps_element);
+                    
+                    if(get_local_id(0) == 0){
+                        derivatives[coord_ind] = tmp;
+                        nmr_steps_used[coord_ind] = nmr_steps_element;
+                    }
+                }
+            }
+        ''', cl_extra=func)
+
+    return SimpleCLFunction.from_string('''
+        void compute(local mot_float_type* parameters,
+                     global float* parameter_scalings_inv,
+                     global float* initial_step,
+                     global double* derivatives,
+                     global uint* nmr_steps_used,
+                     local mot_float_type* x_scratch,
+                     void* data){
+            
+            local mot_float_type* x_tmp = x_scratch + get_local_id(0) * ''' + str(nmr_params) + ''';
+            double f_x_input = _calculate_function(data, parameters);
+            uint nmr_steps_element;
+            
+            uint coords[''' + str(len(coords)) + '''][2] = {
+                ''' + ', '.join('{{{}, {}}}'.format(*c) for c in coords)  + '''
+            };
+            
+            for(uint coord_ind = get_local_id(0); coord_ind < ''' + str(len(coords)) + '''; 
+                    coord_ind += get_local_size(0)){
+                derivatives[coord_ind] = _adaptive_derivative(
+                    data, parameters, x_tmp, f_x_input, coords[coord_ind][0], coords[coord_ind][1], 
+                    parameter_scalings_inv, initial_step, &nmr_steps_element);
+                nmr_steps_used[coord_ind] = nmr_steps_element;
+            }
+        }
+    ''', cl_extra=func)
+
+
 def _richardson_error_kernel(nmr_steps, nmr_convolutions, richardson_coefficients):
     func = _get_error_estimate_functions_cl(nmr_steps, nmr_convolutions, richardson_coefficients)
 
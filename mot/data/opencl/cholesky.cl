@@ -0,0 +1,52 @@
+#ifndef CHOLESKY_%(MEMSPACE)s_%(MEMTYPE)s_CL
+#define CHOLESKY_%(MEMSPACE)s_%(MEMTYPE)s_CL
+
+/**
+ * Author = Robbert Harms
+ * License = LGPL v3
+ * Maintainer = Robbert Harms
+ * Email = robbert.harms@maastrichtuniversity.nl
+ */
+
+/**
+ * Compute the Cholesky decomposition A = L L^T of a small symmetric positive definite matrix in place.
+ *
+ * The lower triangle of A is overwritten with L and the strictly upper triangle is set to zero, such that
+ * afterwards A holds the complete lower triangular matrix L. This should only be called by one work item.
+ *
+ * Args:
+ *  A: the symmetric (n, n) matrix in row-major order, this is overwritten with its Cholesky factor
+ *  n: the size of the matrix
+ *
+ * Returns:
+ *  1 if the matrix was positive definite and decomposed, 0 otherwise. In the latter case, the contents of A
+ *  are undefined.
+ */
+int cholesky_%(MEMSPACE)s_%(MEMTYPE)s(%(MEMSPACE)s %(MEMTYPE)s* const A, const int n){
+    int i, j, k;
+    %(MEMTYPE)s sum;
+
+    for(j = 0; j < n; j++){
+        sum = A[j * n + j];
+        for(k = 0; k < j; k++){
+            sum -= A[j * n + k] * A[j * n + k];
+        }
+
+        if(!(sum > 0) || !isfinite(sum)){
+            return 0;
+        }
+        A[j * n + j] = sqrt(sum);
+
+        for(i = j + 1; i < n; i++){
+            sum = A[i * n + j];
+            for(k = 0; k < j; k++){
+                sum -= A[i * n + k] * A[j * n + k];
+            }
+            A[i * n + j] = sum / A[j * n + j];
+            A[j * n + i] = 0;
+        }
+    }
+    return 1;
+}
+
+#endif // CHOLESKY_%(MEMSPACE)s_%(MEMTYPE)s_CL
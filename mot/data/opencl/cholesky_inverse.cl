@@ -0,0 +1,95 @@
+#ifndef CHOLESKY_INVERSE_%(MEMSPACE)s_%(MEMTYPE)s_CL
+#define CHOLESKY_INVERSE_%(MEMSPACE)s_%(MEMTYPE)s_CL
+
+/**
+ * Author = Robbert Harms
+ * License = LGPL v3
+ * Maintainer = Robbert Harms
+ * Email = robbert.harms@maastrichtuniversity.nl
+ */
+
+/**
+ * Invert a small symmetric positive definite matrix in place, using its Cholesky decomposition.
+ *
+ * We first decompose the matrix as A = L L^T, storing L in the lower triangle. We then compute the inverse of L,
+ * storing its diagonal on the diagonal and its strictly lower elements transposed in the upper triangle. Finally,
+ * we compute A^{-1} = L^{-T} L^{-1} row by row in the lower triangle and mirror it to the upper triangle.
+ * This needs no additional memory and should only be called by one work item.
+ *
+ * Matrices of which the ratio of the largest to the smallest pivot of the decomposition (the squared diagonal of L)
+ * exceeds the reciprocal of the machine precision are rejected as ill-conditioned. This ratio is a lower bound
+ * on the condition number of the matrix.
+ *
+ * Args:
+ *  A: the symmetric (n, n) matrix in row-major order, this is overwritten with its inverse
+ *  n: the size of the matrix
+ *
+ * Returns:
+ *  1 if the matrix was positive definite, well-conditioned and inverted, 0 otherwise. In the latter case, the contents of A
+ *  are undefined.
+ */
+int cholesky_inverse_%(MEMSPACE)s_%(MEMTYPE)s(%(MEMSPACE)s %(MEMTYPE)s* const A, const int n){
+    int i, j, k;
+    %(MEMTYPE)s sum;
+    %(MEMTYPE)s min_pivot = INFINITY;
+    %(MEMTYPE)s max_pivot = 0;
+
+    // the Cholesky decomposition, with the reciprocal of the diagonal of L on the diagonal
+    for(j = 0; j < n; j++){
+        sum = A[j * n + j];
+        for(k = 0; k < j; k++){
+            sum -= A[j * n + k] * A[j * n + k];
+        }
+
+        if(!(sum > 0) || !isfinite(sum)){
+            return 0;
+        }
+        min_pivot = fmin(min_pivot, sum);
+        max_pivot = fmax(max_pivot, sum);
+        A[j * n + j] = sqrt(sum);
+
+        for(i = j + 1; i < n; i++){
+            sum = A[i * n + j];
+            for(k = 0; k < j; k++){
+                sum -= A[i * n + k] * A[j * n + k];
+            }
+            A[i * n + j] = sum / A[j * n + j];
+        }
+        A[j * n + j] = 1 / A[j * n + j];
+    }
+
+    if(!(max_pivot * %(EPSILON)s < min_pivot)){
+        return 0;
+    }
+
+    // the inverse of L, with element (i, j) of the inverse stored in A[j, i]
+    for(j = 0; j < n; j++){
+        for(i = j + 1; i < n; i++){
+            sum = A[i * n + j] * A[j * n + j];
+            for(k = j + 1; k < i; k++){
+                sum += A[i * n + k] * A[j * n + k];
+            }
+            A[j * n + i] = -sum * A[i * n + i];
+        }
+    }
+
+    // the inverse of A, element (i, j) is the sum over k >= i of inv(L)[k, j] * inv(L)[k, i]
+    for(i = 0; i < n; i++){
+        for(j = 0; j <= i; j++){
+            sum = A[i * n + i] * (i == j ? A[i * n + i] : A[j * n + i]);
+            for(k = i + 1; k < n; k++){
+                sum += A[j * n + k] * A[i * n + k];
+            }
+            A[i * n + j] = sum;
+        }
+    }
+
+    for(i = 0; i < n; i++){
+        for(j = i + 1; j < n; j++){
+            A[i * n + j] = A[j * n + i];
+        }
+    }
+    return 1;
+}
+
+#endif // CHOLESKY_INVERSE_%(MEMSPACE)s_%(MEMTYPE)s_CL
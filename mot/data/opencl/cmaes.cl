@@ -0,0 +1,541 @@
+#ifndef CMAES_CL
+#define CMAES_CL
+
+/**
+ * Creator = Robbert Harms
+ * License = LGPL v3
+ * Maintainer = Robbert Harms
+ * Email = robbert.harms@maastrichtuniversity.nl
+ */
+
+/**
+   Covariance Matrix Adaptation Evolution Strategy (CMA-ES) minimization of an objective function.
+
+   Every generation, lambda candidates are sampled from a multivariate normal distribution around the mean. The
+   mean moves to the weighted average of the best mu candidates, after which the step size and the covariance matrix
+   of the distribution are adapted using the evolution paths [1]. The covariance matrix is decomposed into its
+   eigenvectors and eigenvalues for sampling the candidates.
+
+   On termination of a run, the strategy is restarted from the starting point with a doubled population size (IPOP)
+   [2], for at most the given number of restarts. The best candidate over all runs is returned.
+
+   All the state is kept in local memory. The candidates and the covariance matrix update are computed in parallel
+   over the work items, each work item using its own random stream. Every objective function evaluation runs on all
+   the work items of the work group, such that the model evaluations are spread over the work items.
+
+   References:
+
+   [1] Hansen, N. (2016). "The CMA Evolution Strategy: A Tutorial". arXiv:1604.00772.
+   [2] Auger, A. and Hansen, N. (2005). "A Restart CMA Evolution Strategy With Increasing Population Size".
+        IEEE Congress on Evolutionary Computation. 2: 1769-1776. doi:10.1109/CEC.2005.1554902.
+*/
+
+/* Used to set the maximum number of generations per run to patience*(number_of_parameters+1). */
+#define CMAES_MAX_GENERATIONS (%(PATIENCE)r * (%(NMR_PARAMS)r+1))
+#define CMAES_POPULATION_SIZE %(POPULATION_SIZE)r
+#define CMAES_NMR_RESTARTS %(NMR_RESTARTS)r
+#define CMAES_MAX_POPULATION_SIZE (CMAES_POPULATION_SIZE << CMAES_NMR_RESTARTS)
+#define CMAES_SCALE %(SCALE)r
+#define CMAES_FUNCTION_TOLERANCE 30*MOT_EPSILON
+#define CMAES_X_TOLERANCE 30*MOT_EPSILON
+#define CMAES_MAX_CONDITION 1e7 /* the maximum ratio of the largest and the smallest axis of the distribution */
+
+/**
+ * If set, we load and store the distribution in the optimizer state such that the optimization can be resumed.
+ * The state is laid out as [is_initialized, sigma, restart, generation, mean[nmr_params], pc[nmr_params],
+ * ps[nmr_params], C[nmr_params][nmr_params]].
+ */
+#define CMAES_USE_STATE %(USE_STATE)r
+
+/**
+ * If set, we write the number of generations to ``nmr_iterations`` on return.
+ */
+#define CMAES_USE_STATISTICS %(USE_STATISTICS)r
+
+/**
+ * If set, we record the best function value at the start of every generation and on return,
+ * see ``optimizer_trace``.
+ */
+#define CMAES_USE_TRACE %(USE_TRACE)r
+
+#if CMAES_USE_STATE
+    #define CMAES_SAVE_STATE() cmaes_save_state(&cmaes, optimizer_state);
+#else
+    #define CMAES_SAVE_STATE()
+#endif
+
+#if CMAES_USE_STATISTICS
+    #define CMAES_SAVE_STATISTICS() *nmr_iterations = nmr_generations;
+#else
+    #define CMAES_SAVE_STATISTICS()
+#endif
+
+#if CMAES_USE_TRACE
+    #define CMAES_SAVE_TRACE(f, x) optimizer_trace(f, x%(TRACE_ARGUMENT)s);
+#else
+    #define CMAES_SAVE_TRACE(f, x)
+#endif
+
+/* The random state is advanced on return such that a next launch uses new random numbers. */
+#define CMAES_RETURN(return_code) { \
+    if(get_local_id(0) == 0){ \
+        CMAES_SAVE_STATE() \
+        CMAES_SAVE_STATISTICS() \
+        CMAES_SAVE_TRACE(cmaes.best_fval, model_parameters) \
+        rng_state[3]++; \
+    } \
+    return return_code; \
+}
+
+
+/** The evaluation function we are expecting. */
+double %(FUNCTION_NAME)s(local mot_float_type* x, void* data_void);
+
+
+/**
+ * The state of the evolution strategy.
+ */
+typedef struct{
+    /* the settings of the current run */
+    uint lambda;
+    uint mu;
+    double weights[CMAES_MAX_POPULATION_SIZE / 2];
+    double mu_eff;
+    double cc;
+    double cs;
+    double c1;
+    double cmu;
+    double damps;
+    double chi_n;
+
+    /* the distribution */
+    uint restart;
+    uint generation;
+    uint eigen_generation;
+    double sigma;
+    mot_float_type mean[%(NMR_PARAMS)r];
+    mot_float_type pc[%(NMR_PARAMS)r];
+    mot_float_type ps[%(NMR_PARAMS)r];
+    mot_float_type C[%(NMR_PARAMS)r * %(NMR_PARAMS)r];
+    mot_float_type B[%(NMR_PARAMS)r * %(NMR_PARAMS)r];
+    mot_float_type D[%(NMR_PARAMS)r];
+    mot_float_type eigen_scratch[%(NMR_PARAMS)r * %(NMR_PARAMS)r];
+    double hsig;
+
+    /* the candidates of the current generation, as steps from the mean in units of sigma */
+    mot_float_type steps[CMAES_MAX_POPULATION_SIZE][%(NMR_PARAMS)r];
+    mot_float_type candidate[%(NMR_PARAMS)r];
+    double fitness[CMAES_MAX_POPULATION_SIZE];
+    uint ranking[CMAES_MAX_POPULATION_SIZE];
+
+    /* the starting point and the best candidate over all runs */
+    mot_float_type start[%(NMR_PARAMS)r];
+    double best_fval;
+} cmaes_data;
+
+
+/**
+ * Update the eigendecomposition ``C = B * D^2 * B^T`` of the covariance matrix.
+ */
+void cmaes_update_eigen(local cmaes_data* const cmaes){
+    int i;
+    mot_float_type max_eigenvalue = 0;
+
+    for(i = 0; i < %(NMR_PARAMS)r * %(NMR_PARAMS)r; i++){
+        cmaes->eigen_scratch[i] = cmaes->C[i];
+    }
+    eigen_symmetric_local_mot_float_type(cmaes->eigen_scratch, cmaes->B, cmaes->D, %(NMR_PARAMS)r);
+
+    for(i = 0; i < %(NMR_PARAMS)r; i++){
+        max_eigenvalue = fmax(max_eigenvalue, cmaes->D[i]);
+    }
+    for(i = 0; i < %(NMR_PARAMS)r; i++){
+        cmaes->D[i] = sqrt(fmax(cmaes->D[i], max_eigenvalue * (mot_float_type)MOT_EPSILON));
+    }
+    cmaes->eigen_generation = cmaes->generation;
+}
+
+/**
+ * Set the strategy parameters for the population size of the current restart.
+ */
+void cmaes_initialize_settings(local cmaes_data* const cmaes){
+    uint i;
+    double sum = 0;
+    double sum_squares = 0;
+    const double n = %(NMR_PARAMS)r;
+
+    cmaes->lambda = CMAES_POPULATION_SIZE << cmaes->restart;
+    cmaes->mu = cmaes->lambda / 2;
+
+    for(i = 0; i < cmaes->mu; i++){
+        cmaes->weights[i] = log(cmaes->mu + 0.5) - log(i + 1.0);
+        sum += cmaes->weights[i];
+    }
+    for(i = 0; i < cmaes->mu; i++){
+        cmaes->weights[i] /= sum;
+        sum_squares += cmaes->weights[i] * cmaes->weights[i];
+    }
+    cmaes->mu_eff = 1 / sum_squares;
+
+    cmaes->cc = (4 + cmaes->mu_eff / n) / (n + 4 + 2 * cmaes->mu_eff / n);
+    cmaes->cs = (cmaes->mu_eff + 2) / (n + cmaes->mu_eff + 5);
+    cmaes->c1 = 2 / (pown(n + 1.3, 2) + cmaes->mu_eff);
+    cmaes->cmu = fmin(1 - cmaes->c1, 2 * (cmaes->mu_eff - 2 + 1 / cmaes->mu_eff) / (pown(n + 2, 2) + cmaes->mu_eff));
+    cmaes->damps = 1 + 2 * fmax(sqrt((cmaes->mu_eff - 1) / (n + 1)) - 1, (double)0) + cmaes->cs;
+    cmaes->chi_n = sqrt(n) * (1 - 1 / (4 * n) + 1 / (21 * n * n));
+}
+
+/**
+ * Start a new run from the starting point, with an axis-parallel distribution of ``scale * max(|x|, 1)``
+ * per parameter.
+ */
+void cmaes_start_run(local cmaes_data* const cmaes){
+    int i, j;
+
+    cmaes_initialize_settings(cmaes);
+
+    cmaes->generation = 0;
+    cmaes->sigma = CMAES_SCALE;
+
+    for(i = 0; i < %(NMR_PARAMS)r; i++){
+        cmaes->mean[i] = cmaes->start[i];
+        cmaes->pc[i] = 0;
+        cmaes->ps[i] = 0;
+
+        for(j = 0; j < %(NMR_PARAMS)r; j++){
+            cmaes->C[i * %(NMR_PARAMS)r + j] = 0;
+        }
+        cmaes->C[i * %(NMR_PARAMS)r + i] = pown(fmax(fabs(cmaes->start[i]), (mot_float_type)1.0), 2);
+    }
+    cmaes_update_eigen(cmaes);
+}
+
+/**
+ * Load the distribution from the optimizer state, or start a new run if the state is not yet initialized.
+ */
+void cmaes_load_state(local cmaes_data* const cmaes, global const mot_float_type* const optimizer_state){
+    int i;
+
+    if(optimizer_state[0] == 0){
+        cmaes->restart = 0;
+        cmaes_start_run(cmaes);
+        return;
+    }
+
+    cmaes->sigma = optimizer_state[1];
+    cmaes->restart = (uint)optimizer_state[2];
+    cmaes->generation = (uint)optimizer_state[3];
+
+    for(i = 0; i < %(NMR_PARAMS)r; i++){
+        cmaes->mean[i] = optimizer_state[4 + i];
+        cmaes->pc[i] = optimizer_state[4 + %(NMR_PARAMS)r + i];
+        cmaes->ps[i] = optimizer_state[4 + 2 * %(NMR_PARAMS)r + i];
+    }
+    for(i = 0; i < %(NMR_PARAMS)r * %(NMR_PARAMS)r; i++){
+        cmaes->C[i] = optimizer_state[4 + 3 * %(NMR_PARAMS)r + i];
+    }
+
+    cmaes_initialize_settings(cmaes);
+    cmaes_update_eigen(cmaes);
+}
+
+/**
+ * Store the distribution in the optimizer state.
+ */
+void cmaes_save_state(local cmaes_data* const cmaes, global mot_float_type* const optimizer_state){
+    int i;
+
+    optimizer_state[0] = 1;
+    optimizer_state[1] = cmaes->sigma;
+    optimizer_state[2] = cmaes->restart;
+    optimizer_state[3] = cmaes->generation;
+
+    for(i = 0; i < %(NMR_PARAMS)r; i++){
+        optimizer_state[4 + i] = cmaes->mean[i];
+        optimizer_state[4 + %(NMR_PARAMS)r + i] = cmaes->pc[i];
+        optimizer_state[4 + 2 * %(NMR_PARAMS)r + i] = cmaes->ps[i];
+    }
+    for(i = 0; i < %(NMR_PARAMS)r * %(NMR_PARAMS)r; i++){
+        optimizer_state[4 + 3 * %(NMR_PARAMS)r + i] = cmaes->C[i];
+    }
+}
+
+/**
+ * Sample the step of one candidate, ``B * D * z`` with ``z`` standard normal distributed.
+ */
+void cmaes_sample(local cmaes_data* const cmaes, uint candidate, void* rng_data){
+    int i, j;
+    mot_float_type z[%(NMR_PARAMS)r];
+
+    for(j = 0; j < %(NMR_PARAMS)r; j++){
+        z[j] = cmaes->D[j] * randn(rng_data);
+    }
+    for(i = 0; i < %(NMR_PARAMS)r; i++){
+        cmaes->steps[candidate][i] = 0;
+        for(j = 0; j < %(NMR_PARAMS)r; j++){
+            cmaes->steps[candidate][i] += cmaes->B[i * %(NMR_PARAMS)r + j] * z[j];
+        }
+    }
+}
+
+/**
+ * Sort the candidates on their function value, using an insertion sort.
+ */
+void cmaes_rank(local cmaes_data* const cmaes){
+    uint i, j, index;
+
+    for(i = 0; i < cmaes->lambda; i++){
+        index = i;
+        for(j = i; j > 0 && cmaes->fitness[cmaes->ranking[j - 1]] > cmaes->fitness[index]; j--){
+            cmaes->ranking[j] = cmaes->ranking[j - 1];
+        }
+        cmaes->ranking[j] = index;
+    }
+}
+
+/**
+ * Move the mean to the weighted average of the best candidates and update the evolution paths and the step size.
+ */
+void cmaes_update_mean(local cmaes_data* const cmaes){
+    int i, j;
+    uint k;
+    mot_float_type y_w[%(NMR_PARAMS)r];
+    mot_float_type tmp[%(NMR_PARAMS)r];
+    double ps_norm = 0;
+
+    for(i = 0; i < %(NMR_PARAMS)r; i++){
+        y_w[i] = 0;
+        for(k = 0; k < cmaes->mu; k++){
+            y_w[i] += cmaes->weights[k] * cmaes->steps[cmaes->ranking[k]][i];
+        }
+        cmaes->mean[i] += cmaes->sigma * y_w[i];
+    }
+
+    // ps is updated with C^(-1/2) * y_w = B * D^-1 * B^T * y_w
+    for(j = 0; j < %(NMR_PARAMS)r; j++){
+        tmp[j] = 0;
+        for(i = 0; i < %(NMR_PARAMS)r; i++){
+            tmp[j] += cmaes->B[i * %(NMR_PARAMS)r + j] * y_w[i];
+        }
+        tmp[j] /= cmaes->D[j];
+    }
+    for(i = 0; i < %(NMR_PARAMS)r; i++){
+        mot_float_type c_y = 0;
+        for(j = 0; j < %(NMR_PARAMS)r; j++){
+            c_y += cmaes->B[i * %(NMR_PARAMS)r + j] * tmp[j];
+        }
+        cmaes->ps[i] = (1 - cmaes->cs) * cmaes->ps[i] + sqrt(cmaes->cs * (2 - cmaes->cs) * cmaes->mu_eff) * c_y;
+        ps_norm += cmaes->ps[i] * cmaes->ps[i];
+    }
+    ps_norm = sqrt(ps_norm);
+
+    cmaes->hsig = (ps_norm / sqrt(1 - pown(1 - cmaes->cs, 2 * (cmaes->generation + 1))) / cmaes->chi_n)
+                  < (1.4 + 2 / (%(NMR_PARAMS)r + 1.0));
+
+    for(i = 0; i < %(NMR_PARAMS)r; i++){
+        cmaes->pc[i] = (1 - cmaes->cc) * cmaes->pc[i]
+                       + cmaes->hsig * sqrt(cmaes->cc * (2 - cmaes->cc) * cmaes->mu_eff) * y_w[i];
+    }
+
+    cmaes->sigma *= exp((cmaes->cs / cmaes->damps) * (ps_norm / cmaes->chi_n - 1));
+}
+
+/**
+ * Update one element, and its symmetric counterpart, of the covariance matrix using the rank-one and rank-mu update.
+ */
+void cmaes_update_covariance_element(local cmaes_data* const cmaes, uint i, uint j){
+    uint k;
+    double rank_mu = 0;
+    double value;
+
+    for(k = 0; k < cmaes->mu; k++){
+        rank_mu += cmaes->weights[k] * cmaes->steps[cmaes->ranking[k]][i] * cmaes->steps[cmaes->ranking[k]][j];
+    }
+
+    value = (1 - cmaes->c1 - cmaes->cmu) * cmaes->C[i * %(NMR_PARAMS)r + j]
+            + cmaes->c1 * (cmaes->pc[i] * cmaes->pc[j]
+                           + (1 - cmaes->hsig) * cmaes->cc * (2 - cmaes->cc) * cmaes->C[i * %(NMR_PARAMS)r + j])
+            + cmaes->cmu * rank_mu;
+
+    cmaes->C[i * %(NMR_PARAMS)r + j] = value;
+    cmaes->C[j * %(NMR_PARAMS)r + i] = value;
+}
+
+/**
+ * Check if the current run should stop.
+ *
+ * Returns:
+ *  0 to continue, 2 if the function values of the generation are within tolerance, 3 if the distribution is within
+ *  tolerance, 5 if the distribution is degenerate and 6 if the maximum number of generations is reached.
+ */
+int cmaes_stop_criterium(local cmaes_data* const cmaes, uint nmr_run_generations){
+    int i;
+    double fval_best = cmaes->fitness[cmaes->ranking[0]];
+    double fval_worst = cmaes->fitness[cmaes->ranking[cmaes->lambda - 1]];
+    mot_float_type max_std = 0;
+    mot_float_type max_mean = 1;
+    mot_float_type min_axis = INFINITY;
+    mot_float_type max_axis = 0;
+
+    for(i = 0; i < %(NMR_PARAMS)r; i++){
+        max_std = fmax(max_std, sqrt(cmaes->C[i * %(NMR_PARAMS)r + i]));
+        max_mean = fmax(max_mean, fabs(cmaes->mean[i]));
+        min_axis = fmin(min_axis, cmaes->D[i]);
+        max_axis = fmax(max_axis, cmaes->D[i]);
+    }
+
+    if(fval_worst - fval_best <= CMAES_FUNCTION_TOLERANCE * fabs(fval_best) + CMAES_FUNCTION_TOLERANCE){
+        return 2;
+    }
+    if(cmaes->sigma * max_std <= CMAES_X_TOLERANCE * max_mean){
+        return 3;
+    }
+    if(!isfinite(cmaes->sigma) || max_axis > CMAES_MAX_CONDITION * min_axis){
+        return 5;
+    }
+    if(nmr_run_generations >= CMAES_MAX_GENERATIONS){
+        return 6;
+    }
+    return 0;
+}
+
+
+int cmaes(local mot_float_type* model_parameters, void* data,
+          global uint* rng_state%(STATE_PARAMETER)s%(STATISTICS_PARAMETER)s
+          %(TRACE_PARAMETER)s){
+    uint i, j, k;
+    double fval;
+
+    local cmaes_data cmaes;
+    local uint nmr_generations;
+    local uint nmr_run_generations;
+    local int stop;
+
+    // every work item uses its own random stream
+    uint rng_seed[8] = {rng_state[0], rng_state[1], rng_state[2], rng_state[3],
+                        rng_state[4], rng_state[5], get_local_id(0), 0};
+    rand123_data rand123_rng_data = rand123_initialize_data(rng_seed);
+    void* rng_data = (void*)&rand123_rng_data;
+
+    if(get_local_id(0) == 0){
+        nmr_generations = 0;
+        nmr_run_generations = 0;
+        stop = 0;
+
+        for(i = 0; i < %(NMR_PARAMS)r; i++){
+            cmaes.start[i] = model_parameters[i];
+        }
+
+        #if CMAES_USE_STATE
+            cmaes_load_state(&cmaes, optimizer_state);
+        #else
+            cmaes.restart = 0;
+            cmaes_start_run(&cmaes);
+        #endif
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    fval = %(FUNCTION_NAME)s(model_parameters, data);
+    if(get_local_id(0) == 0){
+        cmaes.best_fval = isnan(fval) ? INFINITY : fval;
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    while(true){
+        if(get_local_id(0) == 0){
+            CMAES_SAVE_TRACE(cmaes.best_fval, model_parameters)
+        }
+
+        for(k = get_local_id(0); k < cmaes.lambda; k += get_local_size(0)){
+            cmaes_sample(&cmaes, k, rng_data);
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        for(k = 0; k < cmaes.lambda; k++){
+            if(get_local_id(0) == 0){
+                for(i = 0; i < %(NMR_PARAMS)r; i++){
+                    cmaes.candidate[i] = cmaes.mean[i] + cmaes.sigma * cmaes.steps[k][i];
+                }
+            }
+            barrier(CLK_LOCAL_MEM_FENCE);
+
+            fval = %(FUNCTION_NAME)s(cmaes.candidate, data);
+            barrier(CLK_LOCAL_MEM_FENCE);
+
+            if(get_local_id(0) == 0){
+                cmaes.fitness[k] = isnan(fval) ? INFINITY : fval;
+
+                if(cmaes.fitness[k] < cmaes.best_fval){
+                    cmaes.best_fval = cmaes.fitness[k];
+                    for(i = 0; i < %(NMR_PARAMS)r; i++){
+                        model_parameters[i] = cmaes.candidate[i];
+                    }
+                }
+            }
+        }
+
+        if(get_local_id(0) == 0){
+            cmaes_rank(&cmaes);
+            cmaes_update_mean(&cmaes);
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        for(k = get_local_id(0); k < %(NMR_PARAMS)r * %(NMR_PARAMS)r; k += get_local_size(0)){
+            i = k / %(NMR_PARAMS)r;
+            j = k %% %(NMR_PARAMS)r;
+            if(j >= i){
+                cmaes_update_covariance_element(&cmaes, i, j);
+            }
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        if(get_local_id(0) == 0){
+            cmaes.generation++;
+            nmr_generations++;
+            nmr_run_generations++;
+
+            // the eigendecomposition is only updated every few generations, as in [1]
+            if(cmaes.generation - cmaes.eigen_generation
+                    > cmaes.lambda / ((cmaes.c1 + cmaes.cmu) * %(NMR_PARAMS)r * 10)){
+                cmaes_update_eigen(&cmaes);
+            }
+
+            stop = cmaes_stop_criterium(&cmaes, nmr_run_generations);
+
+            if(stop && cmaes.restart < CMAES_NMR_RESTARTS){
+                cmaes.restart++;
+                cmaes_start_run(&cmaes);
+                nmr_run_generations = 0;
+                stop = 0;
+            }
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        if(stop){
+            break;
+        }
+    }
+
+    if(!isfinite(cmaes.best_fval)){
+        CMAES_RETURN(10);
+    }
+    CMAES_RETURN(stop);
+}
+
+#undef CMAES_MAX_GENERATIONS
+#undef CMAES_POPULATION_SIZE
+#undef CMAES_NMR_RESTARTS
+#undef CMAES_MAX_POPULATION_SIZE
+#undef CMAES_SCALE
+#undef CMAES_FUNCTION_TOLERANCE
+#undef CMAES_X_TOLERANCE
+#undef CMAES_MAX_CONDITION
+#undef CMAES_USE_STATE
+#undef CMAES_USE_STATISTICS
+#undef CMAES_USE_TRACE
+#undef CMAES_SAVE_STATE
+#undef CMAES_SAVE_STATISTICS
+#undef CMAES_SAVE_TRACE
+#undef CMAES_RETURN
+
+#endif // CMAES_CL
@@ -0,0 +1,363 @@
+#ifndef DIFFERENTIAL_EVOLUTION_CL
+#define DIFFERENTIAL_EVOLUTION_CL
+
+/**
+ * Creator = Robbert Harms
+ * License = LGPL v3
+ * Maintainer = Robbert Harms
+ * Email = robbert.harms@maastrichtuniversity.nl
+ */
+
+/**
+   Differential Evolution minimization of an objective function in a multidimensional space.
+
+   This is a population based global optimizer [1]. Every generation, each member of the population is mutated
+   by adding the scaled difference of two other members to a base member, and crossed over with the original
+   member. The resulting trial member replaces the original member if it has a lower or equal function value.
+
+   The population is kept in local memory. The trial members and the selection are computed in parallel over the
+   work items, each work item using its own random stream. Every objective function evaluation runs on all the
+   work items of the work group, such that the model evaluations are spread over the work items. After
+   convergence, the best member can optionally be polished by a local optimization routine in the same kernel.
+
+   References:
+
+   [1] Storn, R. and Price, K. (1997). "Differential Evolution - A Simple and Efficient Heuristic for Global
+        Optimization over Continuous Spaces". Journal of Global Optimization. 11 (4): 341-359.
+        doi:10.1023/A:1008202821328.
+*/
+
+/* Used to set the maximum number of generations to patience*(number_of_parameters+1). */
+#define DE_MAX_GENERATIONS (%(PATIENCE)r * (%(NMR_PARAMS)r+1))
+#define DE_POPULATION_SIZE %(POPULATION_SIZE)r
+#define DE_MUTATION %(MUTATION)r
+#define DE_CROSSOVER %(CROSSOVER)r
+#define DE_TOLERANCE %(TOLERANCE)r
+#define DE_SCALE %(SCALE)r
+#define DE_EPSILON 30*MOT_EPSILON
+
+/**
+ * The strategy used for the base member, either a random member (rand1bin) or the best member (best1bin).
+ */
+#define DE_STRATEGY_RAND1BIN 0
+#define DE_STRATEGY_BEST1BIN 1
+#define DE_STRATEGY DE_STRATEGY_%(STRATEGY)s
+
+/**
+ * If set, we polish the best member using the local optimization routine ``%(POLISH_FUNCTION_NAME)s``.
+ */
+#define DE_USE_POLISH %(USE_POLISH)r
+
+/**
+ * If set, we load and store the population in the optimizer state such that the optimization can be resumed.
+ * The state is laid out as [is_initialized, best_member, population[population_size][nmr_params]].
+ */
+#define DE_USE_STATE %(USE_STATE)r
+
+/**
+ * If set, we write the number of generations to ``nmr_iterations`` on return.
+ */
+#define DE_USE_STATISTICS %(USE_STATISTICS)r
+
+/**
+ * If set, we record the function value of the best member at the start of every generation and on return,
+ * see ``optimizer_trace``.
+ */
+#define DE_USE_TRACE %(USE_TRACE)r
+
+#if DE_USE_STATE
+    #define DE_SAVE_STATE() de_save_state(population, best, optimizer_state);
+#else
+    #define DE_SAVE_STATE()
+#endif
+
+#if DE_USE_STATISTICS
+    #define DE_SAVE_STATISTICS() *nmr_iterations = generation;
+#else
+    #define DE_SAVE_STATISTICS()
+#endif
+
+#if DE_USE_TRACE
+    #define DE_SAVE_TRACE(f, x) optimizer_trace(f, x%(TRACE_ARGUMENT)s);
+#else
+    #define DE_SAVE_TRACE(f, x)
+#endif
+
+/* The random state is advanced on return such that a next launch uses new random numbers. */
+#define DE_RETURN(return_code) { \
+    if(get_local_id(0) == 0){ \
+        DE_SAVE_STATE() \
+        DE_SAVE_STATISTICS() \
+        DE_SAVE_TRACE(fval, model_parameters) \
+        rng_state[3]++; \
+    } \
+    return return_code; \
+}
+
+
+/** The evaluation function we are expecting. */
+double %(FUNCTION_NAME)s(local mot_float_type* x, void* data_void);
+
+
+/**
+ * Get a random member index.
+ */
+uint de_random_member(void* rng_data){
+    return min((uint)(rand(rng_data) * DE_POPULATION_SIZE), (uint)(DE_POPULATION_SIZE - 1));
+}
+
+/**
+ * Get the index of the member with the lowest function value.
+ */
+uint de_best_member(local const double* const fitness){
+    uint best = 0;
+    for(uint i = 1; i < DE_POPULATION_SIZE; i++){
+        if(fitness[i] < fitness[best]){
+            best = i;
+        }
+    }
+    return best;
+}
+
+/**
+ * Check if the spread of the function values in the population is small enough to stop.
+ *
+ * This stops if the standard deviation of the function values is at most the tolerance times the mean.
+ */
+bool de_converged(local const double* const fitness){
+    double mean = 0;
+    double variance = 0;
+
+    for(uint i = 0; i < DE_POPULATION_SIZE; i++){
+        mean += fitness[i];
+    }
+    mean /= DE_POPULATION_SIZE;
+
+    for(uint i = 0; i < DE_POPULATION_SIZE; i++){
+        variance += pown(fitness[i] - mean, 2);
+    }
+    variance /= DE_POPULATION_SIZE;
+
+    return sqrt(variance) <= DE_TOLERANCE * fabs(mean) + DE_EPSILON;
+}
+
+/**
+ * Initialize the members of the population handled by this work item.
+ *
+ * Without state, the first member is the starting point and the other members are drawn uniformly around the
+ * starting point, within ``scale * max(|x|, 1)`` per parameter. With state, the population is loaded and the previous
+ * best member is replaced by the starting point, which may have been polished in the previous launch.
+ */
+void de_initialize_population(local mot_float_type population[DE_POPULATION_SIZE][%(NMR_PARAMS)r],
+                              local const mot_float_type* const model_parameters,
+                              void* rng_data%(STATE_PARAMETER)s){
+    uint i, j;
+    for(i = get_local_id(0); i < DE_POPULATION_SIZE; i += get_local_size(0)){
+        #if DE_USE_STATE
+            if(optimizer_state[0] != 0 && i != (uint)optimizer_state[1]){
+                for(j = 0; j < %(NMR_PARAMS)r; j++){
+                    population[i][j] = optimizer_state[2 + i * %(NMR_PARAMS)r + j];
+                }
+                continue;
+            }
+            if(optimizer_state[0] != 0){
+                for(j = 0; j < %(NMR_PARAMS)r; j++){
+                    population[i][j] = model_parameters[j];
+                }
+                continue;
+            }
+        #endif
+
+        for(j = 0; j < %(NMR_PARAMS)r; j++){
+            population[i][j] = model_parameters[j];
+            if(i > 0){
+                population[i][j] += DE_SCALE * (2 * rand(rng_data) - 1) * fmax(fabs(model_parameters[j]), 1);
+            }
+        }
+    }
+}
+
+/**
+ * Store the population in the optimizer state.
+ */
+void de_save_state(local mot_float_type population[DE_POPULATION_SIZE][%(NMR_PARAMS)r],
+                   uint best,
+                   global mot_float_type* const optimizer_state){
+    optimizer_state[0] = 1;
+    optimizer_state[1] = best;
+    for(uint i = 0; i < DE_POPULATION_SIZE; i++){
+        for(uint j = 0; j < %(NMR_PARAMS)r; j++){
+            optimizer_state[2 + i * %(NMR_PARAMS)r + j] = population[i][j];
+        }
+    }
+}
+
+/**
+ * Generate the trial member for the given member using mutation and binomial crossover.
+ *
+ * Modifies:
+ *  trial: set to the trial member
+ */
+void de_trial_member(uint member, uint best,
+                     local mot_float_type population[DE_POPULATION_SIZE][%(NMR_PARAMS)r],
+                     local mot_float_type* const trial,
+                     void* rng_data){
+    uint base, r1, r2, r3, crossover_index;
+
+    do{
+        r1 = de_random_member(rng_data);
+    } while(r1 == member);
+    do{
+        r2 = de_random_member(rng_data);
+    } while(r2 == member || r2 == r1);
+    do{
+        r3 = de_random_member(rng_data);
+    } while(r3 == member || r3 == r1 || r3 == r2);
+
+    #if DE_STRATEGY == DE_STRATEGY_BEST1BIN
+        base = best;
+    #else
+        base = r1;
+    #endif
+
+    // at least one parameter is always taken from the mutant
+    crossover_index = min((uint)(rand(rng_data) * %(NMR_PARAMS)r), (uint)(%(NMR_PARAMS)r - 1));
+
+    for(uint j = 0; j < %(NMR_PARAMS)r; j++){
+        if(j == crossover_index || rand(rng_data) < DE_CROSSOVER){
+            trial[j] = population[base][j] + DE_MUTATION * (population[r2][j] - population[r3][j]);
+        }
+        else{
+            trial[j] = population[member][j];
+        }
+    }
+}
+
+
+int differential_evolution(local mot_float_type* model_parameters, void* data,
+                           global uint* rng_state%(STATE_PARAMETER)s%(STATISTICS_PARAMETER)s%(POLISH_PARAMETER)s
+                           %(TRACE_PARAMETER)s){
+    uint i, j;
+    int return_code;
+    double fval;
+
+    local int generation;
+    local int converged;
+    local uint best;
+
+    local mot_float_type population[DE_POPULATION_SIZE][%(NMR_PARAMS)r];
+    local mot_float_type trials[DE_POPULATION_SIZE][%(NMR_PARAMS)r];
+    local double fitness[DE_POPULATION_SIZE];
+    local double trial_fitness[DE_POPULATION_SIZE];
+
+    // every work item uses its own random stream
+    uint rng_seed[8] = {rng_state[0], rng_state[1], rng_state[2], rng_state[3],
+                        rng_state[4], rng_state[5], get_local_id(0), 0};
+    rand123_data rand123_rng_data = rand123_initialize_data(rng_seed);
+    void* rng_data = (void*)&rand123_rng_data;
+
+    if(get_local_id(0) == 0){
+        generation = 0;
+        converged = 0;
+    }
+    de_initialize_population(population, model_parameters, rng_data%(STATE_ARGUMENT)s);
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    for(i = 0; i < DE_POPULATION_SIZE; i++){
+        fval = %(FUNCTION_NAME)s(population[i], data);
+        if(get_local_id(0) == 0){
+            fitness[i] = isnan(fval) ? INFINITY : fval;
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if(get_local_id(0) == 0){
+        best = de_best_member(fitness);
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    while(generation < DE_MAX_GENERATIONS){
+        if(get_local_id(0) == 0){
+            DE_SAVE_TRACE(fitness[best], population[best])
+            converged = de_converged(fitness);
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        if(converged){
+            break;
+        }
+
+        for(i = get_local_id(0); i < DE_POPULATION_SIZE; i += get_local_size(0)){
+            de_trial_member(i, best, population, trials[i], rng_data);
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        for(i = 0; i < DE_POPULATION_SIZE; i++){
+            fval = %(FUNCTION_NAME)s(trials[i], data);
+            if(get_local_id(0) == 0){
+                trial_fitness[i] = isnan(fval) ? INFINITY : fval;
+            }
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        for(i = get_local_id(0); i < DE_POPULATION_SIZE; i += get_local_size(0)){
+            if(trial_fitness[i] <= fitness[i]){
+                for(j = 0; j < %(NMR_PARAMS)r; j++){
+                    population[i][j] = trials[i][j];
+                }
+                fitness[i] = trial_fitness[i];
+            }
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        if(get_local_id(0) == 0){
+            best = de_best_member(fitness);
+            generation++;
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+
+    if(get_local_id(0) == 0){
+        for(j = 0; j < %(NMR_PARAMS)r; j++){
+            model_parameters[j] = population[best][j];
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    fval = fitness[best];
+    if(!isfinite(fval)){
+        DE_RETURN(10);
+    }
+
+    return_code = converged ? 2 : 6;
+
+    #if DE_USE_POLISH
+        return_code = %(POLISH_FUNCTION_NAME)s(model_parameters, data%(POLISH_ARGUMENT)s);
+        #if DE_USE_TRACE
+            fval = %(FUNCTION_NAME)s(model_parameters, data);
+        #endif
+    #endif
+
+    DE_RETURN(return_code);
+}
+
+#undef DE_MAX_GENERATIONS
+#undef DE_POPULATION_SIZE
+#undef DE_MUTATION
+#undef DE_CROSSOVER
+#undef DE_TOLERANCE
+#undef DE_SCALE
+#undef DE_EPSILON
+#undef DE_STRATEGY_RAND1BIN
+#undef DE_STRATEGY_BEST1BIN
+#undef DE_STRATEGY
+#undef DE_USE_POLISH
+#undef DE_USE_STATE
+#undef DE_USE_STATISTICS
+#undef DE_USE_TRACE
+#undef DE_SAVE_STATE
+#undef DE_SAVE_STATISTICS
+#undef DE_SAVE_TRACE
+#undef DE_RETURN
+
+#endif // DIFFERENTIAL_EVOLUTION_CL
@@ -0,0 +1,131 @@
+#ifndef DUAL_NUMBERS_CL
+#define DUAL_NUMBERS_CL
+
+/**
+ * Author = Robbert Harms
+ * License = LGPL v3
+ * Maintainer = Robbert Harms
+ * Email = robbert.harms@maastrichtuniversity.nl
+ */
+
+/**
+ * Forward mode automatic differentiation using (multi-component) dual numbers.
+ *
+ * A dual number holds a value and the gradient of that value with respect to all %(NMR_PARAMS)s model parameters.
+ * Writing a function using the operations below propagates the derivatives alongside the values, such that
+ * after a single evaluation the complete gradient is available in the ``d`` member of the result.
+ */
+typedef struct{
+    double v;
+    double d[%(NMR_PARAMS)s];
+} mot_dual;
+
+/**
+ * Create a dual number for a constant, i.e. with a zero gradient.
+ */
+mot_dual dual_constant(double value){
+    mot_dual r;
+    r.v = value;
+    for(uint i = 0; i < %(NMR_PARAMS)s; i++){
+        r.d[i] = 0;
+    }
+    return r;
+}
+
+/**
+ * Create a dual number for the model parameter with the given index, i.e. with a unit gradient in that direction.
+ */
+mot_dual dual_variable(double value, uint index){
+    mot_dual r = dual_constant(value);
+    r.d[index] = 1;
+    return r;
+}
+
+/**
+ * Apply the chain rule, with f the value of the function and df the derivative of the function at a.v.
+ */
+mot_dual dual_chain(mot_dual a, double f, double df){
+    mot_dual r;
+    r.v = f;
+    for(uint i = 0; i < %(NMR_PARAMS)s; i++){
+        r.d[i] = df * a.d[i];
+    }
+    return r;
+}
+
+mot_dual dual_add(mot_dual a, mot_dual b){
+    mot_dual r;
+    r.v = a.v + b.v;
+    for(uint i = 0; i < %(NMR_PARAMS)s; i++){
+        r.d[i] = a.d[i] + b.d[i];
+    }
+    return r;
+}
+
+mot_dual dual_sub(mot_dual a, mot_dual b){
+    mot_dual r;
+    r.v = a.v - b.v;
+    for(uint i = 0; i < %(NMR_PARAMS)s; i++){
+        r.d[i] = a.d[i] - b.d[i];
+    }
+    return r;
+}
+
+mot_dual dual_mul(mot_dual a, mot_dual b){
+    mot_dual r;
+    r.v = a.v * b.v;
+    for(uint i = 0; i < %(NMR_PARAMS)s; i++){
+        r.d[i] = a.d[i] * b.v + a.v * b.d[i];
+    }
+    return r;
+}
+
+mot_dual dual_div(mot_dual a, mot_dual b){
+    mot_dual r;
+    r.v = a.v / b.v;
+    for(uint i = 0; i < %(NMR_PARAMS)s; i++){
+        r.d[i] = (a.d[i] * b.v - a.v * b.d[i]) / (b.v * b.v);
+    }
+    return r;
+}
+
+mot_dual dual_add_scalar(mot_dual a, double s){
+    a.v += s;
+    return a;
+}
+
+mot_dual dual_mul_scalar(mot_dual a, double s){
+    return dual_chain(a, a.v * s, s);
+}
+
+mot_dual dual_neg(mot_dual a){
+    return dual_chain(a, -a.v, -1);
+}
+
+mot_dual dual_exp(mot_dual a){
+    double e = exp(a.v);
+    return dual_chain(a, e, e);
+}
+
+mot_dual dual_log(mot_dual a){
+    return dual_chain(a, log(a.v), 1 / a.v);
+}
+
+mot_dual dual_sqrt(mot_dual a){
+    double s = sqrt(a.v);
+    return dual_chain(a, s, 0.5 / s);
+}
+
+mot_dual dual_pow(mot_dual a, double p){
+    return dual_chain(a, pow(a.v, p), p * pow(a.v, p - 1));
+}
+
+mot_dual dual_sin(mot_dual a){
+    return dual_chain(a, sin(a.v), cos(a.v));
+}
+
+mot_dual dual_cos(mot_dual a){
+    return dual_chain(a, cos(a.v), -sin(a.v));
+}
+
+#endif // DUAL_NUMBERS_CL
@@ -0,0 +1,94 @@
+#ifndef EIGEN_SYMMETRIC_%(MEMSPACE)s_%(MEMTYPE)s_CL
+#define EIGEN_SYMMETRIC_%(MEMSPACE)s_%(MEMTYPE)s_CL
+
+/**
+ * Author = Robbert Harms
+ * License = LGPL v3
+ * Maintainer = Robbert Harms
+ * Email = robbert.harms@maastrichtuniversity.nl
+ */
+
+#ifndef EIGEN_SYMMETRIC_MAX_SWEEPS
+#define EIGEN_SYMMETRIC_MAX_SWEEPS 50
+#endif
+
+/**
+ * Compute the eigenvalues and eigenvectors of a small symmetric matrix using the cyclic Jacobi method.
+ *
+ * Every sweep applies a Jacobi rotation to each off-diagonal element, until the off-diagonal elements are
+ * negligible compared to the diagonal. This is accurate for small matrices and needs no additional memory.
+ * This should only be called by one work item.
+ *
+ * Args:
+ *  A: the symmetric (n, n) matrix in row-major order, this is overwritten
+ *  eigenvectors: the (n, n) matrix in which we store the eigenvectors, in the columns
+ *  eigenvalues: the vector of length n in which we store the eigenvalues, in the order of the eigenvectors
+ *  n: the size of the matrix
+ */
+void eigen_symmetric_%(MEMSPACE)s_%(MEMTYPE)s(%(MEMSPACE)s %(MEMTYPE)s* const A,
+                                            %(MEMSPACE)s %(MEMTYPE)s* const eigenvectors,
+                                            %(MEMSPACE)s %(MEMTYPE)s* const eigenvalues,
+                                            const int n){
+    int i, p, q, sweep;
+    %(MEMTYPE)s theta, t, c, s, a_kp, a_kq;
+    double off_diagonal, diagonal;
+
+    for(p = 0; p < n; p++){
+        for(q = 0; q < n; q++){
+            eigenvectors[p * n + q] = (p == q);
+        }
+    }
+
+    for(sweep = 0; sweep < EIGEN_SYMMETRIC_MAX_SWEEPS; sweep++){
+        off_diagonal = 0;
+        diagonal = 0;
+        for(p = 0; p < n; p++){
+            diagonal += A[p * n + p] * A[p * n + p];
+            for(q = p + 1; q < n; q++){
+                off_diagonal += A[p * n + q] * A[p * n + q];
+            }
+        }
+
+        if(off_diagonal <= MOT_EPSILON * MOT_EPSILON * diagonal){
+            break;
+        }
+
+        for(p = 0; p < n - 1; p++){
+            for(q = p + 1; q < n; q++){
+                if(A[p * n + q] == 0){
+                    continue;
+                }
+
+                theta = (A[q * n + q] - A[p * n + p]) / (2 * A[p * n + q]);
+                t = (theta >= 0 ? 1 : -1) / (fabs(theta) + sqrt(theta * theta + 1));
+                c = 1 / sqrt(t * t + 1);
+                s = t * c;
+
+                for(i = 0; i < n; i++){
+                    a_kp = A[i * n + p];
+                    a_kq = A[i * n + q];
+                    A[i * n + p] = c * a_kp - s * a_kq;
+                    A[i * n + q] = s * a_kp + c * a_kq;
+                }
+                for(i = 0; i < n; i++){
+                    a_kp = A[p * n + i];
+                    a_kq = A[q * n + i];
+                    A[p * n + i] = c * a_kp - s * a_kq;
+                    A[q * n + i] = s * a_kp + c * a_kq;
+                }
+                for(i = 0; i < n; i++){
+                    a_kp = eigenvectors[i * n + p];
+                    a_kq = eigenvectors[i * n + q];
+                    eigenvectors[i * n + p] = c * a_kp - s * a_kq;
+                    eigenvectors[i * n + q] = s * a_kp + c * a_kq;
+                }
+            }
+        }
+    }
+
+    for(p = 0; p < n; p++){
+        eigenvalues[p] = A[p * n + p];
+    }
+}
+
+#endif // EIGEN_SYMMETRIC_%(MEMSPACE)s_%(MEMTYPE)s_CL
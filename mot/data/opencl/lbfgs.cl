@@ -0,0 +1,429 @@
+#ifndef LBFGS_CL
+#define LBFGS_CL
+
+/**
+ * Creator = Robbert Harms
+ * License = LGPL v3
+ * Maintainer = Robbert Harms
+ * Email = robbert.harms@maastrichtuniversity.nl
+ */
+
+/**
+   Limited-memory BFGS minimization of an objective function in a multidimensional space.
+
+   This approximates the inverse Hessian of the objective function using the last few parameter and gradient
+   differences, which are kept in local memory. The search direction is computed using the two-loop recursion [1],
+   after which a backtracking line search finds a step satisfying the Armijo condition.
+
+   By default the gradient is approximated using central differences. Every objective function evaluation runs on all
+   the work items of the work group, such that the model evaluations within each gradient are spread over the
+   work items. Alternatively, a gradient function can be provided.
+
+   References:
+
+   [1] Nocedal, J. (1980). "Updating Quasi-Newton Matrices with Limited Storage".
+        Mathematics of Computation. 35 (151): 773-782. doi:10.1090/S0025-5718-1980-0572855-7.
+   [2] Nocedal, J. and Wright, S. J. (2006). "Numerical Optimization", 2nd edition, chapter 7. Springer.
+*/
+
+/* Used to set the maximum number of iterations to patience*(number_of_parameters+1). */
+#define LBFGS_MAX_ITERATIONS (%(PATIENCE)r * (%(NMR_PARAMS)r+1))
+#define LBFGS_MAX_LINE_SEARCH_ITERATIONS %(PATIENCE_LINE_SEARCH)r
+#define LBFGS_HISTORY_LENGTH %(HISTORY_LENGTH)r
+#define LBFGS_GRADIENT_TOLERANCE %(GRADIENT_TOLERANCE)r
+#define LBFGS_FUNCTION_TOLERANCE 30*MOT_EPSILON
+#define LBFGS_EPSILON 30*MOT_EPSILON
+#define LBFGS_ARMIJO_C1 1e-4
+#define LBFGS_USE_GRADIENT_FUNCTION %(USE_GRADIENT_FUNCTION)r
+
+/**
+ * If set, we load and store the history in the optimizer state such that the optimization can be resumed.
+ * The state is laid out as [is_initialized, nmr_pairs, newest, s[history_length][nmr_params],
+ * y[history_length][nmr_params]].
+ */
+#define LBFGS_USE_STATE %(USE_STATE)r
+
+/**
+ * If set, we write the number of iterations to ``nmr_iterations`` on return.
+ */
+#define LBFGS_USE_STATISTICS %(USE_STATISTICS)r
+
+/**
+ * If set, we record the function value at the start of every iteration and on return, see ``optimizer_trace``.
+ */
+#define LBFGS_USE_TRACE %(USE_TRACE)r
+
+#if LBFGS_USE_STATE
+    #define LBFGS_SAVE_STATE() lbfgs_save_state(s, y, nmr_pairs, newest, optimizer_state);
+#else
+    #define LBFGS_SAVE_STATE()
+#endif
+
+#if LBFGS_USE_STATISTICS
+    #define LBFGS_SAVE_STATISTICS() *nmr_iterations = iteration;
+#else
+    #define LBFGS_SAVE_STATISTICS()
+#endif
+
+#if LBFGS_USE_TRACE
+    #define LBFGS_SAVE_TRACE() optimizer_trace(fval, model_parameters%(TRACE_ARGUMENT)s);
+#else
+    #define LBFGS_SAVE_TRACE()
+#endif
+
+#if LBFGS_USE_STATE || LBFGS_USE_STATISTICS || LBFGS_USE_TRACE
+    #define LBFGS_RETURN(return_code) { \
+        if(get_local_id(0) == 0){ \
+            LBFGS_SAVE_STATE() \
+            LBFGS_SAVE_STATISTICS() \
+            LBFGS_SAVE_TRACE() \
+        } \
+        return return_code; \
+    }
+#else
+    #define LBFGS_RETURN(return_code) return return_code;
+#endif
+
+
+/** The evaluation function we are expecting. */
+double %(FUNCTION_NAME)s(local mot_float_type* x, void* data_void);
+
+#if LBFGS_USE_GRADIENT_FUNCTION
+    /** The gradient function we are expecting. */
+    void %(GRADIENT_FUNCTION_NAME)s(local mot_float_type* x, void* data_void, local mot_float_type* gradient);
+#endif
+
+
+/**
+ * Compute the dot product of two vectors in local memory.
+ */
+mot_float_type lbfgs_dot(local const mot_float_type* const a, local const mot_float_type* const b){
+    mot_float_type sum = 0;
+    for(int i = 0; i < %(NMR_PARAMS)r; i++){
+        sum += a[i] * b[i];
+    }
+    return sum;
+}
+
+/**
+ * Load the history from the optimizer state, or initialize an empty history if the state is not yet initialized.
+ */
+void lbfgs_load_state(local mot_float_type s[LBFGS_HISTORY_LENGTH][%(NMR_PARAMS)r],
+                      local mot_float_type y[LBFGS_HISTORY_LENGTH][%(NMR_PARAMS)r],
+                      local mot_float_type* const rho,
+                      local int* const nmr_pairs,
+                      local int* const newest,
+                      global const mot_float_type* const optimizer_state){
+    int i, j;
+    if(optimizer_state[0] == 0){
+        *nmr_pairs = 0;
+        *newest = LBFGS_HISTORY_LENGTH - 1;
+        return;
+    }
+
+    *nmr_pairs = (int)optimizer_state[1];
+    *newest = (int)optimizer_state[2];
+
+    for(i = 0; i < LBFGS_HISTORY_LENGTH; i++){
+        for(j = 0; j < %(NMR_PARAMS)r; j++){
+            s[i][j] = optimizer_state[3 + i * %(NMR_PARAMS)r + j];
+            y[i][j] = optimizer_state[3 + (LBFGS_HISTORY_LENGTH + i) * %(NMR_PARAMS)r + j];
+        }
+        rho[i] = 1 / lbfgs_dot(s[i], y[i]);
+    }
+}
+
+/**
+ * Store the history in the optimizer state.
+ */
+void lbfgs_save_state(local mot_float_type s[LBFGS_HISTORY_LENGTH][%(NMR_PARAMS)r],
+                      local mot_float_type y[LBFGS_HISTORY_LENGTH][%(NMR_PARAMS)r],
+                      int nmr_pairs, int newest,
+                      global mot_float_type* const optimizer_state){
+    int i, j;
+    optimizer_state[0] = 1;
+    optimizer_state[1] = nmr_pairs;
+    optimizer_state[2] = newest;
+
+    for(i = 0; i < LBFGS_HISTORY_LENGTH; i++){
+        for(j = 0; j < %(NMR_PARAMS)r; j++){
+            optimizer_state[3 + i * %(NMR_PARAMS)r + j] = s[i][j];
+            optimizer_state[3 + (LBFGS_HISTORY_LENGTH + i) * %(NMR_PARAMS)r + j] = y[i][j];
+        }
+    }
+}
+
+/**
+ * Compute the gradient of the objective function at the given position.
+ *
+ * Without a gradient function, this uses central differences with a step size relative to the magnitude of each
+ * parameter. This should be called by all work items, the position is restored before returning.
+ *
+ * Args:
+ *  x: the position at which to compute the gradient
+ *  data: the data pointer for the objective function
+ *
+ * Modifies:
+ *  gradient: set to the gradient at ``x``
+ */
+void lbfgs_gradient(local mot_float_type* const x, void* data, local mot_float_type* const gradient){
+    #if LBFGS_USE_GRADIENT_FUNCTION
+        %(GRADIENT_FUNCTION_NAME)s(x, data, gradient);
+        barrier(CLK_LOCAL_MEM_FENCE);
+    #else
+        mot_float_type original, step;
+        double fval_forward, fval_backward;
+
+        // wait for all work items to be done with the position before changing it
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        for(int i = 0; i < %(NMR_PARAMS)r; i++){
+            if(get_local_id(0) == 0){
+                original = x[i];
+                step = cbrt((mot_float_type)MOT_EPSILON) * fmax(fabs(original), (mot_float_type)1.0);
+                x[i] = original + step;
+            }
+            barrier(CLK_LOCAL_MEM_FENCE);
+
+            fval_forward = %(FUNCTION_NAME)s(x, data);
+            barrier(CLK_LOCAL_MEM_FENCE);
+
+            if(get_local_id(0) == 0){
+                // use the representable step to reduce the rounding error
+                step = x[i] - original;
+                x[i] = original - step;
+            }
+            barrier(CLK_LOCAL_MEM_FENCE);
+
+            fval_backward = %(FUNCTION_NAME)s(x, data);
+            barrier(CLK_LOCAL_MEM_FENCE);
+
+            if(get_local_id(0) == 0){
+                x[i] = original;
+                gradient[i] = (fval_forward - fval_backward) / (2 * step);
+            }
+            barrier(CLK_LOCAL_MEM_FENCE);
+        }
+    #endif
+}
+
+/**
+ * Compute the search direction using the L-BFGS two-loop recursion.
+ *
+ * Without history, this returns the steepest descent direction scaled to a length of at most one.
+ * This should only be called by one work item.
+ *
+ * Modifies:
+ *  direction: set to the approximation of ``-H * gradient``
+ */
+void lbfgs_direction(local const mot_float_type* const gradient,
+                     local mot_float_type* const direction,
+                     local mot_float_type s[LBFGS_HISTORY_LENGTH][%(NMR_PARAMS)r],
+                     local mot_float_type y[LBFGS_HISTORY_LENGTH][%(NMR_PARAMS)r],
+                     local const mot_float_type* const rho,
+                     int nmr_pairs, int newest){
+    int i, k, ind;
+    mot_float_type alpha[LBFGS_HISTORY_LENGTH];
+    mot_float_type beta;
+    mot_float_type gamma;
+
+    for(i = 0; i < %(NMR_PARAMS)r; i++){
+        direction[i] = -gradient[i];
+    }
+
+    if(nmr_pairs == 0){
+        gamma = fmin((mot_float_type)1.0, 1 / sqrt(lbfgs_dot(gradient, gradient)));
+        for(i = 0; i < %(NMR_PARAMS)r; i++){
+            direction[i] *= gamma;
+        }
+        return;
+    }
+
+    for(k = 0; k < nmr_pairs; k++){
+        ind = (newest - k + LBFGS_HISTORY_LENGTH) %% LBFGS_HISTORY_LENGTH;
+        alpha[ind] = rho[ind] * lbfgs_dot(s[ind], direction);
+        for(i = 0; i < %(NMR_PARAMS)r; i++){
+            direction[i] -= alpha[ind] * y[ind][i];
+        }
+    }
+
+    gamma = lbfgs_dot(s[newest], y[newest]) / lbfgs_dot(y[newest], y[newest]);
+    for(i = 0; i < %(NMR_PARAMS)r; i++){
+        direction[i] *= gamma;
+    }
+
+    for(k = nmr_pairs - 1; k >= 0; k--){
+        ind = (newest - k + LBFGS_HISTORY_LENGTH) %% LBFGS_HISTORY_LENGTH;
+        beta = rho[ind] * lbfgs_dot(y[ind], direction);
+        for(i = 0; i < %(NMR_PARAMS)r; i++){
+            direction[i] += s[ind][i] * (alpha[ind] - beta);
+        }
+    }
+}
+
+/**
+ * Check if the largest gradient element is small enough to stop.
+ */
+bool lbfgs_gradient_within_threshold(local const mot_float_type* const gradient, double fval){
+    mot_float_type max_gradient = 0;
+    for(int i = 0; i < %(NMR_PARAMS)r; i++){
+        max_gradient = fmax(max_gradient, fabs(gradient[i]));
+    }
+    return max_gradient <= LBFGS_GRADIENT_TOLERANCE * fmax(fabs(fval), (double)1);
+}
+
+/**
+ * Check if the difference between the old function value and the new function value is small enough to stop.
+ */
+bool lbfgs_fval_diff_within_threshold(double previous_fval, double new_fval){
+    return 2.0 * (previous_fval - new_fval) <= LBFGS_FUNCTION_TOLERANCE * (fabs(previous_fval) + fabs(new_fval))
+                                                + LBFGS_EPSILON;
+}
+
+
+int lbfgs(local mot_float_type* model_parameters, void* data%(STATE_PARAMETER)s%(STATISTICS_PARAMETER)s
+          %(TRACE_PARAMETER)s){
+    int i, line_search_iteration, next;
+    double fval, fval_new;
+    mot_float_type step, curvature;
+
+    local int iteration;
+    local int nmr_pairs, newest;
+    local mot_float_type directional_derivative;
+
+    local mot_float_type s[LBFGS_HISTORY_LENGTH][%(NMR_PARAMS)r];
+    local mot_float_type y[LBFGS_HISTORY_LENGTH][%(NMR_PARAMS)r];
+    local mot_float_type rho[LBFGS_HISTORY_LENGTH];
+
+    local mot_float_type gradient[%(NMR_PARAMS)r];
+    local mot_float_type direction[%(NMR_PARAMS)r];
+    local mot_float_type parameters_at_start_of_iteration[%(NMR_PARAMS)r];
+
+    if(get_local_id(0) == 0){
+        iteration = 0;
+        #if LBFGS_USE_STATE
+            lbfgs_load_state(s, y, rho, &nmr_pairs, &newest, optimizer_state);
+        #else
+            nmr_pairs = 0;
+            newest = LBFGS_HISTORY_LENGTH - 1;
+        #endif
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    fval = %(FUNCTION_NAME)s(model_parameters, data);
+    if(!isfinite(fval)){
+        LBFGS_RETURN(10);
+    }
+
+    lbfgs_gradient(model_parameters, data, gradient);
+
+    while(iteration < LBFGS_MAX_ITERATIONS){
+        if(lbfgs_gradient_within_threshold(gradient, fval)){
+            LBFGS_RETURN(12);
+        }
+
+        if(get_local_id(0) == 0){
+            LBFGS_SAVE_TRACE()
+            lbfgs_direction(gradient, direction, s, y, rho, nmr_pairs, newest);
+            directional_derivative = lbfgs_dot(gradient, direction);
+
+            // restart from the steepest descent direction if the approximation is not a descent direction
+            if(!(directional_derivative < 0)){
+                nmr_pairs = 0;
+                lbfgs_direction(gradient, direction, s, y, rho, nmr_pairs, newest);
+                directional_derivative = lbfgs_dot(gradient, direction);
+            }
+
+            for(i = 0; i < %(NMR_PARAMS)r; i++){
+                parameters_at_start_of_iteration[i] = model_parameters[i];
+            }
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        step = 1;
+
+        for(line_search_iteration = 0; ; line_search_iteration++){
+            if(get_local_id(0) == 0){
+                for(i = 0; i < %(NMR_PARAMS)r; i++){
+                    model_parameters[i] = parameters_at_start_of_iteration[i] + step * direction[i];
+                }
+            }
+            barrier(CLK_LOCAL_MEM_FENCE);
+
+            fval_new = %(FUNCTION_NAME)s(model_parameters, data);
+            barrier(CLK_LOCAL_MEM_FENCE);
+
+            if(isfinite(fval_new) && fval_new <= fval + LBFGS_ARMIJO_C1 * step * directional_derivative){
+                break;
+            }
+
+            if(line_search_iteration + 1 >= LBFGS_MAX_LINE_SEARCH_ITERATIONS){
+                if(get_local_id(0) == 0){
+                    for(i = 0; i < %(NMR_PARAMS)r; i++){
+                        model_parameters[i] = parameters_at_start_of_iteration[i];
+                    }
+                }
+                barrier(CLK_LOCAL_MEM_FENCE);
+                LBFGS_RETURN(7);
+            }
+
+            step *= 0.5;
+        }
+
+        // store the parameter difference and the old gradient in the next history slot
+        if(get_local_id(0) == 0){
+            next = (newest + 1) %% LBFGS_HISTORY_LENGTH;
+            for(i = 0; i < %(NMR_PARAMS)r; i++){
+                s[next][i] = model_parameters[i] - parameters_at_start_of_iteration[i];
+                y[next][i] = gradient[i];
+            }
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        lbfgs_gradient(model_parameters, data, gradient);
+
+        if(get_local_id(0) == 0){
+            for(i = 0; i < %(NMR_PARAMS)r; i++){
+                y[next][i] = gradient[i] - y[next][i];
+            }
+
+            // only accept the pair if the curvature condition holds, else the oldest pair is overwritten and lost
+            curvature = lbfgs_dot(s[next], y[next]);
+            if(curvature > LBFGS_EPSILON * lbfgs_dot(y[next], y[next])){
+                rho[next] = 1 / curvature;
+                newest = next;
+                nmr_pairs = min(nmr_pairs + 1, LBFGS_HISTORY_LENGTH);
+            }
+            else if(nmr_pairs == LBFGS_HISTORY_LENGTH){
+                nmr_pairs--;
+            }
+            ++iteration;
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+
+        if(lbfgs_fval_diff_within_threshold(fval, fval_new)){
+            fval = fval_new;
+            LBFGS_RETURN(2);
+        }
+        fval = fval_new;
+    }
+    LBFGS_RETURN(6);
+}
+
+#undef LBFGS_MAX_ITERATIONS
+#undef LBFGS_MAX_LINE_SEARCH_ITERATIONS
+#undef LBFGS_HISTORY_LENGTH
+#undef LBFGS_GRADIENT_TOLERANCE
+#undef LBFGS_FUNCTION_TOLERANCE
+#undef LBFGS_EPSILON
+#undef LBFGS_ARMIJO_C1
+#undef LBFGS_USE_GRADIENT_FUNCTION
+#undef LBFGS_USE_STATE
+#undef LBFGS_USE_STATISTICS
+#undef LBFGS_USE_TRACE
+#undef LBFGS_SAVE_STATE
+#undef LBFGS_SAVE_STATISTICS
+#undef LBFGS_SAVE_TRACE
+#undef LBFGS_RETURN
+
+#endif // LBFGS_CL
@@ -56,6 +56,11 @@
  */
 #define USER_TOL_X  30*MOT_EPSILON              /** the precision we break at*/
 
+/**
+ * If set, we record the best function value at the start of every iteration and on return, see ``optimizer_trace``.
+ */
+#define LIBNMS_USE_TRACE %(USE_TRACE)r
+
 /** The evaluation function we are expecting. */
 double %(FUNCTION_NAME)s(local mot_float_type* x, void* data_void);
 
@@ -374,7 +379,10 @@ bool _libnms_simplex_contract(
  * - nmr_parameters: the number of parameters in the problem
  * - model_parameters: IN: the initial set of parameters, OUT: the optimal set of parameters
  * - data: the function evaluation data
- * - initial_simplex_scale: the step sizes for creating the initial simplex, of size [nmr_parameters]
+ * - initial_simplex_scale: the step sizes for creating the initial simplex, of size [nmr_parameters]. If this is
+ *                          a null pointer, the initial simplex is not created but is expected to be already present
+ *                          in the scratch memory (after the centroid, reflection and function values memory).
+ *                          This allows resuming the optimization from a previous simplex.
  * - fdiff: this is set, on output, to contain the difference between the high and low function values of the last simplex.
  * - psi: alternative stopping criteria used in the Sbplex method. if psi > 0, then it *replaces* the xtol and ftol
  *        stopping criteria with that the simplex diameter |xl - xh| must be reduced by a factor of psi
@@ -383,6 +391,8 @@ bool _libnms_simplex_contract(
  * - max_iterations: the maximum number of iterations the simplex can run
  * - alpha, beta, gamma, delta: simplex strategy.
  * - scratch: the scratch array containing the memory we can use for the operations, of size [nmr_parameters * 3 + (nmr_parameters + 1)^2]
+ * - nmr_iterations: if not a null pointer, this is set, on output, to the number of iterations
+ * - trace_*: only if the trace is enabled, the trace arguments of ``optimizer_trace``
  */
 int lib_nmsimplex(
         int nmr_parameters,
@@ -396,7 +406,8 @@ int lib_nmsimplex(
         mot_float_type beta,
         mot_float_type gamma,
         mot_float_type delta,
-        local mot_float_type* scratch // size: nmr_parameters * 3 + (nmr_parameters + 1)^2
+        local mot_float_type* scratch, // size: nmr_parameters * 3 + (nmr_parameters + 1)^2
+        int* nmr_iterations%(TRACE_PARAMETER)s
         ){
 
     int return_code = 6;         /** the default return code is that we exhausted our patience */
@@ -417,7 +428,7 @@ int lib_nmsimplex(
 
     *fdiff = HUGE_VAL;
 
-    if(get_local_id(0) == 0){
+    if(get_local_id(0) == 0 && initial_simplex_scale != 0){
 	    _libnms_initialize_simplex(nmr_parameters, vertices, model_parameters, initial_simplex_scale);
 	}
 	barrier(CLK_LOCAL_MEM_FENCE);
@@ -443,6 +454,13 @@ int lib_nmsimplex(
 	/* begin the main loop of the minimization */
 	for (itr=0; itr <= max_iterations; itr++) {
 		_libnms_find_ordering_indices(nmr_parameters, func_vals, &ind_worst, &ind_best, &ind_second_worst);
+
+        #if LIBNMS_USE_TRACE
+            if(get_local_id(0) == 0){
+                optimizer_trace(func_vals[ind_best], vertices + ind_best * nmr_parameters%(TRACE_ARGUMENT)s);
+            }
+        #endif
+
         _libnms_calculate_centroid(nmr_parameters, vertices, centroid, ind_worst);
 
         /* use the default NMSimplex convergence criteria */
@@ -522,9 +540,21 @@ int lib_nmsimplex(
     /* set fdiff to the difference between the largest and smallest vertex */
     *fdiff = func_vals[ind_worst] - func_vals[ind_best];
 
+    if(nmr_iterations){
+        *nmr_iterations = min(itr, max_iterations);
+    }
+
+    #if LIBNMS_USE_TRACE
+        /* on convergence the last entry already holds the final simplex */
+        if(get_local_id(0) == 0 && return_code == 6){
+            optimizer_trace(func_vals[ind_best], model_parameters%(TRACE_ARGUMENT)s);
+        }
+    #endif
+
 	return return_code;
 }
 
 #undef USER_TOL_X
+#undef LIBNMS_USE_TRACE
 
 #endif // LIB_NMSIMPLEX_CL
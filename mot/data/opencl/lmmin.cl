@@ -108,6 +108,63 @@ double lm_euclidian_norm_global(global const mot_float_type* const x, const int
 #define LM_ENORM_SQRT_GIANT LM_SQRT_GIANT /* square should not overflow */
 #define LM_ENORM_SQRT_DWARF LM_SQRT_DWARF /* square should not underflow */
 
+/**
+ * If set, we load and store the variable scalings (diag), the step bound (delta) and the Levenberg-Marquardt parameter
+ * in the optimizer state, such that the optimization can be resumed.
+ * The state is laid out as [is_initialized, diag[nmr_params], delta, lmpar]. The state is only stored once the
+ * scalings and the step bound are initialized, that is, once delta is positive.
+ */
+#define LMMIN_USE_STATE %(USE_STATE)r
+
+/**
+ * If set, we write the number of iterations, i.e. the number of Jacobian evaluations, to ``nmr_iterations`` on return.
+ */
+#define LMMIN_USE_STATISTICS %(USE_STATISTICS)r
+
+/**
+ * If set, we record the sum of squares at the start of every iteration and on return, see ``optimizer_trace``.
+ */
+#define LMMIN_USE_TRACE %(USE_TRACE)r
+
+#if LMMIN_USE_STATE
+    #define LMMIN_SAVE_STATE() \
+        if(delta > 0){ \
+            optimizer_state[0] = 1; \
+            for(j = 0; j < %(NMR_PARAMS)s; j++){ \
+                optimizer_state[1 + j] = diag[j]; \
+            } \
+            optimizer_state[1 + %(NMR_PARAMS)s] = delta; \
+            optimizer_state[2 + %(NMR_PARAMS)s] = lmpar; \
+        }
+#else
+    #define LMMIN_SAVE_STATE()
+#endif
+
+#if LMMIN_USE_STATISTICS
+    #define LMMIN_SAVE_STATISTICS() *nmr_iterations = outer_iterations;
+#else
+    #define LMMIN_SAVE_STATISTICS()
+#endif
+
+#if LMMIN_USE_TRACE
+    #define LMMIN_SAVE_TRACE() optimizer_trace(fnorm * fnorm, model_parameters%(TRACE_ARGUMENT)s);
+#else
+    #define LMMIN_SAVE_TRACE()
+#endif
+
+#if LMMIN_USE_STATE || LMMIN_USE_STATISTICS || LMMIN_USE_TRACE
+    #define LMMIN_RETURN(return_code) { \
+        if(get_local_id(0) == 0){ \
+            LMMIN_SAVE_STATE() \
+            LMMIN_SAVE_STATISTICS() \
+            LMMIN_SAVE_TRACE() \
+        } \
+        return return_code; \
+    }
+#else
+    #define LMMIN_RETURN(return_code) return return_code;
+#endif
+
 /**
  * Make sure that the following holds:
  * %(NMR_PARAMS)s > 0
@@ -122,10 +179,15 @@ double lm_euclidian_norm_global(global const mot_float_type* const x, const int
 /******************************************************************************/
 /*  lmmin (main minimization routine)                                         */
 /******************************************************************************/
-int lmmin(local mot_float_type * const model_parameters, void* data, global mot_float_type* const fjac){
+int lmmin(local mot_float_type * const model_parameters, void* data, global mot_float_type* const fjac%(STATE_PARAMETER)s
+          %(STATISTICS_PARAMETER)s%(TRACE_PARAMETER)s){
 
     int j, i;
 
+    #if LMMIN_USE_STATISTICS
+        int outer_iterations = 0;
+    #endif
+
     local mot_float_type actred, dirder, prered, ratio, temp, temp1, temp2, temp3;
     local mot_float_type xnorm, pnorm, fnorm, fnorm1, gnorm;
     local double sum;
@@ -165,6 +227,23 @@ int lmmin(local mot_float_type * const model_parameters, void* data, global mot_
         barrier(CLK_LOCAL_MEM_FENCE);
     }
 
+    #if LMMIN_USE_STATE
+        /* Resume with the scalings, step bound and Levenberg-Marquardt parameter of the previous run. */
+        if(optimizer_state[0] != 0){
+            if(get_local_id(0) == 0){
+                for (j = 0; j < %(NMR_PARAMS)s; j++){
+                    diag[j] = optimizer_state[1 + j];
+                    wa3[j] = diag[j] * model_parameters[j];
+                }
+                delta = optimizer_state[1 + %(NMR_PARAMS)s];
+                lmpar = optimizer_state[2 + %(NMR_PARAMS)s];
+                xnorm = lm_euclidian_norm(wa3, %(NMR_PARAMS)s);
+                outer_done_first = true;
+            }
+            barrier(CLK_LOCAL_MEM_FENCE);
+        }
+    #endif
+
     /***  Evaluate function at starting point and calculate norm.  ***/
 
     %(FUNCTION_NAME)s(model_parameters, data, fvec);
@@ -176,14 +255,24 @@ int lmmin(local mot_float_type * const model_parameters, void* data, global mot_
     barrier(CLK_LOCAL_MEM_FENCE);
 
     if (!isfinite(fnorm)) {
-	    return 10; /* nan */
+	    LMMIN_RETURN(10); /* nan */
     } else if (fnorm <= LM_DWARF) {
-        return 1;
+        LMMIN_RETURN(1);
     }
 
     /***  The outer loop: compute gradient, then descend.  ***/
 
     while(true){
+        #if LMMIN_USE_STATISTICS
+            outer_iterations++;
+        #endif
+
+        #if LMMIN_USE_TRACE
+            if(get_local_id(0) == 0){
+                LMMIN_SAVE_TRACE()
+            }
+        #endif
+
         /** Calculate the Jacobian. **/
         %(JACOBIAN_FUNCTION_NAME)s(model_parameters, data, fvec, fjac, wf);
 
@@ -250,7 +339,7 @@ int lmmin(local mot_float_type * const model_parameters, void* data, global mot_
         barrier(CLK_LOCAL_MEM_FENCE);
 
         if (gnorm <= GTOL) {
-            return 5;
+            LMMIN_RETURN(5);
         }
 
         /** Initialize or update diag and delta. **/
@@ -276,7 +365,7 @@ int lmmin(local mot_float_type * const model_parameters, void* data, global mot_
             barrier(CLK_LOCAL_MEM_FENCE);
 
             if(!isfinite(xnorm)){
-                return 10;
+                LMMIN_RETURN(10);
             }
 
             /* initialize the step bound delta. */
@@ -317,7 +406,7 @@ int lmmin(local mot_float_type * const model_parameters, void* data, global mot_
             barrier(CLK_LOCAL_MEM_FENCE);
 
 			if(!isfinite(pnorm)) {
-				return 10;
+				LMMIN_RETURN(10);
 			}
 
 			if(get_local_id(0) == 0){
@@ -334,7 +423,7 @@ int lmmin(local mot_float_type * const model_parameters, void* data, global mot_
             barrier(CLK_LOCAL_MEM_FENCE);
 
             if (!isfinite(temp1)){
-                return 10;
+                LMMIN_RETURN(10);
             }
 
             if(get_local_id(0) == 0){
@@ -420,7 +509,7 @@ int lmmin(local mot_float_type * const model_parameters, void* data, global mot_
                 barrier(CLK_LOCAL_MEM_FENCE);
 
                 if (!isfinite(xnorm)){
-                    return 10; /* nan */
+                    LMMIN_RETURN(10); /* nan */
                 }
 
                 if(get_local_id(0) == 0){
@@ -431,28 +520,28 @@ int lmmin(local mot_float_type * const model_parameters, void* data, global mot_
 
             /* convergence tests */
             if (fnorm <= LM_DWARF){
-                return 1; /* success: sum of squares almost zero */
+                LMMIN_RETURN(1); /* success: sum of squares almost zero */
             }
             /* test two criteria (both may be fulfilled) */
             if (fabs(actred) <= FTOL && prered <= FTOL && ratio <= 2){
 				if (delta <= XTOL * xnorm){
-				    return 4; /* success: sum of squares almost stable */
+				    LMMIN_RETURN(4); /* success: sum of squares almost stable */
 				}
-				return 2; /* success: x almost stable */
+				LMMIN_RETURN(2); /* success: x almost stable */
 			}
 
 			/** Tests for termination and stringent tolerances. **/
 			if ( nfev >= MAXFEV ){
-                return 6;
+                LMMIN_RETURN(6);
             }
             if ( fabs(actred) <= LM_MACHEP && prered <= LM_MACHEP && ratio <= 2 ){
-                return 7;
+                LMMIN_RETURN(7);
             }
             if ( delta <= LM_MACHEP * xnorm ){
-                return 8;
+                LMMIN_RETURN(8);
             }
             if ( gnorm <= LM_MACHEP){
-                return 9;
+                LMMIN_RETURN(9);
             }
 
 			/** End of the inner loop. Repeat if iteration unsuccessful. **/
@@ -0,0 +1,42 @@
+#ifndef OPTIMIZER_TRACE_CL
+#define OPTIMIZER_TRACE_CL
+
+/**
+ * Author = Robbert Harms
+ * License = LGPL v3
+ * Maintainer = Robbert Harms
+ * Email = robbert.harms@maastrichtuniversity.nl
+ */
+
+/**
+ * Record the objective function value, and optionally the parameters, of one iteration of an optimization routine.
+ *
+ * The values are written to a ring buffer of %(TRACE_LENGTH)r entries per problem, such that only the last
+ * entries are kept if the routine runs for more iterations. The trace position counts the total number of
+ * entries written, the next entry is written at index ``trace_position %% %(TRACE_LENGTH)r``.
+ *
+ * This should only be called by one work item.
+ *
+ * Args:
+ *  f: the objective function value to record
+ *  x: the parameters at which the objective function was evaluated
+ *  trace_position: the number of entries written
+ *  trace_objective: the ring buffer for the objective function values, of size [%(TRACE_LENGTH)r]
+ *  trace_x: the ring buffer for the parameters, of size [%(TRACE_LENGTH)r][%(NMR_PARAMS)r], only if enabled
+ */
+void optimizer_trace(double f, local const mot_float_type* const x,
+                     global uint* trace_position, global double* trace_objective%(TRACE_X_PARAMETER)s){
+    uint index = *trace_position %% %(TRACE_LENGTH)r;
+
+    trace_objective[index] = f;
+
+    #if %(TRACE_X)r
+        for(uint i = 0; i < %(NMR_PARAMS)r; i++){
+            trace_x[index * %(NMR_PARAMS)r + i] = x[i];
+        }
+    #endif
+
+    *trace_position += 1;
+}
+
+#endif // OPTIMIZER_TRACE_CL
@@ -49,6 +49,54 @@
 #define POWELL_RESET_METHOD_EXTRAPOLATED_POINT 1 /* see Numerical Recipes */
 #define POWELL_RESET_METHOD POWELL_RESET_METHOD_%(RESET_METHOD)s
 
+/**
+ * If set, we load and store the search directions in the optimizer state such that the optimization can be resumed.
+ * The state is laid out as [is_initialized, search_directions[nmr_params][nmr_params]].
+ */
+#define POWELL_USE_STATE %(USE_STATE)r
+
+/**
+ * If set, we write the number of iterations to ``nmr_iterations`` on return.
+ */
+#define POWELL_USE_STATISTICS %(USE_STATISTICS)r
+
+/**
+ * If set, we record the function value at the start of every iteration and on return, see ``optimizer_trace``.
+ */
+#define POWELL_USE_TRACE %(USE_TRACE)r
+
+#if POWELL_USE_STATE
+    #define POWELL_SAVE_STATE() powell_save_state(search_directions, optimizer_state);
+#else
+    #define POWELL_SAVE_STATE()
+#endif
+
+#if POWELL_USE_STATISTICS
+    /* the iteration counter is only incremented at the end of an iteration */
+    #define POWELL_SAVE_STATISTICS() *nmr_iterations = min(iteration + 1, POWELL_MAX_ITERATIONS);
+#else
+    #define POWELL_SAVE_STATISTICS()
+#endif
+
+#if POWELL_USE_TRACE
+    #define POWELL_SAVE_TRACE() optimizer_trace(fval, model_parameters%(TRACE_ARGUMENT)s);
+#else
+    #define POWELL_SAVE_TRACE()
+#endif
+
+#if POWELL_USE_STATE || POWELL_USE_STATISTICS || POWELL_USE_TRACE
+    #define POWELL_RETURN(return_code) { \
+        if(get_local_id(0) == 0){ \
+            POWELL_SAVE_STATE() \
+            POWELL_SAVE_STATISTICS() \
+            POWELL_SAVE_TRACE() \
+        } \
+        return return_code; \
+    }
+#else
+    #define POWELL_RETURN(return_code) return return_code;
+#endif
+
 
 /**
  * A structure used to hold the data we are passing to the linear optimizer.
@@ -90,6 +138,37 @@ void powell_init_search_directions(local mot_float_type search_directions[%(NMR_
     }
 }
 
+/**
+ * Load the search directions from the optimizer state, or initialize them if the state is not yet initialized.
+ */
+void powell_load_state(local mot_float_type search_directions[%(NMR_PARAMS)r][%(NMR_PARAMS)r],
+                       global const mot_float_type* const optimizer_state){
+    int i, j;
+    if(optimizer_state[0] == 0){
+        powell_init_search_directions(search_directions);
+        return;
+    }
+    for(i=0; i < %(NMR_PARAMS)r; i++){
+        for(j=0; j < %(NMR_PARAMS)r; j++){
+            search_directions[i][j] = optimizer_state[1 + i * %(NMR_PARAMS)r + j];
+        }
+    }
+}
+
+/**
+ * Store the search directions in the optimizer state.
+ */
+void powell_save_state(local mot_float_type search_directions[%(NMR_PARAMS)r][%(NMR_PARAMS)r],
+                       global mot_float_type* const optimizer_state){
+    int i, j;
+    optimizer_state[0] = 1;
+    for(i=0; i < %(NMR_PARAMS)r; i++){
+        for(j=0; j < %(NMR_PARAMS)r; j++){
+            optimizer_state[1 + i * %(NMR_PARAMS)r + j] = search_directions[i][j];
+        }
+    }
+}
+
 /**
  * Checks if Powell should terminate
  *
@@ -313,7 +392,8 @@ bool powell_should_exchange_search_directions(
 #define SHOULD_EXCHANGE_SEARCH_DIRECTION true
 #endif
 
-int powell(local mot_float_type* model_parameters, void* data){
+int powell(local mot_float_type* model_parameters, void* data%(STATE_PARAMETER)s%(STATISTICS_PARAMETER)s
+           %(TRACE_PARAMETER)s){
     int i, j;
     mot_float_type fval, fval_extrapolated;
 
@@ -326,7 +406,11 @@ int powell(local mot_float_type* model_parameters, void* data){
 
     if(get_local_id(0) == 0){
         iteration = 0;
-        powell_init_search_directions(search_directions);
+        #if POWELL_USE_STATE
+            powell_load_state(search_directions, optimizer_state);
+        #else
+            powell_init_search_directions(search_directions);
+        #endif
     }
     barrier(CLK_LOCAL_MEM_FENCE);
 
@@ -334,6 +418,7 @@ int powell(local mot_float_type* model_parameters, void* data){
 
     while(iteration < POWELL_MAX_ITERATIONS){
         if(get_local_id(0) == 0){
+            POWELL_SAVE_TRACE()
             fval_at_start_of_iteration = fval;
 
             for(i=0; i < %(NMR_PARAMS)r; i++){
@@ -346,7 +431,7 @@ int powell(local mot_float_type* model_parameters, void* data){
                                        &largest_decrease, &index_largest_decrease);
 
         if(powell_fval_diff_within_threshold(fval_at_start_of_iteration, fval)){
-            return 1;
+            POWELL_RETURN(1);
         }
 
         #if POWELL_RESET_METHOD == POWELL_RESET_METHOD_EXTRAPOLATED_POINT
@@ -395,7 +480,7 @@ int powell(local mot_float_type* model_parameters, void* data){
         }
         barrier(CLK_LOCAL_MEM_FENCE);
     }
-    return 6;
+    POWELL_RETURN(6);
 }
 
 /**
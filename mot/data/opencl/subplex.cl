@@ -31,6 +31,65 @@
 /** the precision we break at*/
 #define USER_TOL_X  30*MOT_EPSILON
 
+/**
+ * If set, we load and store the step sizes and the last change in the parameters in the optimizer state, such that
+ * the optimization can be resumed. The state is laid out as [is_initialized, xstep[nmr_params], delta_x[nmr_params]].
+ */
+#define SUBPLEX_USE_STATE %(USE_STATE)r
+
+/**
+ * If set, we write the number of iterations to ``nmr_iterations`` on return.
+ */
+#define SUBPLEX_USE_STATISTICS %(USE_STATISTICS)r
+
+/**
+ * If set, we record the function value at the start and after every iteration, see ``optimizer_trace``.
+ * Since the function value is not tracked by this method, this costs one function evaluation per iteration.
+ */
+#define SUBPLEX_USE_TRACE %(USE_TRACE)r
+
+#if SUBPLEX_USE_STATE
+    #define SUBPLEX_SAVE_STATE() \
+        optimizer_state[0] = 1; \
+        for(i = 0; i < %(NMR_PARAMS)r; i++){ \
+            optimizer_state[1 + i] = xstep[i]; \
+            optimizer_state[1 + %(NMR_PARAMS)r + i] = delta_x[i]; \
+        }
+#else
+    #define SUBPLEX_SAVE_STATE()
+#endif
+
+#if SUBPLEX_USE_STATISTICS
+    /* the returns happen before the iteration counter is incremented */
+    #define SUBPLEX_SAVE_STATISTICS() *nmr_iterations = min(itr + 1, MAX_IT);
+#else
+    #define SUBPLEX_SAVE_STATISTICS()
+#endif
+
+#if SUBPLEX_USE_TRACE
+    #define SUBPLEX_SAVE_TRACE() { \
+        double trace_fval = %(FUNCTION_NAME)s(model_parameters, data); \
+        if(get_local_id(0) == 0){ \
+            optimizer_trace(trace_fval, model_parameters%(TRACE_ARGUMENT)s); \
+        } \
+        barrier(CLK_LOCAL_MEM_FENCE); \
+    }
+#else
+    #define SUBPLEX_SAVE_TRACE()
+#endif
+
+#if SUBPLEX_USE_STATE || SUBPLEX_USE_STATISTICS
+    #define SUBPLEX_RETURN(return_code) { \
+        if(get_local_id(0) == 0){ \
+            SUBPLEX_SAVE_STATE() \
+            SUBPLEX_SAVE_STATISTICS() \
+        } \
+        return return_code; \
+    }
+#else
+    #define SUBPLEX_RETURN(return_code) return return_code;
+#endif
+
 /** The evaluation function we are expecting. */
 double %(FUNCTION_NAME)s(local mot_float_type* x, void* data_void);
 
@@ -47,7 +106,8 @@ int lib_nmsimplex(
         mot_float_type beta,
         mot_float_type gamma,
         mot_float_type delta,
-        local mot_float_type* scratch);
+        local mot_float_type* scratch,
+        int* nmr_iterations);
 
 
 // the data wrapper used for the subspace evaluation function
@@ -217,7 +277,8 @@ void _subplex_get_subspaces(local const mot_float_type* const delta_x,
 
 int sbplx_minimize(local mot_float_type* model_parameters, /* in: initial guess, out: minimizer */
 			       void* data,
-			       local const mot_float_type* const xstep0/* initial step sizes */){
+			       local const mot_float_type* const xstep0/* initial step sizes */%(STATE_PARAMETER)s%(STATISTICS_PARAMETER)s
+			       %(TRACE_PARAMETER)s){
 
     local mot_float_type scratch[%(NMR_PARAMS)r * 2 // (xstep, delta_x)
                                 + MAX_SUBSPACE_LENGTH * 2 // (subspace_model_parameters, subspace_xstep)
@@ -254,6 +315,15 @@ int sbplx_minimize(local mot_float_type* model_parameters, /* in: initial guess,
             xstep[i] = xstep0[i];
             delta_x[i] = 0;
         }
+
+        #if SUBPLEX_USE_STATE
+            if(optimizer_state[0] != 0){
+                for(i = 0; i < %(NMR_PARAMS)r; i++){
+                    xstep[i] = optimizer_state[1 + i];
+                    delta_x[i] = optimizer_state[1 + %(NMR_PARAMS)r + i];
+                }
+            }
+        #endif
     }
     barrier(CLK_LOCAL_MEM_FENCE);
 
@@ -261,6 +331,8 @@ int sbplx_minimize(local mot_float_type* model_parameters, /* in: initial guess,
     subspace_data.x = model_parameters;
     subspace_data.data = data;
 
+    SUBPLEX_SAVE_TRACE()
+
     for(itr=0; itr < MAX_IT; itr++) {
 
         if(get_local_id(0) == 0){
@@ -304,7 +376,7 @@ int sbplx_minimize(local mot_float_type* model_parameters, /* in: initial guess,
 
             lib_nmsimplex(subspace_dimensions[i], subspace_model_parameters, (void*)&subspace_data, subspace_xstep,
                           &fdiff, PSI, %(PATIENCE_NMSIMPLEX)r * (subspace_dimensions[i] + 1),
-                          alpha, beta, gamma, delta, nms_scratch);
+                          alpha, beta, gamma, delta, nms_scratch, 0);
 
             if(get_local_id(0) == 0){
                 // add the optimized subspace parameters to the current optimal set of model_parameters
@@ -322,6 +394,8 @@ int sbplx_minimize(local mot_float_type* model_parameters, /* in: initial guess,
             barrier(CLK_LOCAL_MEM_FENCE);
         }
 
+        SUBPLEX_SAVE_TRACE()
+
         if(get_local_id(0) == 0){
             // compute change in optimal point, the previous delta_x contained the previous set of model parameters
             for (i = 0; i < %(NMR_PARAMS)r; ++i){
@@ -339,7 +413,7 @@ int sbplx_minimize(local mot_float_type* model_parameters, /* in: initial guess,
 
         // stopping criteria using the infinity norm
         if(max(dxnorm, (mot_float_type)(stepnorm * PSI)) / max(stepnorm, (mot_float_type)1.0) <= USER_TOL_X){
-            return 3;
+            SUBPLEX_RETURN(3);
         }
 
         /**************************/
@@ -377,10 +451,11 @@ int sbplx_minimize(local mot_float_type* model_parameters, /* in: initial guess,
         /**************************/
     }
 
-    return 6;
+    SUBPLEX_RETURN(6);
 }
 
-int subplex(local mot_float_type* const model_parameters, void* data){
+int subplex(local mot_float_type* const model_parameters, void* data%(STATE_PARAMETER)s%(STATISTICS_PARAMETER)s
+            %(TRACE_PARAMETER)s){
     local mot_float_type initial_simplex_scale[%(NMR_PARAMS)r];
 
     if(get_local_id(0) == 0){
@@ -388,7 +463,8 @@ int subplex(local mot_float_type* const model_parameters, void* data){
     }
     barrier(CLK_LOCAL_MEM_FENCE);
 
-    return sbplx_minimize(model_parameters, data, initial_simplex_scale);
+    return sbplx_minimize(model_parameters, data, initial_simplex_scale%(STATE_ARGUMENT)s%(STATISTICS_ARGUMENT)s
+                          %(TRACE_ARGUMENT)s);
 }
 
 
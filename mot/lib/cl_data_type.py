@@ -30,7 +30,8 @@ _cl_data_type_parser = tatsu.compile('''
                    | ?'long' | ?'unsigned long' | ?'ulong'
                    | ?'half'
                    | ?'float'
-                   | ?'double';
+                   | ?'double'
+                   | /[a-zA-Z_]\w*/;
 ''')
 
 
@@ -1,3 +1,4 @@
+import logging
 import pyopencl as cl
 from .utils import device_supports_double, device_type_from_string
 
@@ -243,6 +244,72 @@ class CLEnvironmentFactory:
 
         return runtime_list
 
+    @staticmethod
+    def create_sub_devices(cl_environments=None, partition_type='equally', nmr_sub_devices=2,
+                           affinity_domain='numa'):
+        """Split the devices of the given environments into sub-devices, each in its own environment.
+
+        This uses OpenCL device fission to partition a (typically CPU) device into multiple sub-devices. Each
+        sub-device is returned as a separate :class:`CLEnvironment` with its own context and queue, such that
+        the load balancers can distribute work over them and such that independent kernels can be run
+        concurrently, each on its own subset of the compute units. For example:
+
+        .. code-block:: python
+
+            sub_envs = CLEnvironmentFactory.create_sub_devices(partition_type='affinity')
+            optimize_runtime = CLRuntimeInfo(cl_environments=sub_envs[:1])
+            sample_runtime = CLRuntimeInfo(cl_environments=sub_envs[1:])
+
+        Devices that do not support the requested partitioning are returned unchanged, with a logged warning.
+
+        Args:
+            cl_environments (list of CLEnvironment): the environments with the devices to split. If not given
+                we split all the CPU devices found.
+            partition_type (str): one of 'equally' or 'affinity'. With 'equally' each device is split into
+                ``nmr_sub_devices`` sub-devices with the same number of compute units. With 'affinity' the devices
+                are split along the affinity domain given by ``affinity_domain``.
+            nmr_sub_devices (int): the number of sub-devices to create per device, only used for the
+                'equally' partition type. This is clamped to the number of compute units of the device. If the
+                compute units do not divide evenly, the device may be split into more sub-devices.
+            affinity_domain (str): the affinity domain to split the devices on, only used for the 'affinity'
+                partition type. One of 'numa', 'l4_cache', 'l3_cache', 'l2_cache', 'l1_cache'
+                or 'next_partitionable'.
+
+        Returns:
+            list of CLEnvironment: the list with the environments of the sub-devices.
+        """
+        if partition_type not in ('equally', 'affinity'):
+            raise ValueError('The partition type "{}" is not supported.'.format(partition_type))
+        if partition_type == 'equally' and nmr_sub_devices < 1:
+            raise ValueError('The number of sub-devices should be at least one, {} given.'.format(nmr_sub_devices))
+
+        if cl_environments is None:
+            cl_environments = CLEnvironmentFactory.all_devices(cl_device_type='CPU')
+
+        logger = logging.getLogger(__name__)
+        runtime_list = []
+        for env in cl_environments:
+            if partition_type == 'equally':
+                max_compute_units = env.device.get_info(cl.device_info.MAX_COMPUTE_UNITS)
+                properties = [cl.device_partition_property.EQUALLY,
+                              max_compute_units // min(nmr_sub_devices, max_compute_units)]
+            else:
+                properties = [cl.device_partition_property.BY_AFFINITY_DOMAIN,
+                              getattr(cl.device_affinity_domain, affinity_domain.upper())]
+
+            try:
+                sub_devices = env.device.create_sub_devices(properties)
+            except (cl.LogicError, cl.RuntimeError) as exc:
+                logger.warning('Could not partition the device "{}", using the unsplit device. '
+                               'Reason: {}'.format(env.device.name, exc))
+                runtime_list.append(env)
+                continue
+
+            for sub_device in sub_devices:
+                runtime_list.append(CLEnvironment(env.platform, sub_device))
+
+        return runtime_list
+
     @staticmethod
     def smart_device_selection():
         """Get a list of device environments that is suitable for use in MOT.
@@ -14,7 +14,7 @@ from textwrap import dedent, indent
 from mot.configuration import CLRuntimeInfo
 from mot.lib.kernel_data import KernelData, Scalar, Array, Zeros
 from mot.lib.load_balance_strategies import Worker
-from mot.lib.utils import is_scalar, get_float_type_def
+from mot.lib.utils import is_scalar, get_float_type_def, split_in_batches
 
 __author__ = 'Robbert Harms'
 __date__ = '2017-08-31'
@@ -94,7 +94,7 @@ class CLFunction:
         """
         raise NotImplementedError()
 
-    def evaluate(self, inputs, nmr_instances, use_local_reduction=False, cl_runtime_info=None):
+    def evaluate(self, inputs, nmr_instances, use_local_reduction=False, cl_runtime_info=None, problem_indices=None):
         """Evaluate this function for each set of given parameters.
 
         Given a set of input parameters, this model will be evaluated for every parameter set.
@@ -112,6 +112,9 @@ class CLFunction:
                  evaluating this function. If this is set to True we will multiply the global size
                  (given by the nmr_instances) by the work group sizes.
             cl_runtime_info (mot.configuration.CLRuntimeInfo): the runtime information for execution
+            problem_indices (ndarray): if given, only evaluate the function for the problems with these indices.
+                The number of instances should then still be the total number of problems. This allows running
+                the function on a subset of the problems without having to subset the input data.
 
         Returns:
             ndarray: the return values of the function, which can be None if this function has a void return type.
@@ -250,7 +253,7 @@ class SimpleCLFunction(CLFunction):
     def get_cl_extra(self):
         return self._cl_extra
 
-    def evaluate(self, inputs, nmr_instances, use_local_reduction=False, cl_runtime_info=None):
+    def evaluate(self, inputs, nmr_instances, use_local_reduction=False, cl_runtime_info=None, problem_indices=None):
         def wrap_input_data(input_data):
             def get_data_object(param):
                 if input_data[param.name] is None:
@@ -288,7 +291,8 @@ class SimpleCLFunction(CLFunction):
                                  'required parameters are: {}, missing inputs are: {}'.format(names, missing_names))
 
         return apply_cl_function(self, wrap_input_data(inputs), nmr_instances,
-                                 use_local_reduction=use_local_reduction, cl_runtime_info=cl_runtime_info)
+                                 use_local_reduction=use_local_reduction, cl_runtime_info=cl_runtime_info,
+                                 problem_indices=problem_indices)
 
     def get_dependencies(self):
         return self._dependencies
@@ -429,7 +433,8 @@ class SimpleCLFunctionParameter(CLFunctionParameter):
         return new_param
 
 
-def apply_cl_function(cl_function, kernel_data, nmr_instances, use_local_reduction=False, cl_runtime_info=None):
+def apply_cl_function(cl_function, kernel_data, nmr_instances, use_local_reduction=False, cl_runtime_info=None,
+                      problem_indices=None):
     """Run the given function/procedure on the given set of data.
 
     This class will wrap the given CL function in a kernel call and execute that that for every data instance using
@@ -445,6 +450,9 @@ def apply_cl_function(cl_function, kernel_data, nmr_instances, use_local_reducti
              your CL procedure. If this is set to True we will multiply the global size (given by the nmr_instances)
              by the work group sizes.
         cl_runtime_info (mot.configuration.CLRuntimeInfo): the runtime information
+        problem_indices (ndarray): if given, we only run the function for the problems with these indices.
+            The kernel data is still indexed by the original problem index, such that the results are
+            written to the rows of these problems.
     """
     cl_runtime_info = cl_runtime_info or CLRuntimeInfo()
 
@@ -458,27 +466,111 @@ def apply_cl_function(cl_function, kernel_data, nmr_instances, use_local_reducti
     if cl_function.get_return_type() != 'void':
         kernel_data['_results'] = Zeros((nmr_instances,), cl_function.get_return_type())
 
+    nmr_items = nmr_instances
+    if problem_indices is not None:
+        problem_indices = np.require(np.unique(problem_indices), np.uint64, requirements=['C', 'A', 'O'])
+        nmr_items = problem_indices.shape[0]
+
     workers = []
     for cl_environment in cl_runtime_info.get_cl_environments():
         workers.append(_ProcedureWorker(cl_environment, cl_runtime_info.get_compile_flags(),
                                         cl_function,
-                                        kernel_data, cl_runtime_info.double_precision, use_local_reduction))
+                                        kernel_data, cl_runtime_info.double_precision, use_local_reduction,
+                                        problem_indices=problem_indices))
 
-    cl_runtime_info.load_balancer.process(workers, nmr_instances)
+    if nmr_items:
+        cl_runtime_info.load_balancer.process(workers, nmr_items)
 
     if cl_function.get_return_type() != 'void':
         return kernel_data['_results'].get_data()
 
 
+class _ProcedureRunner:
+
+    def __init__(self, cl_function, kernel_data, nmr_instances, use_local_reduction=False, cl_runtime_info=None):
+        """Run a CL function repeatedly on changing subsets of the problems, keeping the kernel data on the devices.
+
+        Every call of :func:`apply_cl_function` compiles the kernel, uploads all the kernel data and creates the
+        device buffers. This instead compiles the kernel and creates the device buffers once. Per run we only write
+        the indices of the problems to run to the devices and read back the rows of those problems.
+
+        Since the kernel data stays on the devices between runs, every device is assigned a fixed range of problems
+        instead of using the load balancer, as in :class:`mot.sample.base.SamplerSession`. The kernel data should
+        not be changed on the host between runs.
+
+        Args:
+            cl_function (mot.lib.cl_function.CLFunction): the function to run on the datasets.
+            kernel_data (dict[str: mot.lib.kernel_data.KernelData]): the data to use as input to the function,
+                None values are loaded as a zero scalar.
+            nmr_instances (int): the total number of problems
+            use_local_reduction (boolean): if we use local memory reduction, see :func:`apply_cl_function`.
+            cl_runtime_info (mot.configuration.CLRuntimeInfo): the runtime information
+        """
+        cl_runtime_info = cl_runtime_info or CLRuntimeInfo()
+
+        self._kernel_data = {param.name: Scalar(0) if kernel_data[param.name] is None else kernel_data[param.name]
+                             for param in cl_function.get_parameters()}
+        if cl_function.get_return_type() != 'void':
+            self._kernel_data['_results'] = Zeros((nmr_instances,), cl_function.get_return_type())
+
+        cl_environments = cl_runtime_info.load_balancer.get_used_cl_environments(
+            cl_runtime_info.get_cl_environments())
+
+        self._problem_ranges = list(split_in_batches(
+            nmr_instances, max(int(np.ceil(nmr_instances / len(cl_environments))), 1)))
+        self._workers = [_ProcedureWorker(env, cl_runtime_info.get_compile_flags(), cl_function,
+                                          self._kernel_data, cl_runtime_info.double_precision, use_local_reduction,
+                                          problem_indices=np.arange(range_start, range_end, dtype=np.uint64))
+                         for env, (range_start, range_end) in zip(cl_environments, self._problem_ranges)]
+
+    def run(self, problem_indices=None):
+        """Run the function for the given problems.
+
+        Args:
+            problem_indices (ndarray): the indices of the problems to run, if not given we run all problems.
+
+        Returns:
+            ndarray or None: the return values of the function, if it has any. Only the entries of the problems
+                which were run are updated.
+        """
+        for worker, (range_start, range_end) in zip(self._workers, self._problem_ranges):
+            indices = np.arange(range_start, range_end)
+            if problem_indices is not None:
+                indices = np.intersect1d(indices, problem_indices)
+
+            if len(indices):
+                worker.set_problem_indices(indices)
+                worker.calculate(0, len(indices))
+                worker.cl_queue.flush()
+
+        for worker in self._workers:
+            worker.cl_queue.finish()
+
+        if '_results' in self._kernel_data:
+            return self._kernel_data['_results'].get_data()
+
+    def write_data(self, name, values):
+        """Overwrite the kernel data of the given name on all the devices, see :meth:`_ProcedureWorker.enqueue_write`.
+
+        Args:
+            name (str): the name of the kernel data to overwrite
+            values (ndarray): the new values, should have the same number of elements as the kernel data
+        """
+        if name in self._kernel_data:
+            for worker in self._workers:
+                worker.enqueue_write(name, values)
+
+
 class _ProcedureWorker(Worker):
 
     def __init__(self, cl_environment, compile_flags, cl_function,
-                 kernel_data, double_precision, use_local_reduction):
+                 kernel_data, double_precision, use_local_reduction, problem_indices=None):
         super().__init__(cl_environment)
         self._cl_function = cl_function
         self._kernel_data = OrderedDict(sorted(kernel_data.items()))
         self._double_precision = double_precision
         self._use_local_reduction = use_local_reduction
+        self._problem_indices = problem_indices
 
         self._mot_float_dtype = np.float32
         if double_precision:
@@ -498,13 +590,45 @@ class _ProcedureWorker(Worker):
         self._kernel_inputs = {name: data.get_kernel_inputs(self._cl_context, self._workgroup_size)
                                for name, data in self._kernel_data.items()}
 
+        self._problem_indices_buffer = None
+        if self._problem_indices is not None:
+            self._problem_indices_buffer = cl.Buffer(self._cl_context,
+                                                     cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR,
+                                                     hostbuf=self._problem_indices)
+
+    def set_problem_indices(self, problem_indices):
+        """Overwrite the indices of the problems to run, keeping the compiled kernel and the kernel data buffers.
+
+        This only works if this worker was created with problem indices. The write is blocking.
+
+        Args:
+            problem_indices (ndarray): the new problem indices, at most as many as given at construction
+        """
+        problem_indices = np.require(problem_indices, np.uint64, requirements=['C', 'A', 'O'])
+        if problem_indices.shape[0] > self._problem_indices_buffer.size // problem_indices.itemsize:
+            raise ValueError('More problem indices given than this worker was created with.')
+        cl.enqueue_copy(self._cl_queue, self._problem_indices_buffer, problem_indices, is_blocking=True)
+        self._problem_indices = problem_indices
+
     def calculate(self, range_start, range_end):
+        self.enqueue_kernel(range_start, range_end)
+        self.enqueue_readouts(range_start, range_end)
+
+    def enqueue_kernel(self, range_start, range_end):
+        """Enqueue a run of the kernel for the given range of problems, without reading out the results.
+
+        Args:
+            range_start (int): the start of the processing range
+            range_end (int): the end of the processing range
+        """
         nmr_problems = range_end - range_start
 
         func = self._kernel.run_procedure
         func.set_scalar_arg_dtypes(self.get_scalar_arg_dtypes())
 
         kernel_inputs_list = []
+        if self._problem_indices_buffer is not None:
+            kernel_inputs_list.append(self._problem_indices_buffer)
         for inputs in [self._kernel_inputs[name] for name in self._kernel_data]:
             kernel_inputs_list.extend(inputs)
 
@@ -514,8 +638,41 @@ class _ProcedureWorker(Worker):
              *kernel_inputs_list,
              global_offset=(int(range_start * self._workgroup_size),))
 
+    def enqueue_readouts(self, range_start, range_end, names=None):
+        """Enqueue the readouts of the kernel data for the given range of problems.
+
+        The buffers are kept between kernel runs, such that kernel data which is not read out stays on the device.
+        If problem indices are used, we only read out the rows of the problems that were run, one readout per
+        consecutive run of problem indices.
+
+        Args:
+            range_start (int): the start of the processing range
+            range_end (int): the end of the processing range
+            names (List[str]): the names of the kernel data to read out, if not given we read out all kernel data
+        """
+        readout_ranges = [(range_start, range_end)]
+        if self._problem_indices is not None:
+            indices = self._problem_indices[range_start:range_end].astype(np.int64)
+            runs = np.split(indices, np.where(np.diff(indices) != 1)[0] + 1)
+            readout_ranges = [(int(run[0]), int(run[-1]) + 1) for run in runs if len(run)]
+
         for name, data in self._kernel_data.items():
-            data.enqueue_readouts(self._cl_queue, self._kernel_inputs[name], range_start, range_end)
+            if names is None or name in names:
+                for readout_start, readout_end in readout_ranges:
+                    data.enqueue_readouts(self._cl_queue, self._kernel_inputs[name], readout_start, readout_end)
+
+    def enqueue_write(self, name, values):
+        """Overwrite the device buffer of the given kernel data with the given values.
+
+        This only works for kernel data loaded as a single buffer, like :class:`~mot.lib.kernel_data.Array`.
+        The write is blocking, such that the given values can be discarded afterwards.
+
+        Args:
+            name (str): the name of the kernel data to overwrite
+            values (ndarray): the new values, should have the same number of elements as the kernel data
+        """
+        values = np.require(values, self._kernel_data[name].get_data().dtype, requirements=['C', 'A'])
+        cl.enqueue_copy(self._cl_queue, self._kernel_inputs[name][0], values, is_blocking=True)
 
     def _build_kernel(self, kernel_source, compile_flags=()):
         """Convenience function for building the kernel for this worker.
@@ -551,9 +708,13 @@ class _ProcedureWorker(Worker):
         kernel_source += get_float_type_def(self._double_precision)
         kernel_source += '\n'.join(data.get_type_definitions() for data in self._kernel_data.values())
         kernel_source += self._cl_function.get_cl_code()
+        problem_index = '(ulong)(get_global_id(0) / get_local_size(0))'
+        if self._problem_indices is not None:
+            problem_index = '_problem_indices[' + problem_index + ']'
+
         kernel_source += '''
             __kernel void run_procedure(''' + ",\n".join(self._get_kernel_arguments()) + '''){
-                ulong gid = (ulong)(get_global_id(0) / get_local_size(0));
+                ulong gid = ''' + problem_index + ''';
                 
                 ''' + '\n'.join(variable_inits) + '''     
                 
@@ -574,6 +735,8 @@ class _ProcedureWorker(Worker):
             list of str: the list of parameter definitions
         """
         declarations = []
+        if self._problem_indices is not None:
+            declarations.append('global ulong* restrict _problem_indices')
         for name, data in self._kernel_data.items():
             declarations.extend(data.get_kernel_parameters('_' + name))
         return declarations
@@ -586,6 +749,8 @@ class _ProcedureWorker(Worker):
                 if is a scalar.
         """
         dtypes = []
+        if self._problem_indices is not None:
+            dtypes.append(None)
         for name, data in self._kernel_data.items():
             dtypes.extend(data.get_scalar_arg_dtypes())
         return dtypes
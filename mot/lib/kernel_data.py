@@ -318,6 +318,70 @@ class Struct(KernelData):
         return len(self._elements)
 
 
+class GroupedData(KernelData):
+
+    def __init__(self, data, group_size):
+        """Shares the given kernel data between consecutive groups of problem instances.
+
+        The problem instances ``[i * group_size, (i + 1) * group_size)`` all use the data of problem ``i`` of the
+        wrapped kernel data. This allows running multiple instances per problem, like multiple sampling chains,
+        without copying the data.
+
+        Args:
+            data (KernelData): the kernel data to share
+            group_size (int): the number of consecutive problem instances sharing the data of one problem
+        """
+        self._data = data
+        self._group_size = group_size
+
+    def set_mot_float_dtype(self, mot_float_dtype):
+        self._data.set_mot_float_dtype(mot_float_dtype)
+
+    def get_data(self):
+        return self._data.get_data()
+
+    def get_scalar_arg_dtypes(self):
+        return self._data.get_scalar_arg_dtypes()
+
+    def enqueue_readouts(self, queue, buffers, range_start, range_end):
+        self._data.enqueue_readouts(queue, buffers, range_start // self._group_size,
+                                    -(-range_end // self._group_size))
+
+    def get_type_definitions(self):
+        return self._data.get_type_definitions()
+
+    def initialize_variable(self, variable_name, kernel_param_name, problem_id_substitute, address_space):
+        return self._data.initialize_variable(variable_name, kernel_param_name,
+                                              self._get_problem_id(problem_id_substitute), address_space)
+
+    def get_function_call_input(self, variable_name, kernel_param_name, problem_id_substitute, address_space):
+        return self._data.get_function_call_input(variable_name, kernel_param_name,
+                                                  self._get_problem_id(problem_id_substitute), address_space)
+
+    def post_function_callback(self, variable_name, kernel_param_name, problem_id_substitute, address_space):
+        return self._data.post_function_callback(variable_name, kernel_param_name,
+                                                 self._get_problem_id(problem_id_substitute), address_space)
+
+    def get_struct_declaration(self, name):
+        return self._data.get_struct_declaration(name)
+
+    def get_struct_initialization(self, variable_name, kernel_param_name, problem_id_substitute):
+        return self._data.get_struct_initialization(variable_name, kernel_param_name,
+                                                    self._get_problem_id(problem_id_substitute))
+
+    def get_kernel_parameters(self, kernel_param_name):
+        return self._data.get_kernel_parameters(kernel_param_name)
+
+    def get_kernel_inputs(self, cl_context, workgroup_size):
+        return self._data.get_kernel_inputs(cl_context, workgroup_size)
+
+    def get_nmr_kernel_inputs(self):
+        return self._data.get_nmr_kernel_inputs()
+
+    def _get_problem_id(self, problem_id_substitute):
+        return '(({}) / {})'.format(problem_id_substitute, self._group_size)
+
+
 class Scalar(KernelData):
 
     def __init__(self, value, ctype=None):
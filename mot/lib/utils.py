@@ -458,6 +458,11 @@ def hessian_to_covariance(hessian, output_singularity=False):
     exact inverse impossible. This method uses an exact inverse if possible with a fall back on a pseudo inverse.
     If also the pseudo inverse fails, this function returns zeros as covariance for that Hessian.
 
+    All Hessians are processed at once. We take the singular value decomposition of every Hessian, using one stacked
+    decomposition, and compute both the condition number and the (pseudo) inverse from it. Hessians with a condition
+    number above the reciprocal of the machine precision are marked as singular and are inverted as a pseudo inverse,
+    ignoring their small singular values as in :func:`numpy.linalg.pinv`.
+
     Important: Before the matrix inversion it will set NaN's to 0. After the inversion we make the diagonal
     (representing the variances of each parameter) positive where needed by taking the absolute.
 
@@ -472,26 +477,28 @@ def hessian_to_covariance(hessian, output_singularity=False):
             covariance matrix. If ``output_singularity`` is set to True this function returns a tuple with:
             (``covariance_matrix``, ``is_singular``).
     """
-    hessian = np.nan_to_num(hessian)
-
-    if output_singularity:
-        is_singular = np.zeros(hessian.shape[0], dtype=bool)
+    hessian = np.nan_to_num(np.asarray(hessian, dtype=np.result_type(hessian, np.float32)))
 
     covars = np.zeros_like(hessian)
-    for roi_ind in range(hessian.shape[0]):
-        if output_singularity:
-            is_singular[roi_ind] = True
-
-        try:
-            covars[roi_ind] = np.linalg.inv(hessian[roi_ind])
-
-            if output_singularity:
-                is_singular[roi_ind] = False
-        except np.linalg.linalg.LinAlgError:
+    is_singular = np.ones(hessian.shape[0], dtype=bool)
+    try:
+        decompositions = [np.linalg.svd(hessian)]
+        problems = [np.arange(hessian.shape[0])]
+    except np.linalg.LinAlgError:
+        decompositions, problems = [], []
+        for roi_ind in range(hessian.shape[0]):
             try:
-                covars[roi_ind] = np.linalg.pinv(hessian[roi_ind])
-            except np.linalg.linalg.LinAlgError:
-                covars[roi_ind] = np.zeros(hessian[roi_ind].shape)
+                decompositions.append(np.linalg.svd(hessian[roi_ind:roi_ind + 1]))
+                problems.append(np.array([roi_ind]))
+            except np.linalg.LinAlgError:
+                pass
+
+    for (u, s, vh), roi_inds in zip(decompositions, problems):
+        with np.errstate(all='ignore'):
+            is_singular[roi_inds] = ~(s[:, 0] / s[:, -1] < 1 / np.finfo(hessian.dtype).eps)
+            cutoff = np.where(is_singular[roi_inds], 1e-15 * s[:, 0], 0)[:, None]
+            s_inv = np.where(s > cutoff, 1 / s, 0)
+        covars[roi_inds] = np.matmul(np.swapaxes(vh, 1, 2) * s_inv[:, None, :], np.swapaxes(u, 1, 2))
 
     diagonal_ind = np.arange(hessian.shape[1])
     covars[:, diagonal_ind, diagonal_ind] = np.abs(covars[:, diagonal_ind, diagonal_ind])
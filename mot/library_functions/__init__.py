@@ -1,5 +1,5 @@
 import os
-
+import math
 from mot.lib.cl_function import SimpleCLFunction
 from mot.library_functions.base import SimpleCLLibrary, SimpleCLLibraryFromFile, CLLibrary
 from pkg_resources import resource_filename
@@ -117,9 +117,139 @@ class EuclidianNormFunction(SimpleCLLibraryFromFile):
             var_replace_dict={'MEMSPACE': memspace, 'MEMTYPE': memtype})
 
 
+class EigenSymmetric(SimpleCLLibraryFromFile):
+    def __init__(self, memspace='private', memtype='mot_float_type'):
+        """A CL function for the eigendecomposition of a small symmetric matrix, using the cyclic Jacobi method.
+
+        The function has the signature ``void eigen_symmetric_<memspace>_<memtype>(A, eigenvectors, eigenvalues,
+        n)``, for a symmetric (n, n) matrix ``A`` in row-major order, which is overwritten. The eigenvectors are
+        stored in the columns of the (n, n) matrix ``eigenvectors``. This should be called by one work item.
+
+        Args:
+            memspace (str): The memory space of the matrices (private, local, global).
+            memtype (str): the memory type to use, double, float, mot_float_type, ...
+        """
+        super().__init__(
+            'void',
+            'eigen_symmetric_' + memspace + '_' + memtype,
+            [('{} {}*'.format(memspace, memtype), 'A'),
+             ('{} {}*'.format(memspace, memtype), 'eigenvectors'),
+             ('{} {}*'.format(memspace, memtype), 'eigenvalues'),
+             ('int', 'n')],
+            resource_filename('mot', 'data/opencl/eigen_symmetric.cl'),
+            var_replace_dict={'MEMSPACE': memspace, 'MEMTYPE': memtype})
+
+
+class Cholesky(SimpleCLLibraryFromFile):
+    def __init__(self, memspace='private', memtype='mot_float_type'):
+        """A CL function for the Cholesky decomposition of a small symmetric positive definite matrix.
+
+        The function has the signature ``int cholesky_<memspace>_<memtype>(A, n)``, for a symmetric (n, n)
+        matrix ``A`` in row-major order, which is overwritten with the lower triangular factor ``L`` of
+        ``A = L L^T``. It returns 1 on success and 0 if the matrix is not positive definite. This should be called
+        by one work item.
+
+        Args:
+            memspace (str): The memory space of the matrix (private, local, global).
+            memtype (str): the memory type to use, double, float, mot_float_type, ...
+        """
+        super().__init__(
+            'int',
+            'cholesky_' + memspace + '_' + memtype,
+            [('{} {}*'.format(memspace, memtype), 'A'),
+             ('int', 'n')],
+            resource_filename('mot', 'data/opencl/cholesky.cl'),
+            var_replace_dict={'MEMSPACE': memspace, 'MEMTYPE': memtype})
+
+
+class CholeskyInverse(SimpleCLLibraryFromFile):
+    def __init__(self, memspace='private', memtype='mot_float_type'):
+        """A CL function for inverting a small symmetric positive definite matrix using its Cholesky decomposition.
+
+        The function has the signature ``int cholesky_inverse_<memspace>_<memtype>(A, n)``, for a symmetric (n, n)
+        matrix ``A`` in row-major order, which is overwritten with its inverse. It returns 1 on success and 0 if
+        the matrix is not positive definite, or if the ratio of the largest to the smallest Cholesky pivot exceeds
+        the reciprocal of the machine precision of ``memtype``. This should be called by one work item.
+
+        Args:
+            memspace (str): The memory space of the matrix (private, local, global).
+            memtype (str): the memory type to use, double, float, mot_float_type, ...
+        """
+        super().__init__(
+            'int',
+            'cholesky_inverse_' + memspace + '_' + memtype,
+            [('{} {}*'.format(memspace, memtype), 'A'),
+             ('int', 'n')],
+            resource_filename('mot', 'data/opencl/cholesky_inverse.cl'),
+            var_replace_dict={'MEMSPACE': memspace, 'MEMTYPE': memtype,
+                              'EPSILON': {'double': 'DBL_EPSILON', 'float': 'FLT_EPSILON'}.get(memtype, 'MOT_EPSILON')})
+
+
+class OptimizerTrace(SimpleCLLibraryFromFile):
+
+    def __init__(self, nmr_parameters, trace_length=100, trace_x=False):
+        """Records the objective function value, and optionally the parameters, per iteration of an optimizer.
+
+        The optimization routines accept an instance of this class as their ``trace`` argument. They then get the
+        additional arguments listed by :meth:`get_trace_parameters`, in which they record the objective function
+        value at the start of every iteration and on return. The values are written to a ring buffer per problem,
+        such that only the last ``trace_length`` entries are kept.
+
+        Args:
+            nmr_parameters (int): the number of parameters in the model
+            trace_length (int): the number of entries in the ring buffer of every problem
+            trace_x (boolean): if we also record the parameters at every iteration
+        """
+        self._trace_x = trace_x
+
+        params = {
+            'NMR_PARAMS': nmr_parameters,
+            'TRACE_LENGTH': trace_length,
+            'TRACE_X': int(bool(trace_x)),
+            'TRACE_X_PARAMETER': ', global double* trace_x' if trace_x else ''
+        }
+
+        super().__init__(
+            'void', 'optimizer_trace', [],
+            resource_filename('mot', 'data/opencl/optimizer_trace.cl'),
+            var_replace_dict=params)
+
+    def get_trace_parameters(self):
+        """Get the additional parameters of the optimization routines using this trace.
+
+        These are the number of entries written per problem (``trace_position``), the ring buffer with the objective
+        function values (``trace_objective``) and, if enabled, the ring buffer with the parameters (``trace_x``).
+
+        Returns:
+            list of tuple: the (ctype, name) of every additional parameter
+        """
+        parameters = [('global uint*', 'trace_position'), ('global double*', 'trace_objective')]
+        if self._trace_x:
+            parameters.append(('global double*', 'trace_x'))
+        return parameters
+
+
+def _get_trace_template_vars(trace):
+    """Get the template variables used by the optimization routines for recording the given trace.
+
+    Args:
+        trace (OptimizerTrace): the trace to record, or None for no tracing
+
+    Returns:
+        dict: the template variables ``USE_TRACE``, ``TRACE_PARAMETER`` and ``TRACE_ARGUMENT``
+    """
+    if trace is None:
+        return {'USE_TRACE': 0, 'TRACE_PARAMETER': '', 'TRACE_ARGUMENT': ''}
+
+    parameters = trace.get_trace_parameters()
+    return {'USE_TRACE': 1,
+            'TRACE_PARAMETER': ''.join(', {} {}'.format(ctype, name) for ctype, name in parameters),
+            'TRACE_ARGUMENT': ''.join(', {}'.format(name) for ctype, name in parameters)}
+
+
 class LibNMSimplex(SimpleCLLibraryFromFile):
 
-    def __init__(self, function_name):
+    def __init__(self, function_name, trace=None):
         """The NMSimplex algorithm as a reusable library component.
 
         Args:
@@ -127,26 +257,44 @@ class LibNMSimplex(SimpleCLLibraryFromFile):
                 This should point to a function with signature:
 
                     ``double evaluate(local mot_float_type* x, void* data_void);``
+            trace (OptimizerTrace): if given, the function gets the additional arguments of the trace, in which the
+                best function value is recorded at the start of every iteration.
         """
         params = {
             'FUNCTION_NAME': function_name
         }
+        params.update(_get_trace_template_vars(trace))
 
         super().__init__(
             'int', 'lib_nmsimplex', [],
             resource_filename('mot', 'data/opencl/lib_nmsimplex.cl'),
-            var_replace_dict=params)
+            var_replace_dict=params, dependencies=[trace] if trace is not None else [])
 
 
 class NMSimplex(SimpleCLLibrary):
 
     def __init__(self, function_name, nmr_parameters, patience=200, alpha=1.0, beta=0.5,
-                 gamma=2.0, delta=0.5, scale=1.0, adaptive_scales=True, **kwargs):
+                 gamma=2.0, delta=0.5, scale=1.0, adaptive_scales=True, use_state=False, use_statistics=False,
+                 trace=None, **kwargs):
+        """The Nelder-Mead simplex CL implementation.
 
+        Args:
+            function_name (str): the name of the evaluation function to call
+            nmr_parameters (int): the number of parameters in the model, this will be hardcoded in the method
+            use_state (boolean): if set, the function gets an additional argument
+                ``global mot_float_type* optimizer_state`` in which the simplex is loaded and stored, allowing the
+                optimization to be resumed. See :meth:`get_state_length` for the length of the state per problem.
+            use_statistics (boolean): if set, the function gets an additional argument
+                ``global uint* nmr_iterations`` to which the number of iterations is written.
+            trace (OptimizerTrace): if given, the function gets the additional arguments of the trace, in which the
+                best function value is recorded at the start of every iteration and on return.
+        """
         if 'dependencies' in kwargs:
-            kwargs['dependencies'] = list(kwargs['dependencies']) + [LibNMSimplex(function_name)]
+            kwargs['dependencies'] = list(kwargs['dependencies']) + [LibNMSimplex(function_name, trace=trace)]
         else:
-            kwargs['dependencies'] = [LibNMSimplex(function_name)]
+            kwargs['dependencies'] = [LibNMSimplex(function_name, trace=trace)]
+
+        self._nmr_parameters = nmr_parameters
 
         params = {'NMR_PARAMS': nmr_parameters,
                   'PATIENCE': patience,
@@ -155,7 +303,12 @@ class NMSimplex(SimpleCLLibrary):
                   'GAMMA': gamma,
                   'DELTA': delta,
                   'INITIAL_SIMPLEX_SCALES': '\n'.join('initial_simplex_scale[{}] = {};'.format(ind, scale)
-                                                      for ind in range(nmr_parameters))}
+                                                      for ind in range(nmr_parameters)),
+                  'USE_STATE': int(bool(use_state)),
+                  'STATE_PARAMETER': ', global mot_float_type* optimizer_state' if use_state else '',
+                  'USE_STATISTICS': int(bool(use_statistics)),
+                  'STATISTICS_PARAMETER': ', global uint* nmr_iterations' if use_statistics else ''}
+        params.update(_get_trace_template_vars(trace))
 
         if adaptive_scales:
             params.update(
@@ -166,8 +319,10 @@ class NMSimplex(SimpleCLLibrary):
             )
 
         super().__init__('''
-            int nmsimplex(local mot_float_type* model_parameters, void* data){
+            int nmsimplex(local mot_float_type* model_parameters, void* data%(STATE_PARAMETER)s%(STATISTICS_PARAMETER)s
+                          %(TRACE_PARAMETER)s){
                 local mot_float_type initial_simplex_scale[%(NMR_PARAMS)r];
+                int iterations;
                 
                 if(get_local_id(0) == 0){
                     %(INITIAL_SIMPLEX_SCALES)s
@@ -178,19 +333,67 @@ class NMSimplex(SimpleCLLibrary):
                 mot_float_type psi = 0;
                 local mot_float_type nmsimplex_scratch[
                     %(NMR_PARAMS)r * 2 + (%(NMR_PARAMS)r + 1) * (%(NMR_PARAMS)r + 1)];
-    
-                return lib_nmsimplex(%(NMR_PARAMS)r, model_parameters, data, initial_simplex_scale,
-                                     &fdiff, psi, (int)(%(PATIENCE)r * (%(NMR_PARAMS)r+1)),
-                                     %(ALPHA)r, %(BETA)r, %(GAMMA)r, %(DELTA)r,
-                                     nmsimplex_scratch);
+                
+                #if %(USE_STATE)r
+                    /* the simplex vertices are stored relative to the model parameters */
+                    local mot_float_type* vertices = nmsimplex_scratch + 3 * %(NMR_PARAMS)r + 1;
+                    bool resume = optimizer_state[0] != 0;
+                    int return_code;
+                    
+                    if(get_local_id(0) == 0 && resume){
+                        for(uint i = 0; i < %(NMR_PARAMS)r + 1; i++){
+                            for(uint j = 0; j < %(NMR_PARAMS)r; j++){
+                                vertices[i * %(NMR_PARAMS)r + j] = model_parameters[j] 
+                                    + optimizer_state[1 + i * %(NMR_PARAMS)r + j];
+                            }
+                        }
+                    }
+                    barrier(CLK_LOCAL_MEM_FENCE);
+                    
+                    return_code = lib_nmsimplex(%(NMR_PARAMS)r, model_parameters, data, 
+                                                resume ? 0 : initial_simplex_scale,
+                                                &fdiff, psi, (int)(%(PATIENCE)r * (%(NMR_PARAMS)r+1)),
+                                                %(ALPHA)r, %(BETA)r, %(GAMMA)r, %(DELTA)r,
+                                                nmsimplex_scratch, &iterations%(TRACE_ARGUMENT)s);
+                    
+                    if(get_local_id(0) == 0){
+                        optimizer_state[0] = 1;
+                        for(uint i = 0; i < %(NMR_PARAMS)r + 1; i++){
+                            for(uint j = 0; j < %(NMR_PARAMS)r; j++){
+                                optimizer_state[1 + i * %(NMR_PARAMS)r + j] = 
+                                    vertices[i * %(NMR_PARAMS)r + j] - model_parameters[j];
+                            }
+                        }
+                    }
+                #else
+                    int return_code = lib_nmsimplex(%(NMR_PARAMS)r, model_parameters, data, initial_simplex_scale,
+                                                    &fdiff, psi, (int)(%(PATIENCE)r * (%(NMR_PARAMS)r+1)),
+                                                    %(ALPHA)r, %(BETA)r, %(GAMMA)r, %(DELTA)r,
+                                                    nmsimplex_scratch, &iterations%(TRACE_ARGUMENT)s);
+                #endif
+                
+                #if %(USE_STATISTICS)r
+                    if(get_local_id(0) == 0){
+                        *nmr_iterations = iterations;
+                    }
+                #endif
+                return return_code;
             }
         ''' % params, **kwargs)
 
+    def get_state_length(self):
+        """Get the length of the optimizer state per problem, used when ``use_state`` is set.
+
+        Returns:
+            int: the number of elements in the optimizer state of one problem
+        """
+        return 1 + (self._nmr_parameters + 1) * self._nmr_parameters
+
 
 class Powell(SimpleCLLibraryFromFile):
 
     def __init__(self, eval_func, nmr_parameters, patience=2, patience_line_search=None,
-                 reset_method='EXTRAPOLATED_POINT', **kwargs):
+                 reset_method='EXTRAPOLATED_POINT', use_state=False, use_statistics=False, trace=None, **kwargs):
         """The Powell CL implementation.
 
         Args:
@@ -202,29 +405,64 @@ class Powell(SimpleCLLibraryFromFile):
                 patience.
             reset_method (str): one of ``RESET_TO_IDENTITY`` or ``EXTRAPOLATED_POINT``. The method used to
                 reset the search directions every iteration.
+            use_state (boolean): if set, the function gets an additional argument
+                ``global mot_float_type* optimizer_state`` in which the search directions are loaded and stored,
+                allowing the optimization to be resumed. See :meth:`get_state_length` for the length of the
+                state per problem.
+            use_statistics (boolean): if set, the function gets an additional argument
+                ``global uint* nmr_iterations`` to which the number of iterations is written.
+            trace (OptimizerTrace): if given, the function gets the additional arguments of the trace, in which the
+                function value is recorded at the start of every iteration and on return.
         """
         dependencies = list(kwargs.get('dependencies', []))
         dependencies.append(eval_func)
+        if trace is not None:
+            dependencies.append(trace)
         kwargs['dependencies'] = dependencies
 
+        self._nmr_parameters = nmr_parameters
+
         params = {
             'FUNCTION_NAME': eval_func.get_cl_function_name(),
             'NMR_PARAMS': nmr_parameters,
             'RESET_METHOD': reset_method.upper(),
             'PATIENCE': patience,
-            'PATIENCE_LINE_SEARCH': patience if patience_line_search is None else patience_line_search
+            'PATIENCE_LINE_SEARCH': patience if patience_line_search is None else patience_line_search,
+            'USE_STATE': int(bool(use_state)),
+            'STATE_PARAMETER': ', global mot_float_type* optimizer_state' if use_state else '',
+            'USE_STATISTICS': int(bool(use_statistics)),
+            'STATISTICS_PARAMETER': ', global uint* nmr_iterations' if use_statistics else ''
         }
+        params.update(_get_trace_template_vars(trace))
+
+        parameters = [('local mot_float_type*', 'model_parameters'), ('void*', 'data')]
+        if use_state:
+            parameters.append(('global mot_float_type*', 'optimizer_state'))
+        if use_statistics:
+            parameters.append(('global uint*', 'nmr_iterations'))
+        if trace is not None:
+            parameters.extend(trace.get_trace_parameters())
+
         super().__init__(
-            'int', 'powell', [('local mot_float_type*', 'model_parameters'), ('void*', 'data')],
+            'int', 'powell', parameters,
             resource_filename('mot', 'data/opencl/powell.cl'),
             var_replace_dict=params, **kwargs)
 
+    def get_state_length(self):
+        """Get the length of the optimizer state per problem, used when ``use_state`` is set.
+
+        Returns:
+            int: the number of elements in the optimizer state of one problem
+        """
+        return 1 + self._nmr_parameters ** 2
+
 
 class Subplex(SimpleCLLibraryFromFile):
 
     def __init__(self, eval_func, nmr_parameters, patience=10,
                  patience_nmsimplex=100, alpha=1.0, beta=0.5, gamma=2.0, delta=0.5, scale=1.0, psi=0.001, omega=0.01,
-                 adaptive_scales=True, min_subspace_length='auto', max_subspace_length='auto', **kwargs):
+                 adaptive_scales=True, min_subspace_length='auto', max_subspace_length='auto', use_state=False,
+                 use_statistics=False, trace=None, **kwargs):
         """The Subplex optimization routines.
 
         Args:
@@ -256,10 +494,22 @@ class Subplex(SimpleCLLibraryFromFile):
                     beta  = 0.75 - 1.0 / (2 * n)
                     gamma = 1 + 2.0 / n
                     delta = 1 - 1.0 / n
+
+            use_state (boolean): if set, the function gets an additional argument
+                ``global mot_float_type* optimizer_state`` in which the step sizes and the last change in the
+                parameters are loaded and stored, allowing the optimization to be resumed.
+                See :meth:`get_state_length` for the length of the state per problem.
+            use_statistics (boolean): if set, the function gets an additional argument
+                ``global uint* nmr_iterations`` to which the number of iterations is written.
+            trace (OptimizerTrace): if given, the function gets the additional arguments of the trace, in which the
+                function value is recorded at the start and after every iteration. Since this method does not
+                track the function value, this costs one additional function evaluation per iteration.
         """
         dependencies = list(kwargs.get('dependencies', []))
         dependencies.append(eval_func)
         dependencies.append(LibNMSimplex('subspace_evaluate'))
+        if trace is not None:
+            dependencies.append(trace)
         kwargs['dependencies'] = dependencies
 
         params = {
@@ -275,35 +525,72 @@ class Subplex(SimpleCLLibraryFromFile):
             'NMR_PARAMS': nmr_parameters,
             'ADAPTIVE_SCALES': int(bool(adaptive_scales)),
             'MIN_SUBSPACE_LENGTH': (min(2, nmr_parameters) if min_subspace_length == 'auto' else min_subspace_length),
-            'MAX_SUBSPACE_LENGTH': (min(5, nmr_parameters) if max_subspace_length == 'auto' else max_subspace_length)
+            'MAX_SUBSPACE_LENGTH': (min(5, nmr_parameters) if max_subspace_length == 'auto' else max_subspace_length),
+            'USE_STATE': int(bool(use_state)),
+            'STATE_PARAMETER': ', global mot_float_type* optimizer_state' if use_state else '',
+            'STATE_ARGUMENT': ', optimizer_state' if use_state else '',
+            'USE_STATISTICS': int(bool(use_statistics)),
+            'STATISTICS_PARAMETER': ', global uint* nmr_iterations' if use_statistics else '',
+            'STATISTICS_ARGUMENT': ', nmr_iterations' if use_statistics else ''
         }
+        params.update(_get_trace_template_vars(trace))
+        self._nmr_parameters = nmr_parameters
 
         s = ''
         for ind in range(nmr_parameters):
             s += 'initial_simplex_scale[{}] = {};'.format(ind, scale)
         params['INITIAL_SIMPLEX_SCALES'] = s
 
+        parameters = [('local mot_float_type* const', 'model_parameters'), ('void*', 'data')]
+        if use_state:
+            parameters.append(('global mot_float_type*', 'optimizer_state'))
+        if use_statistics:
+            parameters.append(('global uint*', 'nmr_iterations'))
+        if trace is not None:
+            parameters.extend(trace.get_trace_parameters())
+
         super().__init__(
-            'int', 'subplex', [('local mot_float_type* const', 'model_parameters'), ('void*', 'data')],
+            'int', 'subplex', parameters,
             resource_filename('mot', 'data/opencl/subplex.cl'), var_replace_dict=params, **kwargs)
 
+    def get_state_length(self):
+        """Get the length of the optimizer state per problem, used when ``use_state`` is set.
+
+        Returns:
+            int: the number of elements in the optimizer state of one problem
+        """
+        return 1 + 2 * self._nmr_parameters
+
 
 class LevenbergMarquardt(SimpleCLLibraryFromFile):
 
     def __init__(self, eval_func, nmr_parameters, nmr_observations, patience=250,
-                 step_bound=100.0, scale_diag=1, usertol_mult=30, jacobian_func=None, **kwargs):
-        """The Powell CL implementation.
+                 step_bound=100.0, scale_diag=1, usertol_mult=30, jacobian_func=None, use_state=False,
+                 use_statistics=False, trace=None, **kwargs):
+        """The Levenberg-Marquardt CL implementation.
 
         Args:
             eval_func (mot.lib.cl_function.CLFunction): the function we want to optimize, Should be of signature:
                 ``void evaluate(local mot_float_type* x, void* data_void, local mot_float_type* result);``
             nmr_parameters (int): the number of parameters in the model, this will be hardcoded in the method
-            patience (int): the patience of the Powell algorithm
-            patience_line_search (int): the patience of the line search algorithm
-            reset_method (str): one of ``RESET_TO_IDENTITY`` or ``EXTRAPOLATED_POINT``. The method used to
-                reset the search directions every iteration.
-            jacobian_func (mot.lib.cl_function.CLFunction or None): the function used to compute the Jacobian.
-                If not given, we will use a numerical differentiation
+            nmr_observations (int): the number of observations returned by the evaluation function
+            patience (int): the patience of the Levenberg-Marquardt algorithm, the maximum number of function
+                evaluations is ``patience * (nmr_parameters + 1)``.
+            step_bound (float): used to determine the initial step bound, generally 100.0 is recommended.
+            scale_diag (boolean): if the variables should be rescaled internally.
+            usertol_mult (float): the tolerances of the stopping criteria as a multiple of the machine precision.
+            jacobian_func (mot.lib.cl_function.CLFunction or None): the function used to compute the Jacobian,
+                see :func:`mot.optimize.minimize` for its signature. If not given, we will use a numerical
+                differentiation.
+            use_state (boolean): if set, the function gets an additional argument
+                ``global mot_float_type* optimizer_state`` in which the variable scalings (``diag``), the step bound
+                and the Levenberg-Marquardt parameter are loaded and stored, allowing the optimization to be resumed.
+                See :meth:`get_state_length` for the length of the state per problem.
+            use_statistics (boolean): if set, the function gets an additional argument
+                ``global uint* nmr_iterations`` to which the number of iterations, i.e. the number of Jacobian
+                evaluations, is written.
+            trace (OptimizerTrace): if given, the function gets the additional arguments of the trace, in which the
+                sum of squares is recorded at the start of every iteration and on return.
         """
         if not jacobian_func:
             jacobian_func = self._get_numerical_jacobian_func(eval_func.get_cl_function_name(),
@@ -311,6 +598,8 @@ class LevenbergMarquardt(SimpleCLLibraryFromFile):
         dependencies = list(kwargs.get('dependencies', []))
         dependencies.append(eval_func)
         dependencies.append(jacobian_func)
+        if trace is not None:
+            dependencies.append(trace)
         kwargs['dependencies'] = dependencies
 
         var_replace_dict = {
@@ -321,16 +610,38 @@ class LevenbergMarquardt(SimpleCLLibraryFromFile):
             'NMR_OBSERVATIONS': nmr_observations,
             'SCALE_DIAG': int(bool(scale_diag)),
             'STEP_BOUND': step_bound,
-            'USERTOL_MULT': usertol_mult
+            'USERTOL_MULT': usertol_mult,
+            'USE_STATE': int(bool(use_state)),
+            'STATE_PARAMETER': ', global mot_float_type* optimizer_state' if use_state else '',
+            'USE_STATISTICS': int(bool(use_statistics)),
+            'STATISTICS_PARAMETER': ', global uint* nmr_iterations' if use_statistics else ''
         }
+        var_replace_dict.update(_get_trace_template_vars(trace))
+        self._nmr_parameters = nmr_parameters
+
+        parameters = [('local mot_float_type* const', 'model_parameters'),
+                      ('void*', 'data'),
+                      ('global mot_float_type*', 'fjac')]
+        if use_state:
+            parameters.append(('global mot_float_type*', 'optimizer_state'))
+        if use_statistics:
+            parameters.append(('global uint*', 'nmr_iterations'))
+        if trace is not None:
+            parameters.extend(trace.get_trace_parameters())
 
         super().__init__(
-            'int', 'lmmin', [('local mot_float_type* const', 'model_parameters'),
-                             ('void*', 'data'),
-                             ('global mot_float_type*', 'fjac')],
+            'int', 'lmmin', parameters,
             resource_filename('mot', 'data/opencl/lmmin.cl'),
             var_replace_dict=var_replace_dict, **kwargs)
 
+    def get_state_length(self):
+        """Get the length of the optimizer state per problem, used when ``use_state`` is set.
+
+        Returns:
+            int: the number of elements in the optimizer state of one problem
+        """
+        return 3 + self._nmr_parameters
+
     def _get_numerical_jacobian_func(self, function_name, nmr_params, nmr_observations):
         return SimpleCLFunction.from_string(r'''
             void compute_jacobian(local mot_float_type* model_parameters,
@@ -376,3 +687,337 @@ class LevenbergMarquardt(SimpleCLLibraryFromFile):
                 }
             }
         ''' % dict(FUNCTION_NAME=function_name, NMR_PARAMS=nmr_params, NMR_OBSERVATIONS=nmr_observations))
+
+
+class LBFGS(SimpleCLLibraryFromFile):
+
+    def __init__(self, eval_func, nmr_parameters, patience=100, patience_line_search=20, history_length=10,
+                 gradient_tolerance=1e-5, gradient_func=None, use_state=False, use_statistics=False, trace=None,
+                 **kwargs):
+        """The limited-memory BFGS CL implementation.
+
+        Args:
+            eval_func (mot.lib.cl_function.CLFunction): the function we want to optimize, Should be of signature:
+                ``double evaluate(local mot_float_type* x, void* data_void);``
+            nmr_parameters (int): the number of parameters in the model, this will be hardcoded in the method
+            patience (int): the patience of the L-BFGS algorithm
+            patience_line_search (int): the maximum number of step halvings in the backtracking line search
+            history_length (int): the number of parameter and gradient differences kept in local memory
+            gradient_tolerance (float): stop if the largest gradient element is below this tolerance,
+                relative to the function value.
+            gradient_func (mot.lib.cl_function.CLFunction or None): the function used to compute the gradient,
+                of signature: ``void gradient(local mot_float_type* x, void* data_void,
+                local mot_float_type* gradient);``. This is called by all work items. If not given, we use
+                central differences.
+            use_state (boolean): if set, the function gets an additional argument
+                ``global mot_float_type* optimizer_state`` in which the history is loaded and stored,
+                allowing the optimization to be resumed. See :meth:`get_state_length` for the length of the
+                state per problem.
+            use_statistics (boolean): if set, the function gets an additional argument
+                ``global uint* nmr_iterations`` to which the number of iterations is written.
+            trace (OptimizerTrace): if given, the function gets the additional arguments of the trace, in which the
+                function value is recorded at the start of every iteration and on return.
+        """
+        dependencies = list(kwargs.get('dependencies', []))
+        dependencies.append(eval_func)
+        if gradient_func:
+            dependencies.append(gradient_func)
+        if trace is not None:
+            dependencies.append(trace)
+        kwargs['dependencies'] = dependencies
+
+        self._nmr_parameters = nmr_parameters
+        self._history_length = history_length
+
+        params = {
+            'FUNCTION_NAME': eval_func.get_cl_function_name(),
+            'GRADIENT_FUNCTION_NAME': gradient_func.get_cl_function_name() if gradient_func else '',
+            'USE_GRADIENT_FUNCTION': int(bool(gradient_func)),
+            'NMR_PARAMS': nmr_parameters,
+            'PATIENCE': patience,
+            'PATIENCE_LINE_SEARCH': patience_line_search,
+            'HISTORY_LENGTH': history_length,
+            'GRADIENT_TOLERANCE': gradient_tolerance,
+            'USE_STATE': int(bool(use_state)),
+            'STATE_PARAMETER': ', global mot_float_type* optimizer_state' if use_state else '',
+            'USE_STATISTICS': int(bool(use_statistics)),
+            'STATISTICS_PARAMETER': ', global uint* nmr_iterations' if use_statistics else ''
+        }
+        params.update(_get_trace_template_vars(trace))
+
+        parameters = [('local mot_float_type*', 'model_parameters'), ('void*', 'data')]
+        if use_state:
+            parameters.append(('global mot_float_type*', 'optimizer_state'))
+        if use_statistics:
+            parameters.append(('global uint*', 'nmr_iterations'))
+        if trace is not None:
+            parameters.extend(trace.get_trace_parameters())
+
+        super().__init__(
+            'int', 'lbfgs', parameters,
+            resource_filename('mot', 'data/opencl/lbfgs.cl'),
+            var_replace_dict=params, **kwargs)
+
+    def get_state_length(self):
+        """Get the length of the optimizer state per problem, used when ``use_state`` is set.
+
+        Returns:
+            int: the number of elements in the optimizer state of one problem
+        """
+        return 3 + 2 * self._history_length * self._nmr_parameters
+
+
+class DifferentialEvolution(SimpleCLLibraryFromFile):
+
+    def __init__(self, eval_func, nmr_parameters, patience=50, population_size='auto', mutation=0.8, crossover=0.9,
+                 strategy='rand1bin', tolerance=0.01, scale=1.0, polish_func=None, use_state=False,
+                 use_statistics=False, trace=None, **kwargs):
+        """The Differential Evolution CL implementation.
+
+        The resulting function gets an additional argument ``global uint* rng_state``, holding six random
+        integers per problem which are used to seed the random number generator.
+
+        Args:
+            eval_func (mot.lib.cl_function.CLFunction): the function we want to optimize, Should be of signature:
+                ``double evaluate(local mot_float_type* x, void* data_void);``
+            nmr_parameters (int): the number of parameters in the model, this will be hardcoded in the method
+            patience (int): the patience of the algorithm, the maximum number of generations is set to
+                patience * (nmr_parameters + 1).
+            population_size (int or str): the number of members in the population, at least four. If 'auto', we use
+                ten members per parameter, clipped to the range [5, 100]. The population is kept in local memory.
+            mutation (float): the scale factor of the difference vector
+            crossover (float): the probability of taking a parameter from the mutated member
+            strategy (str): one of ``rand1bin`` or ``best1bin``, the base member for the mutation is either a random
+                member or the best member.
+            tolerance (float): stop if the standard deviation of the function values in the population is at most
+                this tolerance times the mean function value.
+            scale (float): the initial population is drawn uniformly around the starting point, within
+                ``scale * max(|x|, 1)`` of every parameter.
+            polish_func (mot.lib.cl_function.CLFunction or None): the optimization routine used to polish the best
+                member, called by all work items. Its first two parameters should be the model parameters and the
+                data, its other parameters are added to the parameters of this function. If given, the return code
+                of this routine is returned.
+            use_state (boolean): if set, the function gets an additional argument
+                ``global mot_float_type* optimizer_state`` in which the population is loaded and stored,
+                allowing the optimization to be resumed. See :meth:`get_state_length` for the length of the
+                state per problem.
+            use_statistics (boolean): if set, the function gets an additional argument
+                ``global uint* nmr_iterations`` to which the number of generations is written.
+            trace (OptimizerTrace): if given, the function gets the additional arguments of the trace, in which the
+                function value of the best member is recorded at the start of every generation and on return.
+        """
+        if population_size == 'auto':
+            population_size = min(max(10 * nmr_parameters, 5), 100)
+        if population_size < 4:
+            raise ValueError('The population size should be at least four, {} given.'.format(population_size))
+        if strategy not in ('rand1bin', 'best1bin'):
+            raise ValueError('The strategy should be one of "rand1bin" or "best1bin", "{}" given.'.format(strategy))
+
+        dependencies = list(kwargs.get('dependencies', []))
+        dependencies.append(Rand123())
+        dependencies.append(eval_func)
+        if polish_func:
+            dependencies.append(polish_func)
+        if trace is not None:
+            dependencies.append(trace)
+        kwargs['dependencies'] = dependencies
+
+        self._nmr_parameters = nmr_parameters
+        self._population_size = population_size
+
+        polish_parameters = [(p.data_type.get_declaration(), p.name)
+                             for p in (polish_func.get_parameters()[2:] if polish_func else [])]
+
+        params = {
+            'FUNCTION_NAME': eval_func.get_cl_function_name(),
+            'POLISH_FUNCTION_NAME': polish_func.get_cl_function_name() if polish_func else '',
+            'USE_POLISH': int(bool(polish_func)),
+            'POLISH_PARAMETER': ''.join(', {} {}'.format(ctype, name) for ctype, name in polish_parameters),
+            'POLISH_ARGUMENT': ''.join(', {}'.format(name) for ctype, name in polish_parameters),
+            'NMR_PARAMS': nmr_parameters,
+            'PATIENCE': patience,
+            'POPULATION_SIZE': population_size,
+            'MUTATION': mutation,
+            'CROSSOVER': crossover,
+            'STRATEGY': strategy.upper(),
+            'TOLERANCE': tolerance,
+            'SCALE': scale,
+            'USE_STATE': int(bool(use_state)),
+            'STATE_PARAMETER': ', global mot_float_type* optimizer_state' if use_state else '',
+            'STATE_ARGUMENT': ', optimizer_state' if use_state else '',
+            'USE_STATISTICS': int(bool(use_statistics)),
+            'STATISTICS_PARAMETER': ', global uint* nmr_iterations' if use_statistics else ''
+        }
+        params.update(_get_trace_template_vars(trace))
+
+        parameters = [('local mot_float_type*', 'model_parameters'), ('void*', 'data'), ('global uint*', 'rng_state')]
+        if use_state:
+            parameters.append(('global mot_float_type*', 'optimizer_state'))
+        if use_statistics:
+            parameters.append(('global uint*', 'nmr_iterations'))
+        parameters.extend(polish_parameters)
+        if trace is not None:
+            parameters.extend(trace.get_trace_parameters())
+
+        super().__init__(
+            'int', 'differential_evolution', parameters,
+            resource_filename('mot', 'data/opencl/differential_evolution.cl'),
+            var_replace_dict=params, **kwargs)
+
+    def get_state_length(self):
+        """Get the length of the optimizer state per problem, used when ``use_state`` is set.
+
+        Returns:
+            int: the number of elements in the optimizer state of one problem
+        """
+        return 2 + self._population_size * self._nmr_parameters
+
+
+class CMAES(SimpleCLLibraryFromFile):
+
+    def __init__(self, eval_func, nmr_parameters, patience=100, population_size='auto', nmr_restarts=2, scale=1.0,
+                 use_state=False, use_statistics=False, trace=None, **kwargs):
+        """The CMA-ES CL implementation, with restarts using an increasing population size (IPOP).
+
+        The resulting function gets an additional argument ``global uint* rng_state``, holding six random
+        integers per problem which are used to seed the random number generator.
+
+        Args:
+            eval_func (mot.lib.cl_function.CLFunction): the function we want to optimize, Should be of signature:
+                ``double evaluate(local mot_float_type* x, void* data_void);``
+            nmr_parameters (int): the number of parameters in the model, this will be hardcoded in the method
+            patience (int): the patience of the algorithm, the maximum number of generations per run is set to
+                patience * (nmr_parameters + 1).
+            population_size (int or str): the number of candidates per generation in the first run, at least four.
+                If 'auto', we use ``4 + floor(3 * ln(nmr_parameters))``.
+            nmr_restarts (int): the maximum number of restarts, every restart doubles the population size.
+                The candidates of the largest population are kept in local memory.
+            scale (float): the initial step size. The initial distribution has a standard deviation of
+                ``scale * max(|x|, 1)`` for every parameter.
+            use_state (boolean): if set, the function gets an additional argument
+                ``global mot_float_type* optimizer_state`` in which the distribution is loaded and stored,
+                allowing the optimization to be resumed. See :meth:`get_state_length` for the length of the
+                state per problem.
+            use_statistics (boolean): if set, the function gets an additional argument
+                ``global uint* nmr_iterations`` to which the number of generations is written.
+            trace (OptimizerTrace): if given, the function gets the additional arguments of the trace, in which the
+                best function value is recorded at the start of every generation and on return.
+        """
+        if population_size == 'auto':
+            population_size = 4 + int(math.floor(3 * math.log(nmr_parameters)))
+        if population_size < 4:
+            raise ValueError('The population size should be at least four, {} given.'.format(population_size))
+
+        dependencies = list(kwargs.get('dependencies', []))
+        dependencies.append(Rand123())
+        dependencies.append(EigenSymmetric(memspace='local', memtype='mot_float_type'))
+        dependencies.append(eval_func)
+        if trace is not None:
+            dependencies.append(trace)
+        kwargs['dependencies'] = dependencies
+
+        self._nmr_parameters = nmr_parameters
+
+        params = {
+            'FUNCTION_NAME': eval_func.get_cl_function_name(),
+            'NMR_PARAMS': nmr_parameters,
+            'PATIENCE': patience,
+            'POPULATION_SIZE': population_size,
+            'NMR_RESTARTS': nmr_restarts,
+            'SCALE': scale,
+            'USE_STATE': int(bool(use_state)),
+            'STATE_PARAMETER': ', global mot_float_type* optimizer_state' if use_state else '',
+            'USE_STATISTICS': int(bool(use_statistics)),
+            'STATISTICS_PARAMETER': ', global uint* nmr_iterations' if use_statistics else ''
+        }
+        params.update(_get_trace_template_vars(trace))
+
+        parameters = [('local mot_float_type*', 'model_parameters'), ('void*', 'data'), ('global uint*', 'rng_state')]
+        if use_state:
+            parameters.append(('global mot_float_type*', 'optimizer_state'))
+        if use_statistics:
+            parameters.append(('global uint*', 'nmr_iterations'))
+        if trace is not None:
+            parameters.extend(trace.get_trace_parameters())
+
+        super().__init__(
+            'int', 'cmaes', parameters,
+            resource_filename('mot', 'data/opencl/cmaes.cl'),
+            var_replace_dict=params, **kwargs)
+
+    def get_state_length(self):
+        """Get the length of the optimizer state per problem, used when ``use_state`` is set.
+
+        Returns:
+            int: the number of elements in the optimizer state of one problem
+        """
+        return 4 + 3 * self._nmr_parameters + self._nmr_parameters ** 2
+
+
+class DualNumbers(SimpleCLLibraryFromFile):
+
+    def __init__(self, nmr_parameters):
+        """Dual numbers for forward mode automatic differentiation.
+
+        This defines the ``mot_dual`` type, holding a value ``v`` and its gradient ``d`` with respect to all the
+        model parameters, and the arithmetic on it, ``dual_add``, ``dual_sub``, ``dual_mul``, ``dual_div``,
+        ``dual_add_scalar``, ``dual_mul_scalar``, ``dual_neg``, ``dual_exp``, ``dual_log``, ``dual_sqrt``,
+        ``dual_pow``, ``dual_sin`` and ``dual_cos``. Use ``dual_constant`` and ``dual_variable`` to create dual
+        numbers for constants and model parameters.
+
+        Args:
+            nmr_parameters (int): the number of model parameters, i.e. the length of the gradient.
+        """
+        super().__init__(
+            'mot_dual', 'dual_variable', [('double', 'value'), ('uint', 'index')],
+            resource_filename('mot', 'data/opencl/dual_numbers.cl'),
+            var_replace_dict={'NMR_PARAMS': nmr_parameters})
+
+
+class DualNumberJacobian(SimpleCLLibrary):
+
+    def __init__(self, residual_func, nmr_parameters, nmr_observations):
+        """Generate the Jacobian function for the Levenberg-Marquardt routine using dual numbers.
+
+        Instead of a forward difference approximation, which requires one additional model evaluation per
+        parameter, this evaluates the residuals once using dual numbers (see :class:`DualNumbers`) to get
+        the exact derivatives with respect to all parameters. The observations are divided over the work items.
+
+        The residual function should be written using the dual number arithmetic and should have the signature:
+
+        .. code-block:: c
+
+            mot_dual <func_name>(const mot_dual* const x, void* data, uint observation_index);
+
+        returning the residual of a single observation.
+
+        Args:
+            residual_func (mot.lib.cl_function.CLFunction): the residual function, written using dual numbers
+            nmr_parameters (int): the number of parameters in the model
+            nmr_observations (int): the number of observations
+        """
+        super().__init__('''
+            void dual_jacobian_%(FUNCTION_NAME)s(local mot_float_type* model_parameters,
+                                                 void* data,
+                                                 local mot_float_type* fvec,
+                                                 global mot_float_type* const fjac,
+                                                 local mot_float_type* scratch){
+                mot_dual x[%(NMR_PARAMS)s];
+                mot_dual residual;
+
+                for(uint j = 0; j < %(NMR_PARAMS)s; j++){
+                    x[j] = dual_variable(model_parameters[j], j);
+                }
+
+                for(uint i = get_local_id(0); i < %(NMR_OBSERVATIONS)s; i += get_local_size(0)){
+                    residual = %(FUNCTION_NAME)s(x, data, i);
+
+                    for(uint j = 0; j < %(NMR_PARAMS)s; j++){
+                        fjac[j * %(NMR_OBSERVATIONS)s + i] = residual.d[j];
+                    }
+                }
+                barrier(CLK_GLOBAL_MEM_FENCE);
+            }
+        ''' % dict(FUNCTION_NAME=residual_func.get_cl_function_name(), NMR_PARAMS=nmr_parameters,
+                   NMR_OBSERVATIONS=nmr_observations),
+            dependencies=[DualNumbers(nmr_parameters), residual_func])
@@ -1,8 +1,17 @@
-from mot.lib.cl_function import SimpleCLFunction
+import itertools
+import warnings
+from functools import partial
+from numbers import Number
+import numpy as np
+from mot.cl_routines.numerical_hessian import _get_compute_functions_cl, _get_extrapolation_functions_cl, \
+    _get_nmr_richardson_convolutions
+from mot.lib.cl_function import SimpleCLFunction, _ProcedureRunner
 from mot.configuration import CLRuntimeInfo
-from mot.lib.kernel_data import Array, Zeros
-from mot.library_functions import Powell, Subplex, NMSimplex, LevenbergMarquardt
+from mot.lib.kernel_data import Array, Zeros, Struct
+from mot.library_functions import Powell, Subplex, NMSimplex, LevenbergMarquardt, LBFGS, DifferentialEvolution, \
+    CMAES, OptimizerTrace, CholeskyInverse
 from mot.optimize.base import OptimizeResults
+from mot.lib.utils import hessian_to_covariance
 
 __author__ = 'Robbert Harms'
 __date__ = '2018-08-01'
@@ -11,7 +20,11 @@ __email__ = 'robbert.harms@maastrichtuniversity.nl'
 __licence__ = 'LGPL v3'
 
 
-def minimize(func, x0, data=None, method=None, nmr_observations=None, cl_runtime_info=None, options=None):
+def minimize(func, x0, data=None, method=None, nmr_observations=None, cl_runtime_info=None, options=None,
+             nmr_rounds=1, nmr_starts=None, start_generator='random', start_bounds=None, jacobian_func=None,
+             initial_state=None, return_state=False, gradient_func=None, lower_bounds=None, upper_bounds=None,
+             bounds_transform='cos-sqr', return_statistics=False, trace=False, trace_problems=None, trace_length=100,
+             trace_x=False):
     """Minimization of scalar function of one or more variables.
 
     Args:
@@ -28,7 +41,9 @@ def minimize(func, x0, data=None, method=None, nmr_observations=None, cl_runtime
             and will be squared by the least-square optimizer. This is only used by the ``Levenberg-Marquardt`` routine.
 
         x0 (ndarray): Initial guess. Array of real elements of size (n, p), for 'n' problems and 'p'
-            independent variables.
+            independent variables. Alternatively, provide a matrix of size (n, k, p) with 'k' starting points
+            per problem. All starting points are then optimized in one kernel launch, after which the solution
+            with the lowest objective function value is returned per problem.
         data (mot.lib.kernel_data.KernelData): the kernel data we will load. This is returned to the likelihood function
             as the ``void* data`` pointer.
         method (str): Type of solver.  Should be one of:
@@ -36,19 +51,205 @@ def minimize(func, x0, data=None, method=None, nmr_observations=None, cl_runtime
             - 'Nelder-Mead'
             - 'Powell'
             - 'Subplex'
+            - 'L-BFGS'
+            - 'DifferentialEvolution'
+            - 'CMA-ES'
 
             If not given, defaults to 'Powell'.
 
         nmr_observations (int): the number of observations returned by the optimization function.
-            This is only needed for the ``Levenberg-Marquardt`` method.
+            This is only needed for the ``Levenberg-Marquardt`` method, and for the ``DifferentialEvolution`` method
+            if it is polished with the ``Levenberg-Marquardt`` method.
         cl_runtime_info (mot.configuration.CLRuntimeInfo): the CL runtime information
         options (dict): A dictionary of solver options. All methods accept the following generic options:
                 patience (int): Maximum number of iterations to perform.
+        nmr_rounds (int): the maximum number of rounds to run the optimizer. After each round, only the problems
+            that ran out of patience (return code 6) are relaunched, starting from their current position.
+            The other problems are left out of the next kernel launch, such that the work items are spent
+            on the problems that still need it. With multiple rounds, the patience acts as the per-round limit on
+            the number of iterations.
+        nmr_starts (int): if given, we generate this many starting points per problem using the
+            ``start_generator``, where the first starting point is always the given ``x0``.
+            Only used if ``x0`` is a matrix of (n, p).
+        start_generator (str or Callable): the method used to generate the additional starting points. Either
+            'random' for uniformly distributed points, 'sobol' for a scrambled Sobol sequence (requires SciPy's
+            ``scipy.stats.qmc`` module) or a callable. The 'random' and 'sobol' generators sample points within
+            the ``start_bounds``. A callable is called as ``start_generator(x0, nmr_starts)`` and should return a
+            matrix of (n, nmr_starts, p).
+        start_bounds (tuple): the lower and upper bounds for the 'random' and 'sobol' start generators, each a
+            scalar, a vector of length p or a matrix of size (n, p).
+        jacobian_func (mot.lib.cl_function.CLFunction): the function computing the Jacobian of the objective list,
+            only used by the ``Levenberg-Marquardt`` routine. If not given, we use a forward difference
+            approximation. This should have the signature:
+
+            .. code-block:: c
+
+                void <func_name>(local mot_float_type* x,
+                                 void* data,
+                                 local mot_float_type* fvec,
+                                 global mot_float_type* const fjac,
+                                 local mot_float_type* scratch);
+
+            and should fill ``fjac``, a (p, m) matrix for 'p' parameters and 'm' observations, with the derivatives
+            of the objective list (provided in ``fvec``) with respect to the parameters. The scratch array holds
+            room for 'm' values. See :class:`mot.library_functions.DualNumberJacobian` for generating this
+            function using automatic differentiation.
+        initial_state (ndarray): the optimizer state to resume from, as returned in the ``state`` element of the
+            results of a previous call with ``return_state`` set. This contains the internal state of the
+            optimization routine per problem, for example the Powell search directions or the Nelder-Mead simplex,
+            allowing warm-starts of refits and resuming checkpointed optimizations. The state must come from
+            the same method with the same number of parameters. Rows of which the first element is zero
+            are started cold.
+        return_state (boolean): if set, the results contain the optimizer state per problem in the element ``state``.
+        gradient_func (mot.lib.cl_function.CLFunction): the function computing the gradient of the objective function,
+            only used by the ``L-BFGS`` routine. If not given, we use a central difference approximation.
+            This should have the signature:
+
+            .. code-block:: c
+
+                void <func_name>(local mot_float_type* x,
+                                 void* data,
+                                 local mot_float_type* gradient);
+
+            and should fill ``gradient`` with the derivatives of the objective function with respect to the
+            parameters. It is called by all work items of a work group.
+        lower_bounds (scalar or ndarray): the lower bounds of the parameters, a scalar, a vector of length p or
+            a matrix of size (n, p). Use -inf (or None in a vector) for parameters without a lower bound.
+        upper_bounds (scalar or ndarray): the upper bounds of the parameters, with the same options as the
+            ``lower_bounds``. Use inf (or None in a vector) for parameters without an upper bound.
+        bounds_transform (str): the transformation used for parameters with both a lower and an upper bound,
+            one of 'cos-sqr' or 'sigmoid'. Parameters with only a lower or an upper bound use a softplus
+            transformation. The optimization routine then operates on unbounded parameters, which are transformed
+            to the bounded model parameters before every evaluation of the objective function. The
+            ``Levenberg-Marquardt`` routine, also when used for polishing the ``DifferentialEvolution`` method,
+            instead projects the parameters onto the bounds. The results are always returned in the original,
+            bounded, parameter space.
+        return_statistics (boolean): if set, the results also contain per problem the number of iterations
+            (``nmr_iterations``), the number of objective function evaluations (``nmr_function_evaluations``) and
+            the objective function value at the solution (``objective_value``). These are gathered by the optimization
+            kernel itself, in the same launch. With multiple starting points or rounds, the counts are summed over
+            all of them.
+        trace (boolean): if set, record the convergence trace of all problems, see ``trace_problems``.
+        trace_problems (ndarray): the indices of the problems for which we record the convergence trace. If given,
+            the optimization kernel records the objective function value at every (outer) iteration of these problems
+            into a ring buffer on the device, which is read back once at the end. The results then contain the
+            indices of the traced problems (``trace_problems``), the number of recorded iterations per traced problem
+            (``trace_nmr_entries``) and the last ``trace_length`` objective function values per traced problem
+            (``trace_objective``), from the oldest to the newest, padded with NaN. The traced problems are run
+            in a separate kernel launch, such that the other problems run without the tracing overhead.
+        trace_length (int): the size of the ring buffer per traced problem
+        trace_x (boolean): if set, the trace also records the parameters at every iteration, returned in
+            the results as ``trace_x``, a matrix of (t, trace_length, p) for 't' traced problems.
 
     Returns:
         mot.optimize.base.OptimizeResults:
             The optimization result represented as a ``OptimizeResult`` object.
-            Important attributes are: ``x`` the solution array.
+            Important attributes are: ``x`` the solution array and ``status`` the return codes.
+            If ``return_state`` is set, ``state`` holds the optimizer state per problem.
+            If ``return_statistics`` is set, the results also hold the optimization statistics.
+            If tracing is enabled, the results also hold the convergence trace.
+    """
+    if not method:
+        method = 'Powell'
+
+    cl_runtime_info = cl_runtime_info or CLRuntimeInfo()
+
+    if len(x0.shape) < 2:
+        x0 = x0[..., None]
+
+    if nmr_starts is not None and nmr_starts > 1 and len(x0.shape) == 2:
+        x0 = _generate_starting_points(x0, nmr_starts, start_generator, start_bounds)
+
+    if len(x0.shape) == 3 and (initial_state is not None or return_state):
+        raise ValueError('The optimizer state can not be used in combination with multiple starting points.')
+
+    bounds = None
+    if lower_bounds is not None or upper_bounds is not None:
+        bounds = _get_bounds(lower_bounds, upper_bounds, x0.shape[0], x0.shape[-1])
+        if method == 'Levenberg-Marquardt' or (method == 'DifferentialEvolution' and
+                                               (options or {}).get('polish') == 'Levenberg-Marquardt'):
+            bounds_transform = 'projection'
+
+        x0 = _bounds_to_optimization_space(x0, bounds, bounds_transform)
+        func, data, jacobian_func, gradient_func = _get_bounded_functions(
+            func, data, jacobian_func, gradient_func, bounds, bounds_transform, x0.shape[-1])
+
+    objective_func = None
+    if return_statistics:
+        func, objective_func, data, jacobian_func, gradient_func = _get_statistics_functions(
+            func, data, jacobian_func, gradient_func, x0.shape[0])
+
+    use_state = initial_state is not None or return_state or (nmr_rounds > 1 and len(x0.shape) == 2)
+    if trace and trace_problems is None:
+        trace_problems = np.arange(x0.shape[0])
+    if trace_problems is not None:
+        trace_problems = np.unique(trace_problems)
+
+    run_options = {'nmr_rounds': nmr_rounds, 'use_state': use_state, 'initial_state': initial_state,
+                   'use_statistics': return_statistics, 'objective_func': objective_func,
+                   'trace_problems': trace_problems, 'trace_length': trace_length, 'trace_x': trace_x}
+
+    results = _minimize_with_method(method, func, x0, nmr_observations, cl_runtime_info, data, options,
+                                    jacobian_func=jacobian_func, gradient_func=gradient_func, **run_options)
+
+    if bounds is not None:
+        results['x'] = _bounds_to_model_space(results['x'], bounds, bounds_transform)
+        if 'trace_x' in results:
+            results['trace_x'] = _bounds_to_model_space(
+                results['trace_x'], tuple(b[trace_problems] for b in bounds), bounds_transform)
+
+    if trace_problems is not None:
+        results['trace_problems'] = trace_problems
+
+    if return_statistics:
+        results['nmr_function_evaluations'] = data['nmr_function_evaluations'].get_data().astype(np.int64)
+
+    if not return_state:
+        results.pop('state', None)
+    return results
+
+
+def fit_with_uncertainty(func, x0, data=None, method=None, nmr_observations=None, cl_runtime_info=None,
+                         options=None, nmr_rounds=1, jacobian_func=None, gradient_func=None, step_ratio=2, nmr_steps=5,
+                         max_step_sizes=None):
+    """Minimize the objective function and compute the Hessian and covariance matrix at the solution.
+
+    This fuses the optimization, the evaluation of the objective function at the solution, the numerical Hessian
+    and the inversion of the Hessian into one kernel, such that the data is loaded on the device only once and
+    the solutions never leave the device in between. If the objective function is a negative log-likelihood,
+    the covariance matrix is the inverse of the Hessian.
+
+    The Hessian is computed using central differences with a Richardson extrapolation over ``nmr_steps`` decreasing
+    step sizes, see :func:`mot.cl_routines.numerical_hessian`. Per element of the Hessian, we use the
+    extrapolation with the smallest error estimate. The Wynn extrapolation and the outlier rejection of
+    :func:`~mot.cl_routines.numerical_hessian` are not applied, prefer that function if the Hessian needs to be
+    as accurate as possible. The Hessian is inverted using its Cholesky decomposition, Hessians that are not
+    positive definite, or that are ill-conditioned, fall back on :func:`mot.lib.utils.hessian_to_covariance` on the
+    host, see :func:`mot.cl_routines.compute_covariance`.
+
+    Args:
+        func (mot.lib.cl_function.CLFunction): the objective function, see :func:`minimize`
+        x0 (ndarray): the initial guess, a matrix of size (n, p) for 'n' problems and 'p' parameters.
+        data (mot.lib.kernel_data.KernelData): the kernel data we will load. This is returned to the objective
+            function as the ``void* data`` pointer.
+        method (str): the optimization method, see :func:`minimize`. If not given, defaults to 'Powell'.
+        nmr_observations (int): the number of observations returned by the objective function, see :func:`minimize`
+        cl_runtime_info (mot.configuration.CLRuntimeInfo): the CL runtime information
+        options (dict): the solver options, see :func:`minimize`
+        nmr_rounds (int): the maximum number of rounds to run the optimizer, see :func:`minimize`
+        jacobian_func (mot.lib.cl_function.CLFunction): the Jacobian of the objective list, see :func:`minimize`
+        gradient_func (mot.lib.cl_function.CLFunction): the gradient of the objective function,
+            see :func:`minimize`
+        step_ratio (float): the ratio at which the steps of the numerical Hessian diminish.
+        nmr_steps (int): the number of steps of the numerical Hessian.
+        max_step_sizes (float or ndarray or None): the maximum step size, or the maximum step size per parameter,
+            of the numerical Hessian. If None is given, we use 0.1 for all parameters.
+
+    Returns:
+        mot.optimize.base.OptimizeResults: the results with per problem the solution (``x``), the return
+            codes (``status``), the objective function value at the solution (``objective_value``), the Hessian
+            (``hessian``), the covariance matrix (``covariance``) and if the Hessian was singular
+            (``is_singular``).
     """
     if not method:
         method = 'Powell'
@@ -58,14 +259,93 @@ def minimize(func, x0, data=None, method=None, nmr_observations=None, cl_runtime
     if len(x0.shape) < 2:
         x0 = x0[..., None]
 
+    if len(x0.shape) == 3:
+        raise ValueError('The uncertainty can not be computed in combination with multiple starting points.')
+    if nmr_steps < 1:
+        raise ValueError('The number of steps should be at least one, {} given.'.format(nmr_steps))
+
+    nmr_problems, nmr_parameters = x0.shape
+    nmr_derivatives = nmr_parameters * (nmr_parameters + 1) // 2
+
+    if max_step_sizes is None:
+        max_step_sizes = 0.1
+    if isinstance(max_step_sizes, Number):
+        max_step_sizes = [max_step_sizes] * nmr_parameters
+
+    nmr_convolutions = _get_nmr_richardson_convolutions(nmr_steps)
+
+    uncertainty_data = {
+        'parameter_scalings_inv': Array(np.ones(nmr_parameters), ctype='float', offset_str='0'),
+        'initial_step': Array(np.array(max_step_sizes), ctype='float', offset_str='0'),
+        'step_evaluates': Zeros((nmr_problems, nmr_derivatives, nmr_steps), 'double', mode='rw'),
+        'richardson_extrapolations': Zeros((nmr_problems, nmr_derivatives, nmr_convolutions), 'double', mode='rw'),
+        'richardson_errors': Zeros((nmr_problems, nmr_derivatives, nmr_convolutions - 1), 'double', mode='rw'),
+        'objective_value': Zeros((nmr_problems,), 'double', mode='rw'),
+        'hessian': Zeros((nmr_problems, nmr_parameters, nmr_parameters), 'double', mode='rw'),
+        'covariance': Zeros((nmr_problems, nmr_parameters, nmr_parameters), 'double', mode='rw'),
+        'is_inverted': Zeros((nmr_problems,), 'uint', mode='rw')
+    }
+
+    def wrap_optimizer(optimizer_func):
+        return _get_uncertainty_optimizer(optimizer_func, func, nmr_parameters, step_ratio, nmr_steps), \
+               uncertainty_data
+
+    results = _minimize_with_method(method, func, x0, nmr_observations, cl_runtime_info, data, options,
+                                    jacobian_func=jacobian_func, gradient_func=gradient_func, nmr_rounds=nmr_rounds,
+                                    use_state=nmr_rounds > 1, wrap_optimizer=wrap_optimizer)
+    results.pop('state', None)
+
+    hessian = uncertainty_data['hessian'].get_data()
+    covariance = uncertainty_data['covariance'].get_data()
+    is_inverted = uncertainty_data['is_inverted'].get_data().astype(bool)
+    is_singular = np.zeros(nmr_problems, dtype=bool)
+    if np.any(~is_inverted):
+        covariance[~is_inverted], is_singular[~is_inverted] = hessian_to_covariance(
+            hessian[~is_inverted], output_singularity=True)
+
+    results['objective_value'] = uncertainty_data['objective_value'].get_data()
+    results['hessian'] = hessian
+    results['covariance'] = covariance
+    results['is_singular'] = is_singular
+    return results
+
+
+def _minimize_with_method(method, func, x0, nmr_observations, cl_runtime_info, data, options,
+                          jacobian_func=None, gradient_func=None, **run_options):
+    """Run the minimization routine of the given method.
+
+    Args:
+        method (str): the name of the method, see :func:`minimize`
+        func (mot.lib.cl_function.CLFunction): the objective function
+        x0 (ndarray): the starting points, a matrix of (n, p) or (n, k, p)
+        nmr_observations (int): the number of observations returned by the objective function
+        cl_runtime_info (mot.configuration.CLRuntimeInfo): the CL runtime information
+        data (mot.lib.kernel_data.KernelData): the user provided data for the ``void* data`` pointer
+        options (dict): the solver options
+        jacobian_func (mot.lib.cl_function.CLFunction): the Jacobian function, if any
+        gradient_func (mot.lib.cl_function.CLFunction): the gradient function, if any
+        **run_options: the run options, see :func:`_run_optimizer`
+
+    Returns:
+        mot.optimize.base.OptimizeResults: the optimization results
+    """
     if method == 'Powell':
-        return _minimize_powell(func, x0, cl_runtime_info, data, options)
+        return _minimize_powell(func, x0, cl_runtime_info, data, options, **run_options)
     elif method == 'Nelder-Mead':
-        return _minimize_nmsimplex(func, x0, cl_runtime_info, data, options)
+        return _minimize_nmsimplex(func, x0, cl_runtime_info, data, options, **run_options)
     elif method == 'Levenberg-Marquardt':
-        return _minimize_levenberg_marquardt(func, x0, nmr_observations, cl_runtime_info, data, options)
+        return _minimize_levenberg_marquardt(func, x0, nmr_observations, cl_runtime_info, data, options,
+                                             jacobian_func=jacobian_func, **run_options)
     elif method == 'Subplex':
-        return _minimize_subplex(func, x0, cl_runtime_info, data, options)
+        return _minimize_subplex(func, x0, cl_runtime_info, data, options, **run_options)
+    elif method == 'L-BFGS':
+        return _minimize_lbfgs(func, x0, cl_runtime_info, data, options, gradient_func=gradient_func,
+                               **run_options)
+    elif method == 'DifferentialEvolution':
+        return _minimize_differential_evolution(func, x0, nmr_observations, cl_runtime_info, data, options,
+                                                jacobian_func=jacobian_func, **run_options)
+    elif method == 'CMA-ES':
+        return _minimize_cmaes(func, x0, cl_runtime_info, data, options, **run_options)
     raise ValueError('Could not find the specified method "{}".'.format(method))
 
 
@@ -99,9 +379,362 @@ def get_minimizer_options(method):
                 'min_subspace_length': 'auto',
                 'max_subspace_length': 'auto'}
 
+    elif method == 'L-BFGS':
+        return {'patience': 100,
+                'patience_line_search': 20,
+                'history_length': 10,
+                'gradient_tolerance': 1e-5}
+
+    elif method == 'DifferentialEvolution':
+        return {'patience': 50,
+                'population_size': 'auto',
+                'mutation': 0.8, 'crossover': 0.9,
+                'strategy': 'rand1bin',
+                'tolerance': 0.01,
+                'scale': 1.0,
+                'polish': 'Powell',
+                'seed': None}
+
+    elif method == 'CMA-ES':
+        return {'patience': 100,
+                'population_size': 'auto',
+                'nmr_restarts': 2,
+                'scale': 1.0,
+                'seed': None}
+
     raise ValueError('Could not find the specified method "{}".'.format(method))
 
 
+def _generate_starting_points(x0, nmr_starts, start_generator, start_bounds):
+    """Generate multiple starting points per problem.
+
+    Args:
+        x0 (ndarray): the initial guess, a matrix of size (n, p)
+        nmr_starts (int): the number of starting points per problem, including the initial guess
+        start_generator (str or Callable): the method used to generate the starting points, one of 'random',
+            'sobol' or a callable.
+        start_bounds (tuple): the lower and upper bounds of the starting points for the 'random' and 'sobol' methods
+
+    Returns:
+        ndarray: a matrix of size (n, nmr_starts, p) with the starting points per problem
+    """
+    if callable(start_generator):
+        starts = np.asarray(start_generator(x0, nmr_starts))
+        if starts.shape != (x0.shape[0], nmr_starts, x0.shape[1]):
+            raise ValueError('The start generator should return a matrix of size {}, {} given.'.format(
+                (x0.shape[0], nmr_starts, x0.shape[1]), starts.shape))
+        return starts
+
+    if start_bounds is None:
+        raise ValueError('The "{}" start generator requires the start bounds.'.format(start_generator))
+
+    lower = np.broadcast_to(start_bounds[0], x0.shape)
+    upper = np.broadcast_to(start_bounds[1], x0.shape)
+
+    if start_generator == 'random':
+        samples = np.random.uniform(size=(x0.shape[0], nmr_starts - 1, x0.shape[1]))
+    elif start_generator == 'sobol':
+        from scipy.stats import qmc
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            samples = qmc.Sobol(x0.shape[1], scramble=True).random(nmr_starts - 1)
+        samples = np.broadcast_to(samples, (x0.shape[0],) + samples.shape)
+    else:
+        raise ValueError('The start generator "{}" is not supported.'.format(start_generator))
+
+    starts = lower[:, None, :] + samples * (upper - lower)[:, None, :]
+    return np.concatenate([x0[:, None, :], starts], axis=1)
+
+
+def _get_bounds(lower_bounds, upper_bounds, nmr_problems, nmr_parameters):
+    """Get the lower and upper bounds as matrices with a bound for every problem and parameter.
+
+    Args:
+        lower_bounds (scalar or ndarray): the lower bounds, None values are replaced by -inf
+        upper_bounds (scalar or ndarray): the upper bounds, None values are replaced by inf
+        nmr_problems (int): the number of problems
+        nmr_parameters (int): the number of parameters
+
+    Returns:
+        tuple: the lower and upper bounds, both matrices of size (n, p)
+    """
+    def get_matrix(bound, default):
+        if bound is None:
+            bound = default
+        bound = np.array(bound, dtype=np.float64)
+        bound[np.isnan(bound)] = default
+        return np.array(np.broadcast_to(bound, (nmr_problems, nmr_parameters)))
+
+    lower = get_matrix(lower_bounds, -np.inf)
+    upper = get_matrix(upper_bounds, np.inf)
+
+    if np.any(lower > upper):
+        raise ValueError('The lower bounds should be smaller than or equal to the upper bounds.')
+    return lower, upper
+
+
+def _bounds_to_model_space(x, bounds, transform):
+    """Transform the parameters from the unbounded optimization space to the bounded model space.
+
+    This is the Python equivalent of the CL transformation used in :func:`_get_bounded_functions`.
+
+    Args:
+        x (ndarray): the parameters in the optimization space, a matrix of (n, p) or (n, k, p)
+        bounds (tuple): the lower and upper bounds, both matrices of size (n, p)
+        transform (str): one of 'cos-sqr', 'sigmoid' or 'projection'
+
+    Returns:
+        ndarray: the parameters in the model space
+    """
+    lower, upper = (b if len(x.shape) == 2 else b[:, None, :] for b in bounds)
+
+    if transform == 'projection':
+        return np.clip(x, lower, upper)
+
+    has_lower = np.isfinite(lower)
+    has_upper = np.isfinite(upper)
+
+    with np.errstate(all='ignore'):
+        softplus = np.where(x > 30, x, np.log1p(np.exp(x)))
+
+        if transform == 'cos-sqr':
+            both = lower + (upper - lower) * np.cos(x) ** 2
+        else:
+            both = lower + (upper - lower) / (1 + np.exp(-x))
+
+        result = np.where(has_lower & has_upper, both,
+                          np.where(has_lower, lower + softplus,
+                                   np.where(has_upper, upper - softplus, x)))
+    return result
+
+
+def _bounds_to_optimization_space(x, bounds, transform):
+    """Transform the parameters from the bounded model space to the unbounded optimization space.
+
+    This is the inverse of :func:`_bounds_to_model_space`. Parameters outside of the bounds are first clipped to
+    the bounds.
+
+    Args:
+        x (ndarray): the parameters in the model space, a matrix of (n, p) or (n, k, p)
+        bounds (tuple): the lower and upper bounds, both matrices of size (n, p)
+        transform (str): one of 'cos-sqr', 'sigmoid' or 'projection'
+
+    Returns:
+        ndarray: the parameters in the optimization space
+    """
+    lower, upper = (b if len(x.shape) == 2 else b[:, None, :] for b in bounds)
+    x = np.clip(x, lower, upper)
+
+    if transform == 'projection':
+        return x
+
+    has_lower = np.isfinite(lower)
+    has_upper = np.isfinite(upper)
+    eps = np.finfo(np.float32).eps
+
+    def inverse_softplus(distance):
+        distance = np.maximum(distance, eps)
+        return np.where(distance > 30, distance, np.log(np.expm1(distance)))
+
+    with np.errstate(all='ignore'):
+        fraction = np.clip((x - lower) / (upper - lower), 0, 1)
+
+        if transform == 'cos-sqr':
+            both = np.arccos(np.sqrt(fraction))
+        else:
+            fraction = np.clip(fraction, eps, 1 - eps)
+            both = np.log(fraction / (1 - fraction))
+
+        result = np.where(has_lower & has_upper, np.where(upper > lower, both, 0),
+                          np.where(has_lower, inverse_softplus(x - lower),
+                                   np.where(has_upper, inverse_softplus(upper - x), x)))
+    return result
+
+
+def _get_bounded_functions(func, data, jacobian_func, gradient_func, bounds, transform, nmr_parameters):
+    """Wrap the objective function and its derivatives such that they operate on the unbounded parameters.
+
+    The wrappers transform the parameters to the bounded model space before calling the wrapped functions.
+    The bounds are loaded per problem, together with the original data, in a structure passed as the data pointer.
+
+    Args:
+        func (mot.lib.cl_function.CLFunction): the objective function
+        data (mot.lib.kernel_data.KernelData): the data of the objective function
+        jacobian_func (mot.lib.cl_function.CLFunction): the optional Jacobian function for the
+            ``Levenberg-Marquardt`` routine, this is evaluated at the projected parameters
+        gradient_func (mot.lib.cl_function.CLFunction): the optional gradient function for the ``L-BFGS`` routine,
+            the gradient is multiplied with the derivative of the transformation.
+        bounds (tuple): the lower and upper bounds, both matrices of size (n, p)
+        transform (str): one of 'cos-sqr', 'sigmoid' or 'projection'
+        nmr_parameters (int): the number of parameters
+
+    Returns:
+        tuple: the wrapped objective function, the data, the wrapped Jacobian function and
+            the wrapped gradient function.
+    """
+    if transform not in ('cos-sqr', 'sigmoid', 'projection'):
+        raise ValueError('The bounds transform "{}" is not supported.'.format(transform))
+
+    bounded_data = {'lower_bounds': Array(bounds[0], ctype='mot_float_type', mode='r'),
+                    'upper_bounds': Array(bounds[1], ctype='mot_float_type', mode='r')}
+    if data is not None:
+        bounded_data['data'] = data
+
+    transform_code = {
+        'cos-sqr': ('lower + (upper - lower) * pown(cos(x), 2)',
+                    '-(upper - lower) * sin(2 * x)'),
+        'sigmoid': ('lower + (upper - lower) / (1 + exp(-x))',
+                    '(upper - lower) * exp(-x) / pown(1 + exp(-x), 2)'),
+        'projection': ('clamp(x, lower, upper)', '1')}
+
+    to_model_space = SimpleCLFunction.from_string('''
+        mot_float_type bounds_to_model_space(mot_float_type x, mot_float_type lower, mot_float_type upper){
+            if(isfinite(lower) && isfinite(upper)){
+                return %(BOTH)s;
+            }
+            if(isfinite(lower)){
+                return lower + (x > 30 ? x : log1p(exp(x)));
+            }
+            if(isfinite(upper)){
+                return upper - (x > 30 ? x : log1p(exp(x)));
+            }
+            return x;
+        }
+    ''' % dict(BOTH=transform_code[transform][0]))
+
+    model_space_derivative = SimpleCLFunction.from_string('''
+        mot_float_type bounds_model_space_derivative(mot_float_type x, mot_float_type lower, mot_float_type upper){
+            if(isfinite(lower) && isfinite(upper)){
+                return %(BOTH)s;
+            }
+            if(isfinite(lower)){
+                return 1 / (1 + exp(-x));
+            }
+            if(isfinite(upper)){
+                return -1 / (1 + exp(-x));
+            }
+            return 1;
+        }
+    ''' % dict(BOTH=transform_code[transform][1]))
+
+    template_vars = dict(NMR_PARAMS=nmr_parameters,
+                         DATA='((_bounded_data*)data)->data' if data is not None else '0')
+
+    load_model_parameters = '''
+        if(get_local_id(0) == 0){
+            for(uint i = 0; i < %(NMR_PARAMS)r; i++){
+                x_model[i] = bounds_to_model_space(x[i], ((_bounded_data*)data)->lower_bounds[i],
+                                                   ((_bounded_data*)data)->upper_bounds[i]);
+            }
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    ''' % template_vars
+
+    bounded_func = SimpleCLFunction.from_string('''
+        double bounded_%(NAME)s(local const mot_float_type* const x, void* data, local mot_float_type* objective_list){
+            local mot_float_type x_model[%(NMR_PARAMS)r];
+            %(LOAD)s
+            double result = %(NAME)s(x_model, %(DATA)s, objective_list);
+
+            // wait for all work items to be done with the model parameters before they can be changed again
+            barrier(CLK_LOCAL_MEM_FENCE);
+            return result;
+        }
+    ''' % dict(template_vars, NAME=func.get_cl_function_name(), LOAD=load_model_parameters),
+        dependencies=[func, to_model_space])
+
+    if jacobian_func is not None:
+        jacobian_func = SimpleCLFunction.from_string('''
+            void bounded_%(NAME)s(local mot_float_type* x, void* data, local mot_float_type* fvec,
+                                  global mot_float_type* const fjac, local mot_float_type* scratch){
+                local mot_float_type x_model[%(NMR_PARAMS)r];
+                %(LOAD)s
+                %(NAME)s(x_model, %(DATA)s, fvec, fjac, scratch);
+                barrier(CLK_LOCAL_MEM_FENCE);
+            }
+        ''' % dict(template_vars, NAME=jacobian_func.get_cl_function_name(), LOAD=load_model_parameters),
+            dependencies=[jacobian_func, to_model_space])
+
+    if gradient_func is not None:
+        gradient_func = SimpleCLFunction.from_string('''
+            void bounded_%(NAME)s(local mot_float_type* x, void* data, local mot_float_type* gradient){
+                local mot_float_type x_model[%(NMR_PARAMS)r];
+                %(LOAD)s
+                %(NAME)s(x_model, %(DATA)s, gradient);
+                barrier(CLK_LOCAL_MEM_FENCE);
+
+                if(get_local_id(0) == 0){
+                    for(uint i = 0; i < %(NMR_PARAMS)r; i++){
+                        gradient[i] *= bounds_model_space_derivative(
+                            x[i], ((_bounded_data*)data)->lower_bounds[i], ((_bounded_data*)data)->upper_bounds[i]);
+                    }
+                }
+                barrier(CLK_LOCAL_MEM_FENCE);
+            }
+        ''' % dict(template_vars, NAME=gradient_func.get_cl_function_name(), LOAD=load_model_parameters),
+            dependencies=[gradient_func, to_model_space, model_space_derivative])
+
+    return bounded_func, Struct(bounded_data, '_bounded_data'), jacobian_func, gradient_func
+
+
+def _get_statistics_functions(func, data, jacobian_func, gradient_func, nmr_problems):
+    """Wrap the objective function and its derivatives such that the objective function evaluations are counted.
+
+    The counter is loaded per problem, together with the original data, in a structure passed as the data pointer.
+    The count is only increased by the first work item, such that every evaluation by a work group counts once.
+
+    Args:
+        func (mot.lib.cl_function.CLFunction): the objective function
+        data (mot.lib.kernel_data.KernelData): the data of the objective function
+        jacobian_func (mot.lib.cl_function.CLFunction): the optional Jacobian function
+        gradient_func (mot.lib.cl_function.CLFunction): the optional gradient function
+        nmr_problems (int): the number of problems
+
+    Returns:
+        tuple: the counting objective function, the objective function without counting (for evaluating the
+            solutions), the data, the wrapped Jacobian function and the wrapped gradient function.
+    """
+    statistics_data = {'nmr_function_evaluations': Zeros((nmr_problems,), ctype='uint', mode='rw')}
+    if data is not None:
+        statistics_data['data'] = data
+
+    template_vars = dict(NAME=func.get_cl_function_name(),
+                         DATA='((_statistics_data*)data)->data' if data is not None else '0')
+
+    counting_func = SimpleCLFunction.from_string('''
+        double counted_%(NAME)s(local const mot_float_type* const x, void* data, local mot_float_type* objective_list){
+            if(get_local_id(0) == 0){
+                *((_statistics_data*)data)->nmr_function_evaluations += 1;
+            }
+            return %(NAME)s(x, %(DATA)s, objective_list);
+        }
+    ''' % template_vars, dependencies=[func])
+
+    objective_func = SimpleCLFunction.from_string('''
+        double uncounted_%(NAME)s(local const mot_float_type* const x, void* data,
+                                  local mot_float_type* objective_list){
+            return %(NAME)s(x, %(DATA)s, objective_list);
+        }
+    ''' % template_vars, dependencies=[func])
+
+    if jacobian_func is not None:
+        jacobian_func = SimpleCLFunction.from_string('''
+            void uncounted_%(NAME)s(local mot_float_type* x, void* data, local mot_float_type* fvec,
+                                    global mot_float_type* const fjac, local mot_float_type* scratch){
+                %(NAME)s(x, %(DATA)s, fvec, fjac, scratch);
+            }
+        ''' % dict(template_vars, NAME=jacobian_func.get_cl_function_name()), dependencies=[jacobian_func])
+
+    if gradient_func is not None:
+        gradient_func = SimpleCLFunction.from_string('''
+            void uncounted_%(NAME)s(local mot_float_type* x, void* data, local mot_float_type* gradient){
+                %(NAME)s(x, %(DATA)s, gradient);
+            }
+        ''' % dict(template_vars, NAME=gradient_func.get_cl_function_name()), dependencies=[gradient_func])
+
+    return counting_func, objective_func, Struct(statistics_data, '_statistics_data'), jacobian_func, gradient_func
+
+
 def _clean_options(method, provided_options):
     """Clean the given input options.
 
@@ -128,7 +761,466 @@ def _clean_options(method, provided_options):
     return result
 
 
-def _minimize_powell(func, x0, cl_runtime_info, data=None, options=None):
+def _get_rng_state(nmr_problems, seed=None):
+    """Get the kernel data for the random state of the population based optimization routines.
+
+    Args:
+        nmr_problems (int): the number of problems
+        seed (int): the seed for generating the random state
+
+    Returns:
+        mot.lib.kernel_data.Array: six random integers per problem, updated by the optimization routine
+    """
+    rng_state = np.random.RandomState(seed).uniform(low=np.iinfo(np.uint32).min, high=np.iinfo(np.uint32).max + 1,
+                                                    size=(nmr_problems, 6)).astype(np.uint32)
+    return Array(rng_state, ctype='uint', mode='rw')
+
+
+def _run_optimizer(get_optimizer, func, x0, kernel_data, cl_runtime_info, nmr_rounds=1, use_state=False,
+                   initial_state=None, use_statistics=False, objective_func=None, trace_problems=None,
+                   trace_length=100, trace_x=False, wrap_optimizer=None):
+    """Run the given optimization routine in one or more rounds.
+
+    The first round runs all the problems. Every next round only relaunches the problems that ran out of
+    patience in the previous round (return code 6), starting from the parameters at which they stopped. If the
+    optimizer state is used, the relaunched problems also resume with the internal state of the optimization routine.
+    The rounds share the compiled kernels and the device buffers, see :class:`mot.lib.cl_function._ProcedureRunner`.
+    Per round we only write the indices of the relaunched problems to the devices and read back their rows.
+
+    If multiple starting points are given per problem, the first round optimizes all of them, see
+    :func:`_get_multistart_optimizer`.
+
+    If a trace is requested, the traced problems are run by a separate launch of the optimization routine compiled
+    with the trace, such that the other problems run without the tracing overhead.
+
+    Args:
+        get_optimizer (Callable): returns the optimization routine, operating on the ``model_parameters`` in the
+            kernel data. This is called with an optional keyword argument ``trace`` for the traced optimization
+            routine.
+        func (mot.lib.cl_function.CLFunction): the objective function, used to select the best solution
+            if multiple starting points are given
+        x0 (ndarray): the starting points, a matrix of (n, p) or (n, k, p) for 'n' problems, 'k' starting points
+            and 'p' parameters.
+        kernel_data (dict): the kernel data for the optimizer, without the model parameters
+        cl_runtime_info (mot.configuration.CLRuntimeInfo): the CL runtime information
+        nmr_rounds (int): the maximum number of rounds
+        use_state (boolean): if the optimization routine was compiled with the optimizer state
+        initial_state (ndarray): the initial optimizer state, if not given we start with an empty state.
+        use_statistics (boolean): if the optimization routine was compiled with the statistics, i.e. writes the
+            number of iterations. If set, we also evaluate the objective function at the solution in the same launch.
+        objective_func (mot.lib.cl_function.CLFunction): the objective function used for selecting the best
+            starting point and for evaluating the solutions. Defaults to ``func``.
+        trace_problems (ndarray): if given, the indices of the problems for which we record the trace
+        trace_length (int): the number of entries in the trace of every problem
+        trace_x (boolean): if we also record the parameters in the trace
+        wrap_optimizer (Callable): if given, the optimization routines of the rounds are replaced by
+            ``wrap_optimizer(optimizer_func)``, which should return the wrapped routine and the additional kernel data
+            it needs. This allows post-processing the solutions in the same kernel launch. The wrapper is not
+            applied to the optimization of multiple starting points. The wrapped routines can take the additional
+            argument ``global uint* is_last_round``, which is set to 1 in the last round. The problems which ran out
+            of patience in any other round are relaunched, such that their post-processing can be skipped.
+
+    Returns:
+        mot.optimize.base.OptimizeResults: the optimized parameters, the return codes and, if used,
+            the optimizer state, the statistics and the trace per problem.
+    """
+    use_local_reduction = all(env.is_gpu for env in cl_runtime_info.get_cl_environments())
+    nmr_problems = x0.shape[0]
+    nmr_parameters = x0.shape[-1]
+    nmr_rounds = max(1, nmr_rounds)
+    objective_func = objective_func or func
+
+    optimizer_func = get_optimizer()
+
+    # every element holds an optimization routine, the indices of the problems it runs and its extra kernel data
+    optimizers = [(optimizer_func, None, {})]
+    if trace_problems is not None:
+        traced = np.zeros(nmr_problems, dtype=bool)
+        traced[trace_problems] = True
+
+        trace_data = {'trace_position': Zeros((nmr_problems,), ctype='uint', mode='rw'),
+                      'trace_objective': Zeros((nmr_problems, trace_length), ctype='double', mode='rw')}
+        if trace_x:
+            trace_data['trace_x'] = Zeros((nmr_problems, trace_length, nmr_parameters), ctype='double', mode='rw')
+
+        trace = OptimizerTrace(nmr_parameters, trace_length=trace_length, trace_x=trace_x)
+        optimizers = [(optimizer_func, np.where(~traced)[0], {}),
+                      (get_optimizer(trace=trace), np.where(traced)[0], trace_data)]
+
+    x = x0
+    return_codes = None
+    problem_indices = None
+
+    state = None
+    if use_state:
+        state = np.zeros((nmr_problems, optimizer_func.get_state_length()))
+        if initial_state is not None:
+            if initial_state.shape != state.shape:
+                raise ValueError('The initial state should be of shape {}, {} given.'.format(
+                    state.shape, initial_state.shape))
+            state = np.copy(initial_state)
+
+    nmr_iterations = None
+    if use_statistics:
+        nmr_iterations = np.zeros(nmr_problems, dtype=np.int64)
+        kernel_data['objective_value'] = Zeros((nmr_problems,), ctype='double', mode='rw')
+
+    def run_optimizers(optimizers, problem_indices):
+        """Launch every optimization routine on its subset of the given problems, returns the return codes."""
+        nonlocal x, state, nmr_iterations
+
+        launch_codes = np.zeros(nmr_problems, dtype=np.int32)
+        for optimizer, subset, extra_data in optimizers:
+            indices = problem_indices
+            if subset is not None:
+                indices = subset if problem_indices is None else np.intersect1d(subset, problem_indices)
+                if not len(indices):
+                    continue
+
+            launch_data = dict(kernel_data)
+            launch_data.update(extra_data)
+            launch_data['model_parameters'] = Array(x, ctype='mot_float_type', mode='rw')
+            if use_state:
+                launch_data['optimizer_state'] = Array(state, ctype='mot_float_type', mode='rw')
+            if use_statistics:
+                launch_data['nmr_iterations'] = Zeros((nmr_problems,), ctype='uint', mode='rw')
+
+            codes = optimizer.evaluate(launch_data, nmr_problems, use_local_reduction=use_local_reduction,
+                                       cl_runtime_info=cl_runtime_info, problem_indices=indices)
+
+            x = launch_data['model_parameters'].get_data()
+            if use_state:
+                state = launch_data['optimizer_state'].get_data()
+            if use_statistics:
+                nmr_iterations += launch_data['nmr_iterations'].get_data()
+
+            if indices is None:
+                launch_codes = codes
+            else:
+                launch_codes[indices] = codes[indices]
+        return launch_codes
+
+    if len(x0.shape) == 3:
+        kernel_data['starts'] = Array(x0, ctype='mot_float_type', mode='r')
+        x = np.zeros((nmr_problems, nmr_parameters))
+
+        return_codes = run_optimizers(
+            [(_get_multistart_optimizer(optimizer, objective_func, nmr_parameters, x0.shape[1],
+                                       use_statistics=use_statistics),
+              subset, extra_data) for optimizer, subset, extra_data in optimizers], None)
+
+        del kernel_data['starts']
+        problem_indices = np.where(return_codes == 6)[0]
+        nmr_rounds -= 1
+
+    if use_statistics:
+        optimizers = [(_get_statistics_optimizer(optimizer, objective_func), subset, extra_data)
+                      for optimizer, subset, extra_data in optimizers]
+
+    if wrap_optimizer is not None:
+        wrapped_optimizers = []
+        for optimizer, subset, extra_data in optimizers:
+            wrapped_optimizer, wrapper_data = wrap_optimizer(optimizer)
+            wrapped_optimizers.append((wrapped_optimizer, subset, dict(extra_data, **wrapper_data)))
+        optimizers = wrapped_optimizers
+
+    runners = None
+    round_data = dict(kernel_data)
+    if wrap_optimizer is not None:
+        round_data['is_last_round'] = Array(np.array([nmr_rounds == 1], dtype=np.uint32), ctype='uint',
+                                            offset_str='0', mode='r')
+
+    for round_ind in range(nmr_rounds):
+        if problem_indices is not None and not len(problem_indices):
+            break
+
+        if runners is None:
+            # the rounds share the kernels and device buffers, we only rewrite the indices of the problems to run
+            x = np.require(x, cl_runtime_info.mot_float_dtype, requirements=['C', 'A', 'O', 'W'])
+            round_data['model_parameters'] = Array(x, ctype='mot_float_type', mode='rw', ensure_zero_copy=True)
+            if use_state:
+                state = np.require(state, cl_runtime_info.mot_float_dtype, requirements=['C', 'A', 'O', 'W'])
+                round_data['optimizer_state'] = Array(state, ctype='mot_float_type', mode='rw',
+                                                      ensure_zero_copy=True)
+            if use_statistics:
+                round_data['nmr_iterations'] = Zeros((nmr_problems,), ctype='uint', mode='rw')
+
+            runners = [(_ProcedureRunner(optimizer, dict(round_data, **extra_data), nmr_problems,
+                                         use_local_reduction=use_local_reduction, cl_runtime_info=cl_runtime_info),
+                        subset) for optimizer, subset, extra_data in optimizers]
+        elif round_ind == nmr_rounds - 1:
+            for runner, _ in runners:
+                runner.write_data('is_last_round', np.ones(1, dtype=np.uint32))
+
+        launched = np.arange(nmr_problems) if problem_indices is None else problem_indices
+        round_codes = np.zeros(nmr_problems, dtype=np.int32)
+        for runner, subset in runners:
+            indices = launched if subset is None else np.intersect1d(subset, launched)
+            if len(indices):
+                round_codes[indices] = runner.run(indices)[indices]
+
+        if use_statistics:
+            nmr_iterations[launched] += round_data['nmr_iterations'].get_data()[launched]
+
+        if return_codes is None:
+            return_codes = round_codes
+        else:
+            return_codes[problem_indices] = round_codes[problem_indices]
+
+        problem_indices = np.where(return_codes == 6)[0]
+
+    results = OptimizeResults({'x': x, 'status': return_codes})
+    if use_state:
+        results['state'] = state
+    if use_statistics:
+        results['nmr_iterations'] = nmr_iterations
+        results['objective_value'] = kernel_data['objective_value'].get_data()
+    if trace_problems is not None:
+        trace_position = trace_data['trace_position'].get_data()[trace_problems].astype(np.int64)
+        results['trace_nmr_entries'] = trace_position
+        results['trace_objective'] = _unroll_trace(
+            trace_position, trace_data['trace_objective'].get_data()[trace_problems])
+        if trace_x:
+            results['trace_x'] = _unroll_trace(trace_position, trace_data['trace_x'].get_data()[trace_problems])
+    return results
+
+
+def _unroll_trace(trace_position, ring_buffer):
+    """Order the entries of the trace ring buffers from the oldest to the newest entry.
+
+    Args:
+        trace_position (ndarray): the total number of entries written per problem, a vector of length n
+        ring_buffer (ndarray): the ring buffers, a matrix of (n, l, ...) for a trace length of 'l'
+
+    Returns:
+        ndarray: the entries of the ring buffers in chronological order, with NaN for the entries not written
+    """
+    trace_length = ring_buffer.shape[1]
+    steps = np.arange(trace_length)
+
+    indices = (np.maximum(trace_position - trace_length, 0)[:, None] + steps[None, :]) % trace_length
+    entries = ring_buffer[np.arange(ring_buffer.shape[0])[:, None], indices]
+    entries[steps[None, :] >= np.minimum(trace_position, trace_length)[:, None]] = np.nan
+    return entries
+
+
+def _get_statistics_optimizer(optimizer_func, objective_func):
+    """Wrap the optimization routine such that it evaluates the objective function at the solution.
+
+    The objective function value is written to an additional argument ``global double* objective_value``.
+
+    Args:
+        optimizer_func (mot.lib.cl_function.CLFunction): the optimization routine
+        objective_func (mot.lib.cl_function.CLFunction): the objective function
+
+    Returns:
+        mot.lib.cl_function.CLFunction: the wrapped optimization routine
+    """
+    parameters = optimizer_func.get_parameters()
+
+    return SimpleCLFunction.from_string('''
+        int optimize_with_statistics(''' + ', '.join('{} {}'.format(p.data_type.get_declaration(), p.name)
+                                                     for p in parameters) + ''',
+                                     global double* objective_value){
+            int return_code = %(OPTIMIZER)s(%(ARGS)s);
+            double f = %(FUNCTION_NAME)s(model_parameters, data, 0);
+
+            if(get_local_id(0) == 0){
+                *objective_value = f;
+            }
+            return return_code;
+        }
+    ''' % dict(OPTIMIZER=optimizer_func.get_cl_function_name(),
+               ARGS=', '.join(p.name for p in parameters),
+               FUNCTION_NAME=objective_func.get_cl_function_name()), dependencies=[optimizer_func, objective_func])
+
+
+def _get_uncertainty_optimizer(optimizer_func, objective_func, nmr_parameters, step_ratio, nmr_steps):
+    """Wrap the optimization routine such that it computes the Hessian and the covariance matrix at the solution.
+
+    After the optimization routine, the work group evaluates the objective function at the solution, computes the
+    lower triangular elements of the Hessian using the central differences of :mod:`mot.cl_routines.numerical_hessian`
+    and inverts the Hessian using its Cholesky decomposition. The results are written to the
+    additional arguments ``objective_value``, ``hessian``, ``covariance`` and ``is_inverted``, and the steps and
+    their Richardson extrapolations to the scratch arguments ``step_evaluates``, ``richardson_extrapolations``
+    and ``richardson_errors``. If the Hessian is not positive definite or is ill-conditioned, ``is_inverted`` is set
+    to zero. Problems that ran out of patience (return code 6) skip these computations, except in the last round,
+    since they are relaunched in the next round, see :func:`_run_optimizer`.
+
+    Args:
+        optimizer_func (mot.lib.cl_function.CLFunction): the optimization routine
+        objective_func (mot.lib.cl_function.CLFunction): the objective function
+        nmr_parameters (int): the number of parameters
+        step_ratio (float): the ratio at which the steps diminish
+        nmr_steps (int): the number of steps per element of the Hessian
+
+    Returns:
+        mot.lib.cl_function.CLFunction: the wrapped optimization routine
+    """
+    parameters = optimizer_func.get_parameters()
+    coords = list(itertools.combinations_with_replacement(range(nmr_parameters), 2))
+
+    nmr_convolutions = _get_nmr_richardson_convolutions(nmr_steps)
+
+    parameter_transform_func = SimpleCLFunction.from_string(
+        'void voidTransform(void* data, local mot_float_type* x){}')
+
+    cl_extra = _get_compute_functions_cl(objective_func, nmr_parameters, nmr_steps, step_ratio,
+                                         parameter_transform_func)
+    cl_extra += _get_extrapolation_functions_cl(nmr_steps, step_ratio)
+
+    return SimpleCLFunction.from_string('''
+        int optimize_with_uncertainty(''' + ', '.join('{} {}'.format(p.data_type.get_declaration(), p.name)
+                                                      for p in parameters) + ''',
+                                      global float* parameter_scalings_inv,
+                                      global float* initial_step,
+                                      global double* step_evaluates,
+                                      global double* richardson_extrapolations,
+                                      global double* richardson_errors,
+                                      global double* objective_value,
+                                      global double* hessian,
+                                      global double* covariance,
+                                      global uint* is_inverted,
+                                      global uint* is_last_round){
+            uint coords[%(NMR_DERIVATIVES)r][2] = {%(COORDS)s};
+            uint px, py;
+            double derivative;
+
+            int return_code = %(OPTIMIZER)s(%(ARGS)s);
+
+            // the problem ran out of patience and is relaunched in the next round
+            if(return_code == 6 && !*is_last_round){
+                return return_code;
+            }
+
+            double f = _calculate_function(data, model_parameters);
+
+            for(uint coord_ind = 0; coord_ind < %(NMR_DERIVATIVES)r; coord_ind++){
+                _compute_steps(data, model_parameters, f, coords[coord_ind][0], coords[coord_ind][1],
+                               step_evaluates + coord_ind * %(NMR_STEPS)r, parameter_scalings_inv, initial_step);
+            }
+
+            if(get_local_id(0) == 0){
+                *objective_value = f;
+
+                for(uint coord_ind = 0; coord_ind < %(NMR_DERIVATIVES)r; coord_ind++){
+                    px = coords[coord_ind][0];
+                    py = coords[coord_ind][1];
+
+                    derivative = _extrapolate_derivative(
+                        step_evaluates + coord_ind * %(NMR_STEPS)r,
+                        richardson_extrapolations + coord_ind * %(NMR_CONVOLUTIONS)r,
+                        richardson_errors + coord_ind * (%(NMR_CONVOLUTIONS)r - 1));
+
+                    hessian[px * %(NMR_PARAMS)r + py] = derivative;
+                    hessian[py * %(NMR_PARAMS)r + px] = derivative;
+                }
+
+                for(uint i = 0; i < %(NMR_PARAMS)r * %(NMR_PARAMS)r; i++){
+                    covariance[i] = hessian[i];
+                }
+
+                *is_inverted = cholesky_inverse_global_double(covariance, %(NMR_PARAMS)r);
+                if(*is_inverted){
+                    for(uint i = 0; i < %(NMR_PARAMS)r; i++){
+                        covariance[i * %(NMR_PARAMS)r + i] = fabs(covariance[i * %(NMR_PARAMS)r + i]);
+                    }
+                }
+            }
+            barrier(CLK_GLOBAL_MEM_FENCE);
+            return return_code;
+        }
+    ''' % dict(NMR_PARAMS=nmr_parameters, NMR_STEPS=nmr_steps, NMR_CONVOLUTIONS=nmr_convolutions,
+               NMR_DERIVATIVES=len(coords), COORDS=', '.join('{{{}, {}}}'.format(*c) for c in coords),
+               OPTIMIZER=optimizer_func.get_cl_function_name(), ARGS=', '.join(p.name for p in parameters)),
+        dependencies=[optimizer_func, CholeskyInverse(memspace='global', memtype='double')], cl_extra=cl_extra)
+
+
+def _get_multistart_optimizer(optimizer_func, func, nmr_parameters, nmr_starts, use_statistics=False):
+    """Wrap the optimization routine such that it optimizes multiple starting points per problem in one launch.
+
+    Every work group runs the optimization routine for each of the starting points of its problem, given by the
+    ``starts`` in the kernel data, and keeps the solution with the lowest objective function value. Only these best
+    solutions are written to the ``model_parameters``, and read back from the device.
+
+    Args:
+        optimizer_func (mot.lib.cl_function.CLFunction): the optimization routine
+        func (mot.lib.cl_function.CLFunction): the objective function, used to select the best solution
+        nmr_parameters (int): the number of parameters
+        nmr_starts (int): the number of starting points per problem
+        use_statistics (boolean): if the optimization routine writes the number of iterations. If set, we sum the
+            iterations over all starting points and write the objective function value of the best solution to
+            the ``objective_value`` in the kernel data.
+
+    Returns:
+        mot.lib.cl_function.CLFunction: the optimization routine for multiple starting points
+    """
+
+    extra_parameters = [p for p in optimizer_func.get_parameters() if p.name != 'model_parameters']
+    statistics_parameter = ', global double* objective_value' if use_statistics else ''
+
+    return SimpleCLFunction.from_string('''
+        int multistart(global mot_float_type* starts,
+                       global mot_float_type* model_parameters,
+                       ''' + ', '.join('{} {}'.format(p.data_type.get_declaration(), p.name)
+                                      for p in extra_parameters) + statistics_parameter + '''){
+            local mot_float_type x[%(NMR_PARAMS)r];
+
+            #if %(USE_STATISTICS)r
+                uint total_iterations = 0;
+            #endif
+
+            int return_code;
+            int best_return_code = 0;
+            double f;
+            double best_f = INFINITY;
+
+            for(uint k = 0; k < %(NMR_STARTS)r; k++){
+                if(get_local_id(0) == 0){
+                    for(uint i = 0; i < %(NMR_PARAMS)r; i++){
+                        x[i] = starts[k * %(NMR_PARAMS)r + i];
+                    }
+                }
+                barrier(CLK_LOCAL_MEM_FENCE);
+
+                return_code = %(OPTIMIZER)s(x, %(EXTRA_ARGS)s);
+                f = %(FUNCTION_NAME)s(x, data, 0);
+
+                #if %(USE_STATISTICS)r
+                    if(get_local_id(0) == 0){
+                        total_iterations += *nmr_iterations;
+                    }
+                #endif
+
+                if(k == 0 || f < best_f || (isnan(best_f) && !isnan(f))){
+                    best_f = f;
+                    best_return_code = return_code;
+
+                    if(get_local_id(0) == 0){
+                        for(uint i = 0; i < %(NMR_PARAMS)r; i++){
+                            model_parameters[i] = x[i];
+                        }
+                    }
+                }
+                barrier(CLK_LOCAL_MEM_FENCE);
+            }
+
+            #if %(USE_STATISTICS)r
+                if(get_local_id(0) == 0){
+                    *nmr_iterations = total_iterations;
+                    *objective_value = best_f;
+                }
+            #endif
+            return best_return_code;
+        }
+    ''' % dict(NMR_PARAMS=nmr_parameters, NMR_STARTS=nmr_starts, USE_STATISTICS=int(bool(use_statistics)),
+               OPTIMIZER=optimizer_func.get_cl_function_name(),
+               EXTRA_ARGS=', '.join(p.name for p in extra_parameters),
+               FUNCTION_NAME=func.get_cl_function_name()), dependencies=[optimizer_func, func])
+
+
+def _minimize_powell(func, x0, cl_runtime_info, data=None, options=None, use_state=False, use_statistics=False,
+                       **run_options):
     """
     Options:
         patience (int): Used to set the maximum number of iterations to patience*(number_of_parameters+1)
@@ -139,10 +1231,9 @@ def _minimize_powell(func, x0, cl_runtime_info, data=None, options=None):
     options = _clean_options('Powell', options)
 
     nmr_problems = x0.shape[0]
-    nmr_parameters = x0.shape[1]
+    nmr_parameters = x0.shape[-1]
 
-    kernel_data = {'model_parameters': Array(x0, ctype='mot_float_type', mode='rw'),
-                   'data': data}
+    kernel_data = {'data': data}
 
     eval_func = SimpleCLFunction.from_string('''
         double evaluate(local mot_float_type* x, void* data){
@@ -150,18 +1241,15 @@ def _minimize_powell(func, x0, cl_runtime_info, data=None, options=None):
         }
     ''', dependencies=[func])
 
-    optimizer_func = Powell(eval_func, nmr_parameters, **options)
+    get_optimizer = partial(Powell, eval_func, nmr_parameters, use_state=use_state,
+                            use_statistics=use_statistics, **options)
 
-    return_code = optimizer_func.evaluate(
-        kernel_data, nmr_problems,
-        use_local_reduction=all(env.is_gpu for env in cl_runtime_info.get_cl_environments()),
-        cl_runtime_info=cl_runtime_info)
+    return _run_optimizer(get_optimizer, func, x0, kernel_data, cl_runtime_info, use_state=use_state,
+                          use_statistics=use_statistics, **run_options)
 
-    return OptimizeResults({'x': kernel_data['model_parameters'].get_data(),
-                            'status': return_code})
 
-
-def _minimize_nmsimplex(func, x0, cl_runtime_info, data=None, options=None):
+def _minimize_nmsimplex(func, x0, cl_runtime_info, data=None, options=None, use_state=False, use_statistics=False,
+                          **run_options):
     """Use the Nelder-Mead simplex method to calculate the optimimum.
 
     The scales should satisfy the following constraints:
@@ -202,10 +1290,9 @@ def _minimize_nmsimplex(func, x0, cl_runtime_info, data=None, options=None):
     options = _clean_options('Nelder-Mead', options)
 
     nmr_problems = x0.shape[0]
-    nmr_parameters = x0.shape[1]
+    nmr_parameters = x0.shape[-1]
 
-    kernel_data = {'model_parameters': Array(x0, ctype='mot_float_type', mode='rw'),
-                   'data': data}
+    kernel_data = {'data': data}
 
     eval_func = SimpleCLFunction.from_string('''
         double evaluate(local mot_float_type* x, void* data){
@@ -213,18 +1300,15 @@ def _minimize_nmsimplex(func, x0, cl_runtime_info, data=None, options=None):
         }
     ''', dependencies=[func])
 
-    optimizer_func = NMSimplex('evaluate', nmr_parameters, dependencies=[eval_func], **options)
-
-    return_code = optimizer_func.evaluate(
-        kernel_data, nmr_problems,
-        use_local_reduction=all(env.is_gpu for env in cl_runtime_info.get_cl_environments()),
-        cl_runtime_info=cl_runtime_info)
+    get_optimizer = partial(NMSimplex, 'evaluate', nmr_parameters, dependencies=[eval_func], use_state=use_state,
+                            use_statistics=use_statistics, **options)
 
-    return OptimizeResults({'x': kernel_data['model_parameters'].get_data(),
-                            'status': return_code})
+    return _run_optimizer(get_optimizer, func, x0, kernel_data, cl_runtime_info, use_state=use_state,
+                          use_statistics=use_statistics, **run_options)
 
 
-def _minimize_subplex(func, x0, cl_runtime_info, data=None, options=None):
+def _minimize_subplex(func, x0, cl_runtime_info, data=None, options=None, use_state=False, use_statistics=False,
+                        **run_options):
     """Variation on the Nelder-Mead Simplex method by Thomas H. Rowan.
 
     This method uses NMSimplex to search subspace regions for the minimum. See Rowan's thesis titled
@@ -275,10 +1359,9 @@ def _minimize_subplex(func, x0, cl_runtime_info, data=None, options=None):
     options = _clean_options('Subplex', options)
 
     nmr_problems = x0.shape[0]
-    nmr_parameters = x0.shape[1]
+    nmr_parameters = x0.shape[-1]
 
-    kernel_data = {'model_parameters': Array(x0, ctype='mot_float_type', mode='rw'),
-                   'data': data}
+    kernel_data = {'data': data}
 
     eval_func = SimpleCLFunction.from_string('''
         double evaluate(local mot_float_type* x, void* data){
@@ -286,28 +1369,24 @@ def _minimize_subplex(func, x0, cl_runtime_info, data=None, options=None):
         }
     ''', dependencies=[func])
 
-    optimizer_func = Subplex(eval_func, nmr_parameters, **options)
-
-    return_code = optimizer_func.evaluate(
-        kernel_data, nmr_problems,
-        use_local_reduction=all(env.is_gpu for env in cl_runtime_info.get_cl_environments()),
-        cl_runtime_info=cl_runtime_info)
+    get_optimizer = partial(Subplex, eval_func, nmr_parameters, use_state=use_state,
+                            use_statistics=use_statistics, **options)
 
-    return OptimizeResults({'x': kernel_data['model_parameters'].get_data(),
-                            'status': return_code})
+    return _run_optimizer(get_optimizer, func, x0, kernel_data, cl_runtime_info, use_state=use_state,
+                          use_statistics=use_statistics, **run_options)
 
 
-def _minimize_levenberg_marquardt(func, x0, nmr_observations, cl_runtime_info, data=None, options=None):
+def _minimize_levenberg_marquardt(func, x0, nmr_observations, cl_runtime_info, data=None, options=None,
+                                  jacobian_func=None, use_state=False, use_statistics=False, **run_options):
     options = _clean_options('Levenberg-Marquardt', options)
 
     nmr_problems = x0.shape[0]
-    nmr_parameters = x0.shape[1]
+    nmr_parameters = x0.shape[-1]
 
-    if nmr_observations < x0.shape[1]:
+    if nmr_observations < nmr_parameters:
         raise ValueError('The number of instances per problem must be greater than the number of parameters')
 
-    kernel_data = {'model_parameters': Array(x0, ctype='mot_float_type', mode='rw'),
-                   'data': data,
+    kernel_data = {'data': data,
                    'fjac': Zeros((nmr_problems, nmr_parameters, nmr_observations), ctype='mot_float_type',
                                  mode='rw')}
 
@@ -317,12 +1396,161 @@ def _minimize_levenberg_marquardt(func, x0, nmr_observations, cl_runtime_info, d
         }
     ''', dependencies=[func])
 
-    optimizer_func = LevenbergMarquardt(eval_func, nmr_parameters, nmr_observations, jacobian_func=None, **options)
+    get_optimizer = partial(LevenbergMarquardt, eval_func, nmr_parameters, nmr_observations,
+                            jacobian_func=jacobian_func, use_state=use_state, use_statistics=use_statistics,
+                            **options)
+
+    return _run_optimizer(get_optimizer, func, x0, kernel_data, cl_runtime_info, use_state=use_state,
+                          use_statistics=use_statistics, **run_options)
+
+
+def _minimize_lbfgs(func, x0, cl_runtime_info, data=None, options=None, gradient_func=None, use_state=False,
+                    use_statistics=False, **run_options):
+    """Use the limited-memory BFGS method to calculate the optimum.
+
+    This quasi-Newton method approximates the inverse Hessian using the last few gradient evaluations. By default the
+    gradients are computed using central differences, provide a ``gradient_func`` for analytic gradients.
+
+    Options:
+        patience (int): Used to set the maximum number of iterations to patience*(number_of_parameters+1)
+        patience_line_search (int): the maximum number of step halvings in the backtracking line search
+        history_length (int): the number of previous iterations used in the inverse Hessian approximation
+        gradient_tolerance (float): stop if the largest gradient element is at most this tolerance times
+            the function value (or times one if the function value is smaller than one).
+
+    References:
+        [1] Nocedal, J. (1980). "Updating Quasi-Newton Matrices with Limited Storage".
+            Mathematics of Computation. 35 (151): 773-782.
+    """
+    options = _clean_options('L-BFGS', options)
+
+    nmr_parameters = x0.shape[-1]
+
+    kernel_data = {'data': data}
+
+    eval_func = SimpleCLFunction.from_string('''
+        double evaluate(local mot_float_type* x, void* data){
+            return ''' + func.get_cl_function_name() + '''(x, data, 0);
+        }
+    ''', dependencies=[func])
+
+    get_optimizer = partial(LBFGS, eval_func, nmr_parameters, gradient_func=gradient_func, use_state=use_state,
+                            use_statistics=use_statistics, **options)
+
+    return _run_optimizer(get_optimizer, func, x0, kernel_data, cl_runtime_info, use_state=use_state,
+                          use_statistics=use_statistics, **run_options)
+
+
+def _minimize_differential_evolution(func, x0, nmr_observations, cl_runtime_info, data=None, options=None,
+                                     jacobian_func=None, use_state=False, use_statistics=False, **run_options):
+    """Use Differential Evolution to calculate the global optimum.
+
+    Every problem evolves its own population in a work group. The population is kept in local memory and the trial
+    members are generated in parallel over the work items, using the Random123 generators. The best member can be
+    polished by a local optimization routine in the same kernel.
+
+    Options:
+        patience (int): Used to set the maximum number of generations to patience*(number_of_parameters+1)
+        population_size (int or str): the number of members in the population, at least four. If 'auto', we use
+            ten members per parameter, clipped to the range [5, 100].
+        mutation (float): the scale factor of the difference vector
+        crossover (float): the probability of taking a parameter from the mutated member
+        strategy (str): one of 'rand1bin' or 'best1bin', the base member for the mutation is either a random
+            member or the best member.
+        tolerance (float): stop if the standard deviation of the function values in the population is at most
+            this tolerance times the mean function value.
+        scale (float): the initial population is drawn uniformly around the starting point, within
+            ``scale * max(|x|, 1)`` of every parameter.
+        polish (str or None): the local optimization routine used to polish the best member, one of 'Powell' or
+            'Levenberg-Marquardt', with their default options, or None for no polishing.
+        seed (int): the seed for the random number generator
+
+    References:
+        [1] Storn, R. and Price, K. (1997). "Differential Evolution - A Simple and Efficient Heuristic for Global
+            Optimization over Continuous Spaces". Journal of Global Optimization. 11 (4): 341-359.
+    """
+    options = _clean_options('DifferentialEvolution', options)
+    polish = options.pop('polish')
+    seed = options.pop('seed')
+
+    nmr_problems = x0.shape[0]
+    nmr_parameters = x0.shape[-1]
+
+    kernel_data = {'data': data,
+                   'rng_state': _get_rng_state(nmr_problems, seed)}
+
+    eval_func = SimpleCLFunction.from_string('''
+        double evaluate(local mot_float_type* x, void* data){
+            return ''' + func.get_cl_function_name() + '''(x, data, 0);
+        }
+    ''', dependencies=[func])
+
+    polish_func = None
+    if polish == 'Powell':
+        polish_func = Powell(eval_func, nmr_parameters, **_clean_options('Powell', None))
+    elif polish == 'Levenberg-Marquardt':
+        if nmr_observations is None or nmr_observations < nmr_parameters:
+            raise ValueError('The number of instances per problem must be greater than the number of parameters')
+
+        kernel_data['fjac'] = Zeros((nmr_problems, nmr_parameters, nmr_observations), ctype='mot_float_type',
+                                    mode='rw')
+
+        eval_lm_func = SimpleCLFunction.from_string('''
+            void evaluate_lm(local mot_float_type* x, void* data, local mot_float_type* result){
+                ''' + func.get_cl_function_name() + '''(x, data, result);
+            }
+        ''', dependencies=[func])
+        polish_func = LevenbergMarquardt(eval_lm_func, nmr_parameters, nmr_observations, jacobian_func=jacobian_func,
+                                         **_clean_options('Levenberg-Marquardt', None))
+    elif polish is not None:
+        raise ValueError('Could not find the specified polish method "{}".'.format(polish))
+
+    get_optimizer = partial(DifferentialEvolution, eval_func, nmr_parameters, polish_func=polish_func,
+                            use_state=use_state, use_statistics=use_statistics, **options)
+
+    return _run_optimizer(get_optimizer, func, x0, kernel_data, cl_runtime_info, use_state=use_state,
+                          use_statistics=use_statistics, **run_options)
+
+
+def _minimize_cmaes(func, x0, cl_runtime_info, data=None, options=None, use_state=False, use_statistics=False,
+                    **run_options):
+    """Use the Covariance Matrix Adaptation Evolution Strategy (CMA-ES) to calculate the global optimum.
+
+    Every problem runs its own evolution strategy in a work group, with its state in local memory. The candidates are
+    sampled in parallel over the work items using the Random123 generators, and the covariance matrix is updated and
+    decomposed on the device. After convergence, the strategy is restarted with a doubled population size (IPOP).
+
+    Options:
+        patience (int): Used to set the maximum number of generations per run to patience*(number_of_parameters+1)
+        population_size (int or str): the number of candidates per generation in the first run, at least four.
+            If 'auto', we use ``4 + floor(3 * ln(number_of_parameters))``.
+        nmr_restarts (int): the maximum number of restarts, each doubling the population size
+        scale (float): the initial step size, the initial distribution has a standard deviation of
+            ``scale * max(|x|, 1)`` for every parameter.
+        seed (int): the seed for the random number generator
+
+    References:
+        [1] Hansen, N. (2016). "The CMA Evolution Strategy: A Tutorial". arXiv:1604.00772.
+        [2] Auger, A. and Hansen, N. (2005). "A Restart CMA Evolution Strategy With Increasing Population Size".
+            IEEE Congress on Evolutionary Computation. 2: 1769-1776.
+    """
+    options = _clean_options('CMA-ES', options)
+    seed = options.pop('seed')
+
+    nmr_problems = x0.shape[0]
+    nmr_parameters = x0.shape[-1]
+
+    kernel_data = {'data': data,
+                   'rng_state': _get_rng_state(nmr_problems, seed)}
+
+    eval_func = SimpleCLFunction.from_string('''
+        double evaluate(local mot_float_type* x, void* data){
+            return ''' + func.get_cl_function_name() + '''(x, data, 0);
+        }
+    ''', dependencies=[func])
 
-    return_code = optimizer_func.evaluate(
-        kernel_data, nmr_problems,
-        use_local_reduction=all(env.is_gpu for env in cl_runtime_info.get_cl_environments()),
-        cl_runtime_info=cl_runtime_info)
+    get_optimizer = partial(CMAES, eval_func, nmr_parameters, use_state=use_state,
+                            use_statistics=use_statistics, **options)
 
-    return OptimizeResults({'x': kernel_data['model_parameters'].get_data(),
-                            'status': return_code})
+    return _run_optimizer(get_optimizer, func, x0, kernel_data, cl_runtime_info, use_state=use_state,
+                          use_statistics=use_statistics, **run_options)
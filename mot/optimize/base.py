@@ -17,7 +17,8 @@ return_code_labels = {
     8: ['failed', 'xtol<tol: cannot improve approximate solution any further'],
     9: ['failed', 'gtol<tol: cannot improve approximate solution any further'],
     10: ['NaN', 'Function value is not-a-number or infinite'],
-    11: ['exhausted', 'temperature decreased to 0.0']
+    11: ['exhausted', 'temperature decreased to 0.0'],
+    12: ['converged', 'the norm of the gradient is at most tol']
 }
 
 
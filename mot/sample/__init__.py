@@ -1,3 +1,6 @@
 from .amwg import AdaptiveMetropolisWithinGibbs
 from .scam import SingleComponentAdaptiveMetropolis
 from .mwg import MetropolisWithinGibbs
+from .am import AdaptiveMetropolis
+from .hmc import HamiltonianMonteCarlo
+from .base import SamplerSession, SampleOutputWriter, ArraySampleOutputWriter
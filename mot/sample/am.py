@@ -0,0 +1,191 @@
+import numpy as np
+from mot.lib.cl_function import SimpleCLFunction
+from mot.library_functions import Cholesky
+from mot.sample.base import AbstractSampler
+from mot.lib.kernel_data import Array, Struct
+
+__author__ = 'Robbert Harms'
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class AdaptiveMetropolis(AbstractSampler):
+
+    def __init__(self, ll_func, log_prior_func, x0, proposal_covariances, waiting_period=100,
+                 scaling_factor=None, epsilon=1e-10, finalize_proposal_func=None, **kwargs):
+        r"""An implementation of the Adaptive Metropolis (AM) MCMC algorithm [1].
+
+        Contrary to the component-wise samplers, this proposes all parameters jointly, using a multivariate normal
+        proposal distribution with a covariance adapted to the empirical covariance of the chain. This requires
+        only one log-likelihood evaluation per iteration instead of one per parameter. The proposal covariance
+        :math:`C_t` at time :math:`t` is given by:
+
+        .. math::
+
+            C_t = \begin{cases}
+            C_0, & t \leq t_0 \\
+            s_d \mathrm{Cov}(\mathbf{X}_0, \ldots, \mathbf{X}_{t-1}) + s_d \epsilon I_d, & t > t_0
+            \end{cases}
+
+        where :math:`t_0` is the waiting period, :math:`d` the number of parameters and
+        :math:`s_d = 2.4^2 / d` the scaling factor. The running means and co-moments of the chain and the
+        Cholesky factor of the proposal covariance are kept on the device, in the method data. If the updated
+        covariance is not positive definite, we keep using the previous Cholesky factor.
+
+        Args:
+            ll_func (mot.lib.cl_function.CLFunction): The log-likelihood function. See parent docs.
+            log_prior_func (mot.lib.cl_function.CLFunction): The log-prior function. See parent docs.
+            x0 (ndarray): the starting positions for the sampler. Should be a two dimensional matrix
+                with for every modeling instance (first dimension) and every parameter (second dimension) a value.
+            proposal_covariances (ndarray): the initial proposal covariance matrices, a (d, p, p) matrix with a
+                covariance matrix for every modeling instance. This can also be given as a (d, p) matrix with
+                proposal standard deviations, for a diagonal initial covariance.
+            waiting_period (int): only start adapting the proposal covariance after this many draws.
+            scaling_factor (float): the scaling factor :math:`s_d`, defaults to :math:`2.4^2 / d`.
+            epsilon (float): small number to prevent the covariance from becoming singular.
+            finalize_proposal_func (mot.lib.cl_function.CLFunction): a CL function to finalize every proposal
+                before computing the prior or likelihood probabilities, see
+                :class:`~mot.sample.base.AbstractRWMSampler`. If None, we will not use this callback.
+
+        References:
+            [1] Haario, H., Saksman, E., & Tamminen, J. (2001). An adaptive Metropolis algorithm.
+                Bernoulli, 7(2), 223-242. https://doi.org/10.2307/3318737
+        """
+        super().__init__(ll_func, log_prior_func, x0, **kwargs)
+        self._waiting_period = waiting_period
+        self._scaling_factor = scaling_factor or 2.4 ** 2 / self._nmr_params
+        self._epsilon = epsilon
+        self._finalize_proposal_func = finalize_proposal_func or SimpleCLFunction.from_string(
+            'void finalizeProposal(void* data, local mot_float_type* x){}')
+
+        proposal_covariances = np.asarray(proposal_covariances, dtype=np.float64)
+        if len(proposal_covariances.shape) == 2:
+            proposal_covariances = np.apply_along_axis(np.diag, 1, proposal_covariances ** 2)
+        proposal_covariances = self._repeat_over_chains(proposal_covariances, 'proposal covariances')
+
+        self._proposal_cholesky = np.require(np.linalg.cholesky(proposal_covariances), requirements='CAOW',
+                                             dtype=self._cl_runtime_info.mot_float_dtype)
+        self._parameter_means = np.zeros((self._nmr_problems, self._nmr_params), dtype=np.float64, order='C')
+        self._parameter_comoments = np.zeros((self._nmr_problems, self._nmr_params, self._nmr_params),
+                                             dtype=np.float64, order='C')
+
+    def get_proposal_covariances(self):
+        """Get the current proposal covariance matrices.
+
+        Returns:
+            ndarray: a (d, p, p) matrix with the proposal covariance of every modeling instance
+        """
+        cholesky = self._proposal_cholesky.astype(np.float64)
+        return np.matmul(cholesky, np.transpose(cholesky, (0, 2, 1)))
+
+    def _get_mcmc_method_kernel_data(self):
+        return Struct({
+            'proposal_cholesky': Array(self._proposal_cholesky, 'mot_float_type', mode='rw', ensure_zero_copy=True),
+            'parameter_means': Array(self._parameter_means, 'double', mode='rw', ensure_zero_copy=True),
+            'parameter_comoments': Array(self._parameter_comoments, 'double', mode='rw', ensure_zero_copy=True)
+        }, '_mcmc_method_data')
+
+    def _get_proposal_update_function(self):
+        nmr_params = str(self._nmr_params)
+        kernel_source = Cholesky(memspace='private', memtype='mot_float_type').get_cl_code()
+        kernel_source += '''
+            void _updateProposalState(_mcmc_method_data* method_data, ulong current_iteration,
+                                      local mot_float_type* current_position){
+                double delta[''' + nmr_params + '''];
+                mot_float_type covariance[''' + str(self._nmr_params ** 2) + '''];
+
+                for(uint k = 0; k < ''' + nmr_params + '''; k++){
+                    delta[k] = current_position[k] - method_data->parameter_means[k];
+                    method_data->parameter_means[k] += delta[k] / (current_iteration + 1);
+                }
+                for(uint k = 0; k < ''' + nmr_params + '''; k++){
+                    for(uint l = 0; l <= k; l++){
+                        method_data->parameter_comoments[k * ''' + nmr_params + ''' + l] +=
+                            delta[k] * (current_position[l] - method_data->parameter_means[l]);
+                    }
+                }
+
+                if(current_iteration > ''' + str(self._waiting_period) + '''){
+                    for(uint k = 0; k < ''' + nmr_params + '''; k++){
+                        for(uint l = 0; l <= k; l++){
+                            covariance[k * ''' + nmr_params + ''' + l] = ''' + str(self._scaling_factor) + '''
+                                * method_data->parameter_comoments[k * ''' + nmr_params + ''' + l]
+                                / current_iteration;
+                            covariance[l * ''' + nmr_params + ''' + k] = covariance[k * ''' + nmr_params + ''' + l];
+                        }
+                        covariance[k * ''' + nmr_params + ''' + k] += ''' + str(self._scaling_factor) + '''
+                                                                          * ''' + str(self._epsilon) + ''';
+                    }
+
+                    if(cholesky_private_mot_float_type(covariance, ''' + nmr_params + ''')){
+                        for(uint k = 0; k < ''' + str(self._nmr_params ** 2) + '''; k++){
+                            method_data->proposal_cholesky[k] = covariance[k];
+                        }
+                    }
+                }
+            }
+        '''
+        return kernel_source
+
+    def _get_state_update_cl_func(self, nmr_samples, thinning, return_output):
+        nmr_params = str(self._nmr_params)
+        kernel_source = self._get_proposal_update_function()
+        kernel_source += self._finalize_proposal_func.get_cl_code()
+        kernel_source += '''
+            void _advanceSampler(
+                    void* method_data,
+                    void* data,
+                    ulong current_iteration,
+                    void* rng_data,
+                    local mot_float_type* current_position,
+                    local double* const current_likelihood,
+                    local mot_float_type* const current_prior){
+
+                local mot_float_type new_position[''' + nmr_params + '''];
+                local mot_float_type new_prior;
+                local double new_likelihood;
+                local double bayesian_f;
+                bool is_first_work_item = get_local_id(0) == 0;
+
+                global mot_float_type* proposal_cholesky = ((_mcmc_method_data*)method_data)->proposal_cholesky;
+                mot_float_type normal_draws[''' + nmr_params + '''];
+
+                if(is_first_work_item){
+                    for(uint k = 0; k < ''' + nmr_params + '''; k++){
+                        normal_draws[k] = frandn(rng_data);
+                    }
+                    for(uint k = 0; k < ''' + nmr_params + '''; k++){
+                        new_position[k] = current_position[k];
+                        for(uint l = 0; l <= k; l++){
+                            new_position[k] += proposal_cholesky[k * ''' + nmr_params + ''' + l] * normal_draws[l];
+                        }
+                    }
+                    ''' + self._finalize_proposal_func.get_cl_function_name() + '''(data, new_position);
+                    new_prior = _computeLogPrior(new_position, data);
+                }
+                barrier(CLK_LOCAL_MEM_FENCE);
+
+                if(exp(new_prior) > 0){
+                    new_likelihood = _computeLogLikelihood(new_position, data);
+
+                    if(is_first_work_item){
+                        bayesian_f = exp((new_likelihood + new_prior) - (*current_likelihood + *current_prior));
+
+                        if(frand(rng_data) < bayesian_f){
+                            *current_likelihood = new_likelihood;
+                            *current_prior = new_prior;
+                            for(uint k = 0; k < ''' + nmr_params + '''; k++){
+                                current_position[k] = new_position[k];
+                            }
+                        }
+                    }
+                }
+
+                if(is_first_work_item){
+                    _updateProposalState((_mcmc_method_data*)method_data, current_iteration, current_position);
+                }
+                barrier(CLK_LOCAL_MEM_FENCE);
+            }
+        '''
+        return kernel_source
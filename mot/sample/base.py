@@ -1,12 +1,13 @@
 import logging
+import os
 from contextlib import contextmanager
 
-from mot.lib.cl_function import SimpleCLFunction
+from mot.lib.cl_function import SimpleCLFunction, _ProcedureWorker
 from mot.configuration import CLRuntimeInfo
 from mot.library_functions import Rand123
 from mot.lib.utils import split_in_batches
 from mot.lib.kernel_data import Scalar, Array, \
-    Zeros, Struct
+    Zeros, Struct, GroupedData
 import numpy as np
 
 __author__ = 'Robbert Harms'
@@ -18,7 +19,7 @@ __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 class AbstractSampler:
 
-    def __init__(self, ll_func, log_prior_func, x0, data=None, cl_runtime_info=None, **kwargs):
+    def __init__(self, ll_func, log_prior_func, x0, data=None, cl_runtime_info=None, nmr_chains=1, **kwargs):
         """Abstract base class for sample routines.
 
         Sampling routines implementing this interface should be stateful objects that, for the given likelihood
@@ -39,16 +40,31 @@ class AbstractSampler:
 
             x0 (ndarray): the starting positions for the sampler. Should be a two dimensional matrix
                 with for every modeling instance (first dimension) and every parameter (second dimension) a value.
+                With multiple chains, this can also be a (d, k, p) matrix with a starting position per chain.
             data (mot.lib.kernel_data.KernelData): the user provided data for the ``void* data`` pointer.
+            nmr_chains (int): the number of independent chains per modeling instance. The chains are laid out as
+                extra problem instances, with chain ``c`` of problem ``i`` at index ``i * nmr_chains + c`` in the
+                sampler state and in the sample output. All chains of a problem share the ``data`` of that problem.
+                With multiple chains, we compute the split-R-hat at the end of every batch,
+                see :meth:`get_convergence_diagnostics`.
         """
         self._cl_runtime_info = cl_runtime_info or CLRuntimeInfo()
         self._logger = logging.getLogger(__name__)
         self._ll_func = ll_func
         self._log_prior_func = log_prior_func
         self._data = data
+        self._nmr_chains = nmr_chains
         self._x0 = x0
         if len(x0.shape) < 2:
             self._x0 = self._x0[..., None]
+        if len(self._x0.shape) == 3:
+            if self._x0.shape[1] != nmr_chains:
+                raise ValueError('The starting positions should be given for {} chains, {} given.'.format(
+                    nmr_chains, self._x0.shape[1]))
+            self._x0 = np.reshape(self._x0, (-1, self._x0.shape[2]))
+        elif nmr_chains > 1:
+            self._x0 = np.repeat(self._x0, nmr_chains, axis=0)
+        self._convergence_diagnostics = None
         self._nmr_problems = self._x0.shape[0]
         self._nmr_params = self._x0.shape[1]
         self._sampling_index = 0
@@ -58,6 +74,28 @@ class AbstractSampler:
         self._rng_state = np.random.uniform(low=np.iinfo(np.uint32).min, high=np.iinfo(np.uint32).max + 1,
                                             size=(self._nmr_problems, 6)).astype(np.uint32)
 
+    def get_convergence_diagnostics(self):
+        """Get the convergence diagnostics over the chains of every problem, computed on the device.
+
+        With multiple chains, we split every chain in two halves and compute per problem and parameter the
+        split-R-hat (the potential scale reduction factor) over the ``2 * nmr_chains`` half chains:
+
+        .. code-block:: none
+
+            W = mean of the within half-chain variances
+            B = n times the variance of the half-chain means
+            R-hat = sqrt(((n - 1) / n * W + B / n) / W)
+
+        where ``n`` is the (average) length of the half chains. This is updated after every batch, using the
+        samples of the current, or last, call to :meth:`sample`, such that it can be monitored while sampling.
+
+        Returns:
+            dict or None: with the (d, p) matrices ``rhat``, ``within_chain_variance`` and
+                ``between_chain_variance``, for d problems and p parameters. None if we are not using multiple
+                chains or have not sampled yet.
+        """
+        return self._convergence_diagnostics
+
     def set_cl_runtime_info(self, cl_runtime_info):
         """Update the CL runtime information.
 
@@ -66,7 +104,7 @@ class AbstractSampler:
         """
         self._cl_runtime_info = cl_runtime_info
 
-    def sample(self, nmr_samples, burnin=0, thinning=1):
+    def sample(self, nmr_samples, burnin=0, thinning=1, output=None, summary=None):
         """Take additional samples from the given likelihood and prior, using this sampler.
 
         This method can be called multiple times in which the sample state is stored in between.
@@ -77,9 +115,66 @@ class AbstractSampler:
             thinning (int): how many sample we wait before storing a new one. This will draw extra samples such that
                     the total number of samples generated is ``nmr_samples * (thinning)`` and the number of samples
                     stored is ``nmr_samples``. If set to one or lower we store every sample after the burn in.
+            output (SampleOutputWriter): if given, every batch of samples is written to this writer directly,
+                instead of concatenating all the batches in memory.
+            summary (str or None): if set, we do not store the samples but only accumulate summary statistics of
+                the samples on the device, using Welford's online algorithm. Set to 'variance' for the means and
+                variances of the parameters, or to 'covariance' for the means and the full covariance matrices.
+                This uses memory linear or quadratic in the number of parameters instead of linear in the number
+                of samples. This can not be combined with an output writer.
 
         Returns:
-            SamplingOutput: the sample output object
+            SamplingOutput or SampleSummary: the sample output object, if an output writer is given, the output of
+                that writer. If a summary is requested, the sample summary.
+        """
+        if summary is not None:
+            if output is not None:
+                raise ValueError('The sample summary can not be combined with an output writer.')
+            if summary not in ('variance', 'covariance'):
+                raise ValueError('The summary should be "variance" or "covariance", "{}" given.'.format(summary))
+
+            sample_summary = SampleSummary(self._nmr_problems, self._nmr_params, covariance=summary == 'covariance')
+            for _ in self._sample_batches(nmr_samples, burnin, thinning, summary=sample_summary):
+                pass
+            return sample_summary
+
+        if output is not None:
+            for batch_start, batch_output in self._sample_batches(nmr_samples, burnin, thinning):
+                output.write(batch_output, batch_start)
+            return output.get_output()
+
+        outputs = [batch_output for _, batch_output in self._sample_batches(nmr_samples, burnin, thinning)]
+        if outputs:
+            return SimpleSampleOutput(*[np.concatenate([o[ind] for o in outputs], axis=-1) for ind in range(3)])
+
+    def sample_iter(self, nmr_samples, burnin=0, thinning=1):
+        """Take additional samples like :meth:`sample`, but yield the samples per batch.
+
+        This allows processing or storing the samples while sampling, without having all the samples in memory.
+
+        Args:
+            nmr_samples (int): the number of samples to return
+            burnin (int): the number of samples to discard before returning samples
+            thinning (int): how many sample we wait before storing a new one, see :meth:`sample`.
+
+        Yields:
+            SamplingOutput: the sample output of every batch, with the samples of the batches in order
+        """
+        for _, batch_output in self._sample_batches(nmr_samples, burnin, thinning):
+            yield SimpleSampleOutput(*batch_output)
+
+    def _sample_batches(self, nmr_samples, burnin, thinning, summary=None):
+        """Run the burn-in and yield the output of every batch of samples.
+
+        Args:
+            nmr_samples (int): the number of samples to return
+            burnin (int): the number of samples to discard before returning samples
+            thinning (int): how many sample we wait before storing a new one
+            summary (SampleSummary): if given, we update this summary instead of returning the samples
+
+        Yields:
+            tuple: the index of the first sample in the batch and a tuple with the (samples, log_likelihoods,
+                log_priors) of the batch, or None if a summary is given.
         """
         if not thinning or thinning < 1:
             thinning = 1
@@ -91,12 +186,30 @@ class AbstractSampler:
                 for batch_start, batch_end in split_in_batches(burnin, max(1000 // thinning, 100)):
                     self._sample(batch_end - batch_start, return_output=False)
             if nmr_samples > 0:
-                outputs = []
-                for batch_start, batch_end in split_in_batches(nmr_samples, max(1000 // thinning, 100)):
-                    outputs.append(self._sample(batch_end - batch_start, thinning=thinning))
-                return SimpleSampleOutput(*[np.concatenate([o[ind] for o in outputs], axis=-1) for ind in range(3)])
-
-    def _sample(self, nmr_samples, thinning=1, return_output=True):
+                summaries = {}
+                if summary is not None:
+                    summaries['summary'] = summary
+
+                # with multiple chains, we summarize the two halves of the chains separately for the split-R-hat
+                sample_ranges = [(0, nmr_samples)]
+                chain_summaries = []
+                if self._nmr_chains > 1:
+                    sample_ranges = [(0, nmr_samples // 2), (nmr_samples // 2, nmr_samples)]
+                    chain_summaries = [SampleSummary(self._nmr_problems, self._nmr_params) for _ in range(2)]
+
+                for range_ind, (range_start, range_end) in enumerate(sample_ranges):
+                    if chain_summaries:
+                        summaries['chain_summary'] = chain_summaries[range_ind]
+
+                    for batch_start, batch_end in split_in_batches(range_end - range_start,
+                                                                   max(1000 // thinning, 100)):
+                        output = self._sample(batch_end - batch_start, thinning=thinning,
+                                              return_output=summary is None, summaries=summaries)
+                        if chain_summaries:
+                            self._update_convergence_diagnostics(chain_summaries)
+                        yield range_start + batch_start, output
+
+    def _sample(self, nmr_samples, thinning=1, return_output=True, summaries=None):
         """Sample the given number of samples with the given thinning.
 
         If ``return_output`` we will return the samples, log likelihoods and log priors. If not, we will advance the
@@ -106,12 +219,18 @@ class AbstractSampler:
             nmr_samples (int): the number of iterations to advance the sampler
             thinning (int): the thinning to apply
             return_output (boolean): if we should return the output
+            summaries (dict[str: SampleSummary]): if given, the summaries to update with the thinned samples,
+                indexed by the prefix of their kernel data names
 
         Returns:
             None or tuple: if ``return_output`` is True three ndarrays as (samples, log_likelihoods, log_priors)
         """
         kernel_data = self._get_kernel_data(nmr_samples, thinning, return_output)
-        sample_func = self._get_compute_func(nmr_samples, thinning, return_output)
+        summary_modes = {}
+        for prefix, summary in (summaries or {}).items():
+            kernel_data.update(summary.get_kernel_data(prefix))
+            summary_modes[prefix] = summary.get_mode()
+        sample_func = self._get_compute_func(nmr_samples, thinning, return_output, summary_modes=summary_modes)
         sample_func.evaluate(kernel_data, self._nmr_problems,
                              use_local_reduction=all(env.is_gpu for env in self._cl_runtime_info.get_cl_environments()),
                              cl_runtime_info=self._cl_runtime_info)
@@ -122,6 +241,115 @@ class AbstractSampler:
                     kernel_data['log_likelihoods'].get_data(),
                     kernel_data['log_priors'].get_data())
 
+    def _update_convergence_diagnostics(self, chain_summaries):
+        """Compute the split-R-hat on the device from the summaries of the first and second half of the chains.
+
+        This runs one work item per problem, which reads the accumulators of the ``2 * nmr_chains`` half chains of
+        its problem. Half chains with less than two samples are skipped, if less than two half chains remain we
+        return NaN's.
+
+        Args:
+            chain_summaries (list[SampleSummary]): the variance summaries of the first and of the second half of
+                the chains, with one row per chain.
+        """
+        nmr_problems = self._nmr_problems // self._nmr_chains
+        offset = '{problem_id} * ' + str(self._nmr_chains)
+        params_offset = offset + ' * ' + str(self._nmr_params)
+
+        kernel_data = {
+            'rhat': Zeros((nmr_problems, self._nmr_params), 'double'),
+            'within_chain_variance': Zeros((nmr_problems, self._nmr_params), 'double'),
+            'between_chain_variance': Zeros((nmr_problems, self._nmr_params), 'double')}
+        for ind, summary in enumerate(chain_summaries):
+            kernel_data.update({
+                'counts_' + str(ind): Array(summary._counts, 'ulong', offset_str=offset),
+                'means_' + str(ind): Array(summary._means, 'double', offset_str=params_offset),
+                'm2s_' + str(ind): Array(summary._m2s, 'double', offset_str=params_offset)})
+
+        rhat_func = SimpleCLFunction.from_string('''
+            void _computeSplitRhat(global ulong* counts_0, global double* means_0, global double* m2s_0,
+                                   global ulong* counts_1, global double* means_1, global double* m2s_1,
+                                   global double* rhat,
+                                   global double* within_chain_variance,
+                                   global double* between_chain_variance){
+                global ulong* counts[2] = {counts_0, counts_1};
+                global double* means[2] = {means_0, means_1};
+                global double* m2s[2] = {m2s_0, m2s_1};
+
+                uint nmr_splits;
+                double n, grand_mean, W, B, var_plus;
+
+                for(uint j = 0; j < ''' + str(self._nmr_params) + '''; j++){
+                    nmr_splits = 0;
+                    n = 0;
+                    grand_mean = 0;
+                    W = 0;
+                    for(uint split = 0; split < 2; split++){
+                        for(uint c = 0; c < ''' + str(self._nmr_chains) + '''; c++){
+                            if(counts[split][c] > 1){
+                                nmr_splits++;
+                                n += counts[split][c];
+                                grand_mean += means[split][c * ''' + str(self._nmr_params) + ''' + j];
+                                W += m2s[split][c * ''' + str(self._nmr_params) + ''' + j] / (counts[split][c] - 1);
+                            }
+                        }
+                    }
+
+                    if(nmr_splits < 2){
+                        rhat[j] = NAN;
+                        within_chain_variance[j] = NAN;
+                        between_chain_variance[j] = NAN;
+                        continue;
+                    }
+
+                    n /= nmr_splits;
+                    grand_mean /= nmr_splits;
+                    W /= nmr_splits;
+
+                    B = 0;
+                    for(uint split = 0; split < 2; split++){
+                        for(uint c = 0; c < ''' + str(self._nmr_chains) + '''; c++){
+                            if(counts[split][c] > 1){
+                                B += pown(means[split][c * ''' + str(self._nmr_params) + ''' + j] - grand_mean, 2);
+                            }
+                        }
+                    }
+                    B *= n / (nmr_splits - 1);
+
+                    var_plus = (n - 1) / n * W + B / n;
+
+                    rhat[j] = sqrt(var_plus / W);
+                    within_chain_variance[j] = W;
+                    between_chain_variance[j] = B;
+                }
+            }
+        ''')
+        rhat_func.evaluate(kernel_data, nmr_problems, cl_runtime_info=self._cl_runtime_info)
+
+        self._convergence_diagnostics = {key: kernel_data[key].get_data() for key in
+                                         ['rhat', 'within_chain_variance', 'between_chain_variance']}
+
+    def _repeat_over_chains(self, values, name):
+        """Repeat per-instance settings over the chains of every modeling instance.
+
+        Args:
+            values (ndarray): the settings, with in the first dimension either one entry per chain or one
+                entry per modeling instance.
+            name (str): the name of the settings, used in the error message
+
+        Returns:
+            ndarray: the settings with one entry per chain in the first dimension
+
+        Raises:
+            ValueError: if the first dimension matches neither the number of chains nor the number of instances
+        """
+        if values.shape[0] == self._nmr_problems:
+            return values
+        if self._nmr_chains > 1 and values.shape[0] == self._nmr_problems // self._nmr_chains:
+            return np.repeat(values, self._nmr_chains, axis=0)
+        raise ValueError('The {} should be given for {} modeling instances or {} chains, {} given.'.format(
+            name, self._nmr_problems // self._nmr_chains, self._nmr_problems, values.shape[0]))
+
     def _get_kernel_data(self, nmr_samples, thinning, return_output):
         """Get the kernel data we will input to the MCMC sampler.
 
@@ -148,7 +376,11 @@ class AbstractSampler:
         Returns:
             dict[str: mot.lib.utils.KernelData]: the kernel input data
         """
-        kernel_data = {'data': self._data}
+        data = self._data
+        if self._nmr_chains > 1 and data is not None:
+            data = GroupedData(data, self._nmr_chains)
+
+        kernel_data = {'data': data}
         kernel_data.update({
             'method_data': self._get_mcmc_method_kernel_data(),
             'nmr_iterations': Scalar(nmr_samples * thinning, ctype='ulong'),
@@ -184,26 +416,58 @@ class AbstractSampler:
         """
         pass
 
-    def _get_compute_func(self, nmr_samples, thinning, return_output):
+    def _get_compute_func(self, nmr_samples, thinning, return_output, iteration_range_input=False,
+                          summary_modes=None):
         """Get the MCMC algorithm as a computable function.
 
         Args:
             nmr_samples (int): the number of samples we will draw
             thinning (int): the thinning factor we want to use
             return_output (boolean): if the kernel should return output
+            iteration_range_input (boolean): if set, the iteration offset and the number of iterations are not
+                compiled into the kernel but read from the two elements of the ``iteration_range`` kernel input.
+                The number of iterations should then not exceed ``nmr_samples * thinning``.
+            summary_modes (dict[str: str]): per kernel data prefix the mode of a summary, either 'variance' or
+                'covariance'. For every prefix, we update the summary statistics in the kernel inputs
+                ``<prefix>_counts``, ``<prefix>_means`` and ``<prefix>_m2s`` with every thinned sample,
+                see :class:`SampleSummary`.
 
         Returns:
             mot.lib.cl_function.CLFunction: the compute function
         """
         kernel_source = self._get_state_update_cl_func(nmr_samples, thinning, return_output)
+        summary_modes = summary_modes or {}
+        for summary_mode in sorted(set(summary_modes.values())):
+            kernel_source += self._get_summary_update_cl_func(summary_mode == 'covariance')
+
+        summary_arguments = ''
+        summary_updates = ''
+        for prefix, summary_mode in sorted(summary_modes.items()):
+            summary_arguments += '''
+                global ulong* {prefix}_counts, global double* {prefix}_means, global double* {prefix}_m2s,
+            '''.format(prefix=prefix)
+            summary_updates += '''
+                _updateSampleSummary_{mode}(current_position, {prefix}_counts, {prefix}_means, {prefix}_m2s);
+            '''.format(prefix=prefix, mode=summary_mode)
+
+        iteration_arguments = 'ulong iteration_offset, ulong nmr_iterations,'
+        iteration_init = ''
+        if iteration_range_input:
+            iteration_arguments = 'global ulong* iteration_range,'
+            iteration_init = '''
+                ulong iteration_offset = iteration_range[0];
+                ulong nmr_iterations = iteration_range[1];
+            '''
 
         cl_func = '''
             void compute(global uint* rng_state, global mot_float_type* current_chain_position,
-                         ulong iteration_offset, ulong nmr_iterations, 
+                         ''' + iteration_arguments + ''' 
                          ''' + ('''global mot_float_type* samples, 
                                    global mot_float_type* log_likelihoods,
                                    global mot_float_type* log_priors,''' if return_output else '') + '''
+                         ''' + summary_arguments + '''
                          void* method_data, void* data){
+                ''' + iteration_init + '''
                 bool is_first_work_item = get_local_id(0) == 0;
     
                 rand123_data rand123_rng_data = rand123_initialize_data((uint[]){
@@ -243,6 +507,12 @@ class AbstractSampler:
                         }
                     }
         '''
+        if summary_modes:
+            cl_func += '''
+                    if(is_first_work_item && i % ''' + str(thinning) + ''' == 0){
+                        ''' + summary_updates + '''
+                    }
+        '''
         cl_func += '''
                     _advanceSampler(method_data, data, i + iteration_offset, rng_data, 
                                     current_position, &current_likelihood, &current_prior);
@@ -290,6 +560,67 @@ class AbstractSampler:
         """
         raise NotImplementedError()
 
+    def _get_summary_update_cl_func(self, covariance):
+        r"""Get the CL function updating the summary statistics with a new sample.
+
+        This uses the online algorithm by Welford, extended to co-moments for the covariance:
+
+        .. math::
+
+            \delta = x - \bar{x}_{n-1}, \quad
+            \bar{x}_n = \bar{x}_{n-1} + \delta / n, \quad
+            M_n = M_{n-1} + \delta (x - \bar{x}_n)^T
+
+        Args:
+            covariance (boolean): if we update the full (p, p) co-moment matrix or only its (p,) diagonal
+
+        Returns:
+            str: a CL function with signature:
+
+            .. code-block:: c
+
+                void _updateSampleSummary_<mode>(local mot_float_type* current_position,
+                                                 global ulong* summary_count,
+                                                 global double* summary_means,
+                                                 global double* summary_m2s);
+
+            where ``<mode>`` is either ``variance`` or ``covariance``.
+        """
+        nmr_params = str(self._nmr_params)
+
+        if covariance:
+            m2_update = '''
+                for(uint j = 0; j < ''' + nmr_params + '''; j++){
+                    for(uint k = 0; k < ''' + nmr_params + '''; k++){
+                        summary_m2s[j * ''' + nmr_params + ''' + k] += 
+                            deltas[j] * (current_position[k] - summary_means[k]);
+                    }
+                }
+            '''
+        else:
+            m2_update = '''
+                for(uint j = 0; j < ''' + nmr_params + '''; j++){
+                    summary_m2s[j] += deltas[j] * (current_position[j] - summary_means[j]);
+                }
+            '''
+
+        return '''
+            void _updateSampleSummary_''' + ('covariance' if covariance else 'variance') + '''(
+                    local mot_float_type* current_position,
+                    global ulong* summary_count,
+                    global double* summary_means,
+                    global double* summary_m2s){
+                double deltas[''' + nmr_params + '''];
+
+                *summary_count += 1;
+                for(uint j = 0; j < ''' + nmr_params + '''; j++){
+                    deltas[j] = current_position[j] - summary_means[j];
+                    summary_means[j] += deltas[j] / *summary_count;
+                }
+                ''' + m2_update + '''
+            }
+        '''
+
     def _get_log_prior_cl_func(self):
         """Get the CL log prior compute function.
 
@@ -342,6 +673,126 @@ class AbstractSampler:
         self._logger.info('Finished sample')
 
 
+class SamplerSession:
+
+    def __init__(self, sampler, batch_size=1000, thinning=1):
+        """Keeps the chain state and the compiled kernel of a sampler resident on the compute devices.
+
+        Every batch in :meth:`AbstractSampler.sample` creates new kernel data and device buffers, compiles the
+        kernel and reads the complete chain state back. This session instead compiles the sampling kernel once and
+        allocates the device buffers for the chain positions, the random number generator states and the method
+        data (like the proposal standard deviations and the adaptation statistics) once per device. Per batch we only
+        write the iteration range to the device and read back the samples, log likelihoods and log priors.
+
+        The state of the sampler is only updated on :meth:`sync` and :meth:`close`, after which the sampler can be
+        used as before. Do not use the sampler itself while the session is open. Since the state stays on the
+        devices, every device is assigned a fixed range of problems instead of using the load balancer.
+
+        This can be used as a context manager, closing the session at exit.
+
+        Args:
+            sampler (AbstractSampler): the sampler of which we keep the state and kernel resident
+            batch_size (int): the maximum number of samples drawn per kernel run, determining the size of the
+                output buffers.
+            thinning (int): how many samples we wait before storing a new one, see :meth:`AbstractSampler.sample`.
+        """
+        self._sampler = sampler
+        self._batch_size = batch_size
+        self._thinning = max(thinning or 1, 1)
+        self._output_names = ['samples', 'log_likelihoods', 'log_priors']
+        self._state_names = ['rng_state', 'current_chain_position', 'method_data']
+
+        self._kernel_data = sampler._get_kernel_data(self._batch_size, self._thinning, True)
+        del self._kernel_data['nmr_iterations']
+        del self._kernel_data['iteration_offset']
+        self._kernel_data['iteration_range'] = Array(np.zeros(2, dtype=np.uint64), 'ulong', offset_str='0')
+        if self._kernel_data['data'] is None:
+            self._kernel_data['data'] = Scalar(0)
+
+        compute_func = sampler._get_compute_func(self._batch_size, self._thinning, True, iteration_range_input=True)
+
+        cl_runtime_info = sampler._cl_runtime_info
+        cl_environments = cl_runtime_info.load_balancer.get_used_cl_environments(
+            cl_runtime_info.get_cl_environments())
+        use_local_reduction = all(env.is_gpu for env in cl_runtime_info.get_cl_environments())
+
+        self._problem_ranges = list(split_in_batches(
+            sampler._nmr_problems, max(int(np.ceil(sampler._nmr_problems / len(cl_environments))), 1)))
+        self._workers = [_ProcedureWorker(env, cl_runtime_info.get_compile_flags(), compute_func,
+                                          self._kernel_data, cl_runtime_info.double_precision, use_local_reduction)
+                         for env, _ in zip(cl_environments, self._problem_ranges)]
+
+    def step(self, nmr_samples, return_output=True):
+        """Continue the chains with the given number of samples.
+
+        Args:
+            nmr_samples (int): the number of samples to draw. With thinning, this advances the chains by
+                ``nmr_samples * thinning`` iterations.
+            return_output (boolean): if we should return the samples. If not, we only advance the chains, for example
+                for burn-in, and transfer nothing back from the device.
+
+        Returns:
+            SamplingOutput or None: the sample output object, if ``return_output`` is set
+        """
+        if self._workers is None:
+            raise ValueError('This sampler session is already closed.')
+
+        outputs = []
+        for batch_start, batch_end in split_in_batches(nmr_samples, self._batch_size):
+            nmr_batch_samples = batch_end - batch_start
+            self._run_batch(nmr_batch_samples * self._thinning, return_output)
+
+            if return_output:
+                outputs.append([np.copy(self._kernel_data[name].get_data()[..., :nmr_batch_samples])
+                                for name in self._output_names])
+
+        if return_output and outputs:
+            return SimpleSampleOutput(*[np.concatenate([o[ind] for o in outputs], axis=-1) for ind in range(3)])
+
+    def sync(self):
+        """Read the chain state back from the devices and update the sampler with it."""
+        if self._workers is None:
+            return
+
+        for worker, (range_start, range_end) in zip(self._workers, self._problem_ranges):
+            worker.enqueue_readouts(range_start, range_end, names=self._state_names)
+        for worker in self._workers:
+            worker.cl_queue.finish()
+        self._sampler._readout_kernel_data(self._kernel_data)
+
+    def close(self):
+        """Synchronize the sampler state and release the device buffers and kernels."""
+        self.sync()
+        self._workers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run_batch(self, nmr_iterations, return_output):
+        """Run the kernel on all the devices for the given number of iterations.
+
+        Args:
+            nmr_iterations (int): the number of iterations, at most the batch size times the thinning
+            return_output (boolean): if we should read out the samples, log likelihoods and log priors
+        """
+        iteration_range = np.array([self._sampler._sampling_index, nmr_iterations], dtype=np.uint64)
+
+        for worker, (range_start, range_end) in zip(self._workers, self._problem_ranges):
+            worker.enqueue_write('iteration_range', iteration_range)
+            worker.enqueue_kernel(range_start, range_end)
+            if return_output:
+                worker.enqueue_readouts(range_start, range_end, names=self._output_names)
+            worker.cl_queue.flush()
+
+        for worker in self._workers:
+            worker.cl_queue.finish()
+
+        self._sampler._sampling_index += nmr_iterations
+
+
 class AbstractRWMSampler(AbstractSampler):
 
     def __init__(self, ll_func, log_prior_func, x0, proposal_stds, use_random_scan=False,
@@ -357,6 +808,7 @@ class AbstractRWMSampler(AbstractSampler):
             x0 (ndarray): the starting positions for the sampler. Should be a two dimensional matrix
                 with for every modeling instance (first dimension) and every parameter (second dimension) a value.
             proposal_stds (ndarray): for every parameter and every modeling instance an initial proposal std.
+                With multiple chains, this is given either per modeling instance or per chain.
             use_random_scan (boolean): if we iterate over the parameters in a random order or in a linear order
                 at every sample iteration. By default we apply a system scan starting from the first dimension to the
                 last. With a random scan we randomize the indices every iteration.
@@ -383,6 +835,7 @@ class AbstractRWMSampler(AbstractSampler):
         super().__init__(ll_func, log_prior_func, x0, **kwargs)
         self._proposal_stds = np.copy(np.require(proposal_stds, requirements='CAOW',
                                                  dtype=self._cl_runtime_info.mot_float_dtype))
+        self._proposal_stds = self._repeat_over_chains(self._proposal_stds, 'proposal stds')
         self._use_random_scan = use_random_scan
         self._finalize_proposal_func = finalize_proposal_func or SimpleCLFunction.from_string(
             'void finalizeProposal(void* data, local mot_float_type* x){}')
@@ -555,6 +1008,166 @@ class SamplingOutput:
         raise NotImplementedError()
 
 
+class SampleOutputWriter:
+
+    def write(self, output, sample_index):
+        """Write a batch of samples.
+
+        Args:
+            output (tuple): the (samples, log_likelihoods, log_priors) of the batch, with for d problems,
+                p parameters and n samples in the batch, matrices of shape (d, p, n), (d, n) and (d, n).
+            sample_index (int): the index of the first sample of this batch in the complete output
+        """
+        raise NotImplementedError()
+
+    def get_output(self):
+        """Get the written output.
+
+        Returns:
+            SamplingOutput: the sample output
+        """
+        raise NotImplementedError()
+
+
+class ArraySampleOutputWriter(SampleOutputWriter):
+
+    def __init__(self, samples, log_likelihoods=None, log_priors=None):
+        """Writes the sample output into the given preallocated arrays.
+
+        The arrays can be any array-like supporting slice assignment, like ndarrays or memory mapped arrays.
+
+        Args:
+            samples (ndarray): a (d, p, n) array for the samples of d problems, p parameters and n samples
+            log_likelihoods (ndarray): a (d, n) array for the log likelihoods, if None we do not store these
+            log_priors (ndarray): a (d, n) array for the log priors, if None we do not store these
+        """
+        self._samples = samples
+        self._log_likelihoods = log_likelihoods
+        self._log_priors = log_priors
+
+    @classmethod
+    def from_memmap(cls, directory, nmr_problems, nmr_params, nmr_samples, dtype=np.float32):
+        """Create a writer writing to new memory mapped numpy files in the given directory.
+
+        This writes the files ``samples.npy``, ``log_likelihoods.npy`` and ``log_priors.npy``, which can afterwards
+        be loaded with ``np.load``.
+
+        Args:
+            directory (str): the directory to write the files to
+            nmr_problems (int): the number of problems
+            nmr_params (int): the number of parameters
+            nmr_samples (int): the number of samples
+            dtype (dtype): the data type of the stored values
+
+        Returns:
+            ArraySampleOutputWriter: the writer
+        """
+        def open_memmap(name, shape):
+            return np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+',
+                                             dtype=dtype, shape=shape)
+
+        return cls(open_memmap('samples', (nmr_problems, nmr_params, nmr_samples)),
+                   open_memmap('log_likelihoods', (nmr_problems, nmr_samples)),
+                   open_memmap('log_priors', (nmr_problems, nmr_samples)))
+
+    def write(self, output, sample_index):
+        samples, log_likelihoods, log_priors = output
+        batch = slice(sample_index, sample_index + samples.shape[-1])
+
+        self._samples[..., batch] = samples
+        if self._log_likelihoods is not None:
+            self._log_likelihoods[..., batch] = log_likelihoods
+        if self._log_priors is not None:
+            self._log_priors[..., batch] = log_priors
+
+    def get_output(self):
+        return SimpleSampleOutput(self._samples, self._log_likelihoods, self._log_priors)
+
+
+class SampleSummary:
+
+    def __init__(self, nmr_problems, nmr_params, covariance=False):
+        """Summary statistics of the samples, accumulated on the compute device while sampling.
+
+        This holds per problem the number of summarized samples, the means and the sums of the squared deviations
+        from the means, or the full co-moment matrices, updated using Welford's online algorithm in double precision.
+
+        Args:
+            nmr_problems (int): the number of problems
+            nmr_params (int): the number of parameters
+            covariance (boolean): if we accumulate the full covariance matrices, or only the variances
+        """
+        self._covariance = covariance
+        self._counts = np.zeros(nmr_problems, dtype=np.uint64)
+        self._means = np.zeros((nmr_problems, nmr_params), dtype=np.float64)
+        if covariance:
+            self._m2s = np.zeros((nmr_problems, nmr_params, nmr_params), dtype=np.float64)
+        else:
+            self._m2s = np.zeros((nmr_problems, nmr_params), dtype=np.float64)
+
+    def get_mode(self):
+        """Get the summary mode, either 'variance' or 'covariance'."""
+        return 'covariance' if self._covariance else 'variance'
+
+    def get_kernel_data(self, prefix='summary'):
+        """Get the kernel data for updating this summary in the sampling kernel.
+
+        Args:
+            prefix (str): the prefix of the kernel data names
+
+        Returns:
+            dict[str: mot.lib.kernel_data.KernelData]: the kernel data, updating the arrays of this summary
+        """
+        return {prefix + '_counts': Array(self._counts, 'ulong', mode='rw', ensure_zero_copy=True),
+                prefix + '_means': Array(self._means, 'double', mode='rw', ensure_zero_copy=True),
+                prefix + '_m2s': Array(self._m2s, 'double', mode='rw', ensure_zero_copy=True)}
+
+    def get_nmr_samples(self):
+        """Get the number of samples summarized per problem.
+
+        Returns:
+            ndarray: a (d,) vector with the number of samples for d problems.
+        """
+        return self._counts
+
+    def get_means(self):
+        """Get the sample means.
+
+        Returns:
+            ndarray: a (d, p) matrix with for d problems and p parameters the means
+        """
+        return self._means
+
+    def get_variances(self):
+        """Get the (unbiased) sample variances.
+
+        Returns:
+            ndarray: a (d, p) matrix with for d problems and p parameters the variances
+        """
+        m2s = self._m2s
+        if self._covariance:
+            m2s = np.diagonal(m2s, axis1=1, axis2=2)
+        return m2s / (self._counts[:, None] - 1)
+
+    def get_stds(self):
+        """Get the sample standard deviations.
+
+        Returns:
+            ndarray: a (d, p) matrix with for d problems and p parameters the standard deviations
+        """
+        return np.sqrt(self.get_variances())
+
+    def get_covariances(self):
+        """Get the (unbiased) sample covariance matrices.
+
+        Returns:
+            ndarray: a (d, p, p) matrix with for d problems the covariance matrix of the p parameters
+        """
+        if not self._covariance:
+            raise ValueError('The covariances were not accumulated, use the "covariance" summary mode.')
+        return self._m2s / (self._counts[:, None, None] - 1)
+
+
 class SimpleSampleOutput(SamplingOutput):
 
     def __init__(self, samples, log_likelihoods, log_priors):
@@ -0,0 +1,346 @@
+import numpy as np
+from mot.lib.cl_function import SimpleCLFunction
+from mot.sample.base import AbstractSampler
+from mot.lib.kernel_data import Array, Struct
+
+__author__ = 'Robbert Harms'
+__license__ = "LGPL v3"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class HamiltonianMonteCarlo(AbstractSampler):
+
+    def __init__(self, ll_func, log_prior_func, x0, gradient_func=None, step_size=0.1, nmr_leapfrog_steps=10,
+                 nmr_adaptation_steps=1000, target_acceptance_rate=0.65, step_size_jitter=0.2,
+                 numerical_gradient_step=None, finalize_proposal_func=None, **kwargs):
+        r"""An implementation of the Hamiltonian Monte Carlo (HMC) MCMC algorithm [1].
+
+        Every iteration we draw a momentum :math:`r \sim N(0, M)` and integrate the Hamiltonian dynamics of the
+        position and momentum with ``nmr_leapfrog_steps`` leapfrog steps of size :math:`\epsilon`. The end point is
+        accepted with probability :math:`\min(1, \exp(H_0 - H_L))`, with the Hamiltonian
+        :math:`H = -\log p(x) + r^T M^{-1} r / 2`. The leapfrog integration uses the gradient of the log posterior,
+        computed by the given ``gradient_func`` or, if not given, by central differences of the log likelihood
+        plus the log prior in the sampling kernel. The position, momentum and gradient are kept in local memory.
+
+        During the first ``nmr_adaptation_steps`` iterations we adapt the step size and the diagonal mass matrix
+        :math:`M`, similar to [2]:
+
+        * the step size is adapted with the dual averaging algorithm of [2] towards the target acceptance rate;
+        * the inverse mass matrix is set to the (regularized) variance of the samples between 1/4 and 3/4 of the
+          adaptation steps, after which the step size adaptation is restarted;
+        * at the end of the adaptation the step size is fixed to the averaged step size of the dual averaging.
+
+        To prevent periodic trajectories, which lead to highly correlated samples, every iteration the step size
+        is multiplied by a random factor drawn uniformly from ``[1 - step_size_jitter, 1 + step_size_jitter]``.
+
+        Since the adaptation depends on the iteration index, the ``burnin`` of :meth:`sample` should be at least
+        ``nmr_adaptation_steps`` for the returned samples to come from a fixed, and hence valid, MCMC kernel.
+
+        Args:
+            ll_func (mot.lib.cl_function.CLFunction): The log-likelihood function. See parent docs.
+            log_prior_func (mot.lib.cl_function.CLFunction): The log-prior function. See parent docs.
+            x0 (ndarray): the starting positions for the sampler. Should be a two dimensional matrix
+                with for every modeling instance (first dimension) and every parameter (second dimension) a value.
+            gradient_func (mot.lib.cl_function.CLFunction): the gradient of the log-likelihood plus the log-prior.
+                If None, we use central differences in the sampling kernel, costing two log-likelihood evaluations
+                per parameter per gradient. This function is called by all the work items of a work group and
+                should have written the complete gradient on return. Signature:
+
+                .. code-block:: c
+
+                    void <func_name>(local const mot_float_type* const x,
+                                     void* data,
+                                     local mot_float_type* gradient);
+
+            step_size (float or ndarray): the initial leapfrog step size, a scalar or one per modeling instance.
+            nmr_leapfrog_steps (int): the number of leapfrog steps per iteration.
+            nmr_adaptation_steps (int): the number of iterations in which we adapt the step size and mass matrix.
+            target_acceptance_rate (float): the target acceptance rate of the step size adaptation.
+            step_size_jitter (float): the relative amount of random jitter applied to the step size.
+            numerical_gradient_step (float): the relative step size for the numerical gradient, defaults to
+                the cube root of the machine epsilon of the floating point type.
+            finalize_proposal_func (mot.lib.cl_function.CLFunction): a CL function to finalize the position after
+                every leapfrog step, see :class:`~mot.sample.base.AbstractRWMSampler`. This should only be used for
+                transformations that leave the posterior unchanged, like the modulus of a periodic parameter.
+                If None, we will not use this callback.
+
+        References:
+            [1] Neal, R. M. (2011). MCMC using Hamiltonian dynamics. In Handbook of Markov Chain Monte Carlo
+                (pp. 113-162). Chapman & Hall/CRC.
+            [2] Hoffman, M. D., & Gelman, A. (2014). The No-U-Turn sampler: adaptively setting path lengths in
+                Hamiltonian Monte Carlo. Journal of Machine Learning Research, 15(1), 1593-1623.
+        """
+        super().__init__(ll_func, log_prior_func, x0, **kwargs)
+        self._gradient_func = gradient_func
+        self._nmr_leapfrog_steps = nmr_leapfrog_steps
+        self._nmr_adaptation_steps = nmr_adaptation_steps
+        self._target_acceptance_rate = target_acceptance_rate
+        self._step_size_jitter = step_size_jitter
+        self._numerical_gradient_step = numerical_gradient_step or \
+            np.finfo(self._cl_runtime_info.mot_float_dtype).eps ** (1 / 3.)
+        self._finalize_proposal_func = finalize_proposal_func or SimpleCLFunction.from_string(
+            'void finalizeProposal(void* data, local mot_float_type* x){}')
+
+        step_size = np.asarray(step_size, dtype=np.float64)
+        if step_size.size > 1:
+            step_size = self._repeat_over_chains(step_size.flatten(), 'step sizes')
+        self._step_sizes = np.zeros(self._nmr_problems, dtype=np.float64)
+        self._step_sizes[:] = step_size
+        self._step_size_mus = np.log(10 * self._step_sizes)
+        self._step_size_h_bars = np.zeros(self._nmr_problems, dtype=np.float64)
+        self._log_step_size_averages = np.zeros(self._nmr_problems, dtype=np.float64)
+        self._inverse_metrics = np.ones((self._nmr_problems, self._nmr_params), dtype=np.float64, order='C')
+        self._parameter_means = np.zeros((self._nmr_problems, self._nmr_params), dtype=np.float64, order='C')
+        self._parameter_m2s = np.zeros((self._nmr_problems, self._nmr_params), dtype=np.float64, order='C')
+
+    def get_step_sizes(self):
+        """Get the current leapfrog step sizes.
+
+        Returns:
+            ndarray: a (d,) vector with the step size of every modeling instance
+        """
+        return np.copy(self._step_sizes)
+
+    def get_inverse_metrics(self):
+        """Get the current diagonal of the inverse mass matrix.
+
+        Returns:
+            ndarray: a (d, p) matrix with the inverse mass matrix diagonal of every modeling instance
+        """
+        return np.copy(self._inverse_metrics)
+
+    def _get_mcmc_method_kernel_data(self):
+        return Struct({
+            'step_sizes': Array(self._step_sizes, 'double', mode='rw', ensure_zero_copy=True),
+            'step_size_mus': Array(self._step_size_mus, 'double', mode='rw', ensure_zero_copy=True),
+            'step_size_h_bars': Array(self._step_size_h_bars, 'double', mode='rw', ensure_zero_copy=True),
+            'log_step_size_averages': Array(self._log_step_size_averages, 'double', mode='rw',
+                                            ensure_zero_copy=True),
+            'inverse_metrics': Array(self._inverse_metrics, 'double', mode='rw', ensure_zero_copy=True),
+            'parameter_means': Array(self._parameter_means, 'double', mode='rw', ensure_zero_copy=True),
+            'parameter_m2s': Array(self._parameter_m2s, 'double', mode='rw', ensure_zero_copy=True)
+        }, '_mcmc_method_data')
+
+    def _get_gradient_function(self):
+        """Get the CL function computing the gradient of the log posterior.
+
+        Returns:
+            str: a CL function with signature:
+
+            .. code-block:: c
+
+                void _computeLogPosteriorGradient(void* data,
+                                                  local mot_float_type* position,
+                                                  local mot_float_type* gradient);
+        """
+        if self._gradient_func is not None:
+            return self._gradient_func.get_cl_code() + '''
+                void _computeLogPosteriorGradient(void* data,
+                                                  local mot_float_type* position,
+                                                  local mot_float_type* gradient){
+                    ''' + self._gradient_func.get_cl_function_name() + '''(position, data, gradient);
+                    barrier(CLK_LOCAL_MEM_FENCE);
+                }
+            '''
+        return '''
+            void _computeLogPosteriorGradient(void* data,
+                                              local mot_float_type* position,
+                                              local mot_float_type* gradient){
+                bool is_first_work_item = get_local_id(0) == 0;
+                mot_float_type original_value;
+                mot_float_type step;
+                double log_posterior_plus;
+                double log_posterior_min;
+
+                for(uint k = 0; k < ''' + str(self._nmr_params) + '''; k++){
+                    if(is_first_work_item){
+                        original_value = position[k];
+                        step = ''' + str(self._numerical_gradient_step) + ''' * max((mot_float_type)1,
+                                                                                  fabs(original_value));
+                        position[k] = original_value + step;
+                    }
+                    barrier(CLK_LOCAL_MEM_FENCE);
+                    log_posterior_plus = _computeLogLikelihood(position, data) + _computeLogPrior(position, data);
+                    barrier(CLK_LOCAL_MEM_FENCE);
+
+                    if(is_first_work_item){
+                        position[k] = original_value - step;
+                    }
+                    barrier(CLK_LOCAL_MEM_FENCE);
+                    log_posterior_min = _computeLogLikelihood(position, data) + _computeLogPrior(position, data);
+                    barrier(CLK_LOCAL_MEM_FENCE);
+
+                    if(is_first_work_item){
+                        position[k] = original_value;
+                        gradient[k] = (log_posterior_plus - log_posterior_min) / (2 * step);
+                    }
+                    barrier(CLK_LOCAL_MEM_FENCE);
+                }
+            }
+        '''
+
+    def _get_adaptation_function(self):
+        """Get the CL function adapting the step size and the mass matrix.
+
+        This implements the dual averaging of the step size (Algorithm 5 in Hoffman & Gelman, 2014) and the
+        estimation of the inverse mass matrix diagonal from the samples in the metric adaptation window.
+        """
+        metric_window_start = self._nmr_adaptation_steps // 4
+        metric_window_end = 3 * self._nmr_adaptation_steps // 4
+
+        return '''
+            void _adaptSampler(_mcmc_method_data* method_data, ulong current_iteration,
+                               local mot_float_type* current_position, double acceptance_probability){
+                double m;
+                double delta;
+                double log_step_size;
+                double metric_window_size;
+
+                if(current_iteration >= ''' + str(self._nmr_adaptation_steps) + '''){
+                    return;
+                }
+
+                // dual averaging of the step size, restarted at the end of the metric window
+                m = current_iteration + 1;
+                if(current_iteration >= ''' + str(metric_window_end) + '''){
+                    m -= ''' + str(metric_window_end) + ''';
+                }
+
+                *method_data->step_size_h_bars = (1 - 1 / (m + 10)) * *method_data->step_size_h_bars
+                    + (''' + str(self._target_acceptance_rate) + ''' - acceptance_probability) / (m + 10);
+                log_step_size = *method_data->step_size_mus - sqrt(m) / 0.05 * *method_data->step_size_h_bars;
+                *method_data->log_step_size_averages = pow(m, (double)-0.75) * log_step_size
+                    + (1 - pow(m, (double)-0.75)) * *method_data->log_step_size_averages;
+                *method_data->step_sizes = exp(log_step_size);
+
+                // the variance of the samples in the metric window, using the online algorithm by Welford
+                if(current_iteration >= ''' + str(metric_window_start) + '''
+                        && current_iteration < ''' + str(metric_window_end) + '''){
+                    m = current_iteration - ''' + str(metric_window_start) + ''' + 1;
+                    for(uint k = 0; k < ''' + str(self._nmr_params) + '''; k++){
+                        delta = current_position[k] - method_data->parameter_means[k];
+                        method_data->parameter_means[k] += delta / m;
+                        method_data->parameter_m2s[k] += delta * (current_position[k]
+                                                                  - method_data->parameter_means[k]);
+                    }
+                }
+
+                if(current_iteration + 1 == ''' + str(metric_window_end) + '''){
+                    metric_window_size = ''' + str(metric_window_end - metric_window_start) + ''';
+                    if(metric_window_size > 1){
+                        for(uint k = 0; k < ''' + str(self._nmr_params) + '''; k++){
+                            method_data->inverse_metrics[k] =
+                                (metric_window_size / (metric_window_size + 5))
+                                    * method_data->parameter_m2s[k] / (metric_window_size - 1)
+                                + 1e-3 * (5 / (metric_window_size + 5));
+                        }
+                    }
+                    *method_data->step_size_mus = log(10 * *method_data->step_sizes);
+                    *method_data->step_size_h_bars = 0;
+                    *method_data->log_step_size_averages = 0;
+                }
+
+                if(current_iteration + 1 == ''' + str(self._nmr_adaptation_steps) + '''){
+                    *method_data->step_sizes = exp(*method_data->log_step_size_averages);
+                }
+            }
+        '''
+
+    def _get_state_update_cl_func(self, nmr_samples, thinning, return_output):
+        nmr_params = str(self._nmr_params)
+        kernel_source = self._finalize_proposal_func.get_cl_code()
+        kernel_source += self._get_gradient_function()
+        kernel_source += self._get_adaptation_function()
+        kernel_source += '''
+            void _advanceSampler(
+                    void* method_data,
+                    void* data,
+                    ulong current_iteration,
+                    void* rng_data,
+                    local mot_float_type* current_position,
+                    local double* const current_likelihood,
+                    local mot_float_type* const current_prior){
+
+                local mot_float_type new_position[''' + nmr_params + '''];
+                local mot_float_type momentum[''' + nmr_params + '''];
+                local mot_float_type gradient[''' + nmr_params + '''];
+                local mot_float_type new_prior;
+                local double new_likelihood;
+                bool is_first_work_item = get_local_id(0) == 0;
+
+                _mcmc_method_data* hmc_data = (_mcmc_method_data*)method_data;
+                double step_size = *hmc_data->step_sizes;
+                double current_hamiltonian;
+                double new_hamiltonian;
+                double acceptance_probability = 0;
+
+                if(is_first_work_item){
+                    step_size *= 1 + ''' + str(self._step_size_jitter) + ''' * (2 * frand(rng_data) - 1);
+
+                    current_hamiltonian = -(*current_likelihood + *current_prior);
+                    for(uint k = 0; k < ''' + nmr_params + '''; k++){
+                        new_position[k] = current_position[k];
+                        momentum[k] = frandn(rng_data) / sqrt(hmc_data->inverse_metrics[k]);
+                        current_hamiltonian += 0.5 * momentum[k] * momentum[k] * hmc_data->inverse_metrics[k];
+                    }
+                }
+                barrier(CLK_LOCAL_MEM_FENCE);
+
+                _computeLogPosteriorGradient(data, new_position, gradient);
+
+                for(uint step = 0; step < ''' + str(self._nmr_leapfrog_steps) + '''; step++){
+                    if(is_first_work_item){
+                        for(uint k = 0; k < ''' + nmr_params + '''; k++){
+                            momentum[k] += 0.5 * step_size * gradient[k];
+                            new_position[k] += step_size * hmc_data->inverse_metrics[k] * momentum[k];
+                        }
+                        ''' + self._finalize_proposal_func.get_cl_function_name() + '''(data, new_position);
+                    }
+                    barrier(CLK_LOCAL_MEM_FENCE);
+
+                    _computeLogPosteriorGradient(data, new_position, gradient);
+
+                    if(is_first_work_item){
+                        for(uint k = 0; k < ''' + nmr_params + '''; k++){
+                            momentum[k] += 0.5 * step_size * gradient[k];
+                        }
+                    }
+                    barrier(CLK_LOCAL_MEM_FENCE);
+                }
+
+                if(is_first_work_item){
+                    new_prior = _computeLogPrior(new_position, data);
+                }
+                barrier(CLK_LOCAL_MEM_FENCE);
+
+                if(exp(new_prior) > 0){
+                    new_likelihood = _computeLogLikelihood(new_position, data);
+
+                    if(is_first_work_item){
+                        new_hamiltonian = -(new_likelihood + new_prior);
+                        for(uint k = 0; k < ''' + nmr_params + '''; k++){
+                            new_hamiltonian += 0.5 * momentum[k] * momentum[k] * hmc_data->inverse_metrics[k];
+                        }
+
+                        if(isfinite(new_hamiltonian)){
+                            acceptance_probability = fmin((double)1, exp(current_hamiltonian - new_hamiltonian));
+                        }
+
+                        if(frand(rng_data) < acceptance_probability){
+                            *current_likelihood = new_likelihood;
+                            *current_prior = new_prior;
+                            for(uint k = 0; k < ''' + nmr_params + '''; k++){
+                                current_position[k] = new_position[k];
+                            }
+                        }
+                    }
+                }
+
+                if(is_first_work_item){
+                    _adaptSampler(hmc_data, current_iteration, current_position, acceptance_probability);
+                }
+                barrier(CLK_LOCAL_MEM_FENCE);
+            }
+        '''
+        return kernel_source
@@ -0,0 +1,25 @@
+import unittest
+
+from mot.lib.cl_data_type import SimpleCLDataType
+
+__author__ = 'Robbert Harms'
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class test_cl_data_type_from_string(unittest.TestCase):
+
+    def test_builtin_type(self):
+        data_type = SimpleCLDataType.from_string('global double4*')
+        self.assertEqual(data_type.raw_data_type, 'double')
+        self.assertEqual(data_type.vector_length, 4)
+        self.assertEqual(data_type.address_space, 'global')
+        self.assertTrue(data_type.is_pointer_type)
+
+    def test_custom_type(self):
+        data_type = SimpleCLDataType.from_string('const mot_dual* const')
+        self.assertEqual(data_type.raw_data_type, 'mot_dual')
+        self.assertEqual(data_type.ctype, 'mot_dual')
+        self.assertTrue(data_type.is_pointer_type)
+        self.assertFalse(data_type.is_vector_type)
+        self.assertEqual(data_type.declaration_type, 'mot_dual*')
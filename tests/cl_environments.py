@@ -0,0 +1,37 @@
+import unittest
+from unittest import mock
+
+import pyopencl as cl
+
+from mot.lib.cl_environments import CLEnvironmentFactory
+
+__author__ = 'Robbert Harms'
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class test_create_sub_devices(unittest.TestCase):
+
+    def _get_environment(self, max_compute_units, sub_devices=None):
+        env = mock.Mock()
+        env.device.name = 'test device'
+        env.device.get_info.return_value = max_compute_units
+        if sub_devices is None:
+            env.device.create_sub_devices.side_effect = cl.RuntimeError('partitioning not supported')
+        else:
+            env.device.create_sub_devices.return_value = sub_devices
+        return env
+
+    def test_partition_type(self):
+        self.assertRaises(ValueError, CLEnvironmentFactory.create_sub_devices, [], partition_type='by_counts')
+        self.assertRaises(ValueError, CLEnvironmentFactory.create_sub_devices, [], nmr_sub_devices=0)
+
+    def test_unsupported_device(self):
+        env = self._get_environment(4)
+        with self.assertLogs('mot.lib.cl_environments', level='WARNING'):
+            self.assertEqual(CLEnvironmentFactory.create_sub_devices([env]), [env])
+
+    def test_nmr_sub_devices_clamped(self):
+        env = self._get_environment(2, sub_devices=[])
+        CLEnvironmentFactory.create_sub_devices([env], nmr_sub_devices=8)
+        env.device.create_sub_devices.assert_called_once_with([cl.device_partition_property.EQUALLY, 1])
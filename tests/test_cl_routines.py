@@ -9,10 +9,18 @@ Tests for `mot` module.
 """
 
 import unittest
+import warnings
 import numpy as np
 
-from mot import minimize
-from mot.lib.cl_function import SimpleCLFunction
+from mot import minimize, fit_with_uncertainty
+from mot.cl_routines import numerical_hessian, numerical_gradient, compute_covariance
+from mot.cl_routines.numerical_hessian import _nanpercentiles
+from mot.lib.utils import hessian_to_covariance
+from mot.lib.cl_function import SimpleCLFunction, _ProcedureRunner
+from mot.lib.kernel_data import Array, Struct
+from mot.library_functions import DualNumberJacobian
+from mot.sample import AdaptiveMetropolisWithinGibbs, AdaptiveMetropolis, HamiltonianMonteCarlo, SamplerSession, \
+    ArraySampleOutputWriter
 
 
 class CLRoutineTestCase(unittest.TestCase):
@@ -26,7 +34,8 @@ class TestRosenbrock(CLRoutineTestCase):
     def setUp(self):
         super().setUp()
         self.n = 5
-        self.methods = {'Nelder-Mead': None, 'Powell': {'patience': 3}}
+        self.methods = {'Nelder-Mead': None, 'Powell': {'patience': 3}, 'L-BFGS': None,
+                        'Subplex': {'min_subspace_length': 5, 'max_subspace_length': 5}}
         self._nmr_observations = self.n - 1
         self._objective_func = SimpleCLFunction.from_string('''
             double rosenbrock_MLE_func(local const mot_float_type* const x,
@@ -55,6 +64,130 @@ class TestRosenbrock(CLRoutineTestCase):
             for ind in range(2):
                 self.assertAlmostEqual(v[0, ind], 1, places=3, msg=method)
 
+    def test_resume_state(self):
+        for method, options in self.methods.items():
+            options = dict(options or {}, patience=1)
+            output = minimize(self._objective_func, np.array([[3] * 5]), method=method,
+                              nmr_observations=self._nmr_observations, options=options, return_state=True)
+
+            for _ in range(100):
+                if output['status'][0] != 6:
+                    break
+                output = minimize(self._objective_func, output['x'], method=method,
+                                  nmr_observations=self._nmr_observations, options=options,
+                                  initial_state=output['state'], return_state=True)
+            v = output['x']
+            for ind in range(2):
+                self.assertAlmostEqual(v[0, ind], 1, places=3, msg=method)
+
+    def test_statistics(self):
+        for method, options in self.methods.items():
+            output = minimize(self._objective_func, np.array([[3] * 5]), method=method,
+                              nmr_observations=self._nmr_observations, options=options, return_statistics=True)
+            self.assertGreater(output['nmr_iterations'][0], 0, msg=method)
+            self.assertGreater(output['nmr_function_evaluations'][0], output['nmr_iterations'][0], msg=method)
+            self.assertAlmostEqual(output['objective_value'][0], 0, places=3, msg=method)
+
+    def test_trace(self):
+        for method, options in self.methods.items():
+            output = minimize(self._objective_func, np.array([[3] * 5, [2] * 5]), method=method,
+                              nmr_observations=self._nmr_observations, options=options,
+                              trace_problems=[1], trace_length=10, trace_x=True)
+            self.assertEqual(output['trace_objective'].shape, (1, 10), msg=method)
+            self.assertEqual(output['trace_x'].shape, (1, 10, 5), msg=method)
+            self.assertGreater(output['trace_nmr_entries'][0], 0, msg=method)
+
+            trace = output['trace_objective'][0]
+            self.assertAlmostEqual(trace[np.isfinite(trace)][-1], 0, places=3, msg=method)
+
+    def test_rounds(self):
+        x0 = np.array([[3] * 5, [1] * 5, [-1, 2, 1, 0, 2], [1] * 5, [2] * 5])
+        first_round = minimize(self._objective_func, x0, method='L-BFGS', nmr_observations=self._nmr_observations,
+                               options={'patience': 1})
+        np.testing.assert_array_equal(first_round['status'] == 6, [True, False, True, False, True])
+
+        reference = minimize(self._objective_func, x0, method='L-BFGS', nmr_observations=self._nmr_observations,
+                             options={'patience': 1000})
+        output = minimize(self._objective_func, x0, method='L-BFGS', nmr_observations=self._nmr_observations,
+                          options={'patience': 1}, nmr_rounds=100)
+        np.testing.assert_array_equal(output['status'], reference['status'])
+        np.testing.assert_allclose(output['x'], reference['x'])
+
+    def test_problem_indices(self):
+        values = Array(np.zeros(6), 'double', mode='rw')
+        SimpleCLFunction.from_string('void increment(global double* value){ *value += 1; }').evaluate(
+            {'value': values}, 6, problem_indices=np.array([1, 2, 4]))
+        np.testing.assert_array_equal(values.get_data(), [0, 1, 1, 0, 1, 0])
+
+    def test_procedure_runner(self):
+        values = Array(np.zeros(6), 'double', mode='rw')
+        runner = _ProcedureRunner(SimpleCLFunction.from_string('void increment(global double* value){ *value += 1; }'),
+                                  {'value': values}, 6)
+        runner.run()
+        runner.run(np.array([1, 2, 4]))
+        runner.run(np.array([4]))
+        np.testing.assert_array_equal(values.get_data(), [1, 2, 2, 1, 3, 1])
+
+    def test_numerical_gradient(self):
+        x = np.array([[0.5, 1, 1.5, 1, 0.5]])
+        gradient = numerical_gradient(self._objective_func, x)
+
+        expected = np.zeros(self.n)
+        expected[:-1] += -400 * x[0, :-1] * (x[0, 1:] - x[0, :-1] ** 2) - 2 * (1 - x[0, :-1])
+        expected[1:] += 200 * (x[0, 1:] - x[0, :-1] ** 2)
+        np.testing.assert_allclose(gradient[0], expected, rtol=1e-3)
+
+    def test_numerical_gradient_parallel_evaluations(self):
+        x = np.array([[0.5, 1, 1.5, 1, 0.5], [1, 1, 1, 1, 1], [2, 1, 0, 1, 2]])
+        gradient = numerical_gradient(self._objective_func, x)
+        gradient_parallel = numerical_gradient(self._objective_func, x, parallel_evaluations=True)
+        np.testing.assert_allclose(gradient_parallel, gradient, rtol=1e-6, atol=1e-6)
+
+    def test_numerical_hessian_parallel_evaluations(self):
+        x = np.array([[0.5, 1, 1.5, 1, 0.5], [1, 1, 1, 1, 1]])
+        hessian = numerical_hessian(self._objective_func, x)
+        hessian_parallel = numerical_hessian(self._objective_func, x, parallel_evaluations=True)
+        np.testing.assert_allclose(hessian_parallel, hessian, rtol=1e-3, atol=1e-3)
+
+    def test_numerical_hessian_reuse_evaluations(self):
+        x = np.array([[0.5, 1, 1.5, 1, 0.5], [1, 1, 1, 1, 1]])
+        hessian = numerical_hessian(self._objective_func, x)
+        for parallel_evaluations in [False, True]:
+            hessian_shared = numerical_hessian(self._objective_func, x, reuse_evaluations=True,
+                                               parallel_evaluations=parallel_evaluations)
+            np.testing.assert_allclose(hessian_shared, hessian, rtol=1e-3, atol=1e-3)
+
+    def test_numerical_hessian_subsets(self):
+        x = np.array([[0.5, 1, 1.5, 1, 0.5]])
+        hessian = numerical_hessian(self._objective_func, x)
+
+        diagonal = numerical_hessian(self._objective_func, x, mode='diagonal')
+        np.testing.assert_allclose(diagonal, np.diagonal(hessian, axis1=1, axis2=2))
+
+        block = numerical_hessian(self._objective_func, x, parameter_indices=[3, 1])
+        np.testing.assert_allclose(block, hessian[:, [3, 1]][:, :, [3, 1]])
+
+    def test_numerical_hessian_adaptive(self):
+        x = np.array([[0.5, 1, 1.5, 1, 0.5], [1, 1, 1, 1, 1]])
+        hessian = numerical_hessian(self._objective_func, x)
+        hessian_adaptive, nmr_steps = numerical_hessian(self._objective_func, x, adaptive_tolerance=1e-6,
+                                                        output_nmr_steps=True)
+        np.testing.assert_allclose(hessian_adaptive, hessian, rtol=1e-3, atol=1e-3)
+        self.assertTrue(np.all(nmr_steps >= 4))
+        self.assertTrue(np.all(nmr_steps <= 15))
+
+    def test_nanpercentiles(self):
+        values = np.random.RandomState(0).normal(size=(3, 4, 7))
+        values[0, 1, [2, 5]] = np.nan
+        values[1, 2, :6] = np.nan
+        values[2, 3, :] = np.nan
+
+        percentiles = [0, 25, 50, 83, 100]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            expected = np.nanpercentile(values, percentiles, axis=-1)
+
+        np.testing.assert_allclose(_nanpercentiles(values, percentiles), expected)
 
 class TestLSQNonLinExample(CLRoutineTestCase):
 
@@ -79,7 +212,7 @@ class TestLSQNonLinExample(CLRoutineTestCase):
                 return sum;
             }
         ''')
-        self.methods = ('Levenberg-Marquardt', 'Powell', 'Nelder-Mead')
+        self.methods = ('Levenberg-Marquardt', 'Powell', 'Nelder-Mead', 'L-BFGS', 'DifferentialEvolution', 'CMA-ES')
 
     def test_model(self):
         for method in self.methods:
@@ -89,6 +222,285 @@ class TestLSQNonLinExample(CLRoutineTestCase):
             for ind in range(2):
                 self.assertAlmostEqual(v[0, ind], 0.2578, places=3, msg=method)
 
+    def test_multistart(self):
+        for method in self.methods:
+            output = minimize(self._objective_func, np.array([[[0.3, 0.4], [0.2, 0.3]]]), method=method,
+                              nmr_observations=self._nmr_observations)
+            v = output['x']
+            self.assertEqual(v.shape, (1, 2))
+            for ind in range(2):
+                self.assertAlmostEqual(v[0, ind], 0.2578, places=3, msg=method)
+
+    def test_bounds(self):
+        for method in self.methods:
+            output = minimize(self._objective_func, np.array([[0.3, 0.4]]), method=method,
+                              nmr_observations=self._nmr_observations, lower_bounds=[0, None], upper_bounds=1)
+            v = output['x']
+            for ind in range(2):
+                self.assertAlmostEqual(v[0, ind], 0.2578, places=3, msg=method)
+
+    def test_jacobian_func(self):
+        analytic_jacobian = SimpleCLFunction.from_string('''
+            void lsqnonlin_example_jacobian(local mot_float_type* x, void* data, local mot_float_type* fvec,
+                                            global mot_float_type* const fjac, local mot_float_type* scratch){
+                double residual;
+                if(get_local_id(0) == 0){
+                    for(uint i = 0; i < ''' + str(self._nmr_observations) + '''; i++){
+                        residual = 2 + 2 * (i+1) - exp((i+1) * x[0]) - exp((i+1) * x[1]);
+                        for(uint j = 0; j < 2; j++){
+                            fjac[j * ''' + str(self._nmr_observations) + ''' + i] =
+                                -2 * residual * (i+1) * exp((i+1) * x[j]);
+                        }
+                    }
+                }
+                barrier(CLK_GLOBAL_MEM_FENCE);
+            }
+        ''')
+        dual_residual = SimpleCLFunction.from_string('''
+            mot_dual lsqnonlin_example_residual(const mot_dual* const x, void* data, uint i){
+                mot_dual residual = dual_add_scalar(
+                    dual_neg(dual_add(dual_exp(dual_mul_scalar(x[0], i+1)), dual_exp(dual_mul_scalar(x[1], i+1)))),
+                    2 + 2 * (i+1));
+                return dual_mul(residual, residual);
+            }
+        ''')
+
+        x0 = np.array([[0.3, 0.4], [0.2, 0.3]])
+        numerical = minimize(self._objective_func, x0, method='Levenberg-Marquardt',
+                             nmr_observations=self._nmr_observations, return_statistics=True)
+
+        for jacobian_func in (analytic_jacobian, DualNumberJacobian(dual_residual, 2, self._nmr_observations)):
+            output = minimize(self._objective_func, x0, method='Levenberg-Marquardt',
+                              nmr_observations=self._nmr_observations, jacobian_func=jacobian_func,
+                              return_statistics=True)
+            np.testing.assert_allclose(output['x'], numerical['x'], atol=2e-3)
+            np.testing.assert_allclose(output['objective_value'], numerical['objective_value'], rtol=1e-3)
+
+    def test_differential_evolution_strategy(self):
+        self.assertRaises(ValueError, minimize, self._objective_func, np.array([[0.3, 0.4]]),
+                          method='DifferentialEvolution', nmr_observations=self._nmr_observations,
+                          options={'strategy': 'best1exp'})
+
+    def test_differential_evolution_resume_state(self):
+        self._assert_resume_state('DifferentialEvolution', {'patience': 5, 'tolerance': 0, 'polish': None, 'seed': 0})
+
+    def test_differential_evolution_trace(self):
+        self._assert_trace('DifferentialEvolution', {'patience': 5, 'tolerance': 0, 'polish': None, 'seed': 0})
+
+    def test_cmaes_resume_state(self):
+        self._assert_resume_state('CMA-ES', {'patience': 5, 'seed': 0})
+
+    def test_cmaes_trace(self):
+        self._assert_trace('CMA-ES', {'patience': 5, 'seed': 0})
+
+    def _assert_resume_state(self, method, options):
+        output = minimize(self._objective_func, np.array([[0.3, 0.4]]), method=method,
+                          nmr_observations=self._nmr_observations, options=options, return_state=True)
+
+        for _ in range(10):
+            output = minimize(self._objective_func, output['x'], method=method,
+                              nmr_observations=self._nmr_observations, options=options,
+                              initial_state=output['state'], return_state=True)
+        for ind in range(2):
+            self.assertAlmostEqual(output['x'][0, ind], 0.2578, places=3, msg=method)
+
+    def _assert_trace(self, method, options):
+        output = minimize(self._objective_func, np.array([[0.3, 0.4], [0.2, 0.3]]), method=method,
+                          nmr_observations=self._nmr_observations, options=options, return_statistics=True,
+                          trace_problems=[1], trace_length=10, trace_x=True)
+        self.assertEqual(output['trace_objective'].shape, (1, 10), msg=method)
+        self.assertEqual(output['trace_x'].shape, (1, 10, 2), msg=method)
+        self.assertGreater(output['trace_nmr_entries'][0], 0, msg=method)
+
+        trace = output['trace_objective'][0]
+        self.assertAlmostEqual(trace[np.isfinite(trace)][-1], output['objective_value'][1], places=3, msg=method)
+
+    def test_fit_with_uncertainty(self):
+        output = fit_with_uncertainty(self._objective_func, np.array([[0.3, 0.4]]),
+                                      nmr_observations=self._nmr_observations)
+        for ind in range(2):
+            self.assertAlmostEqual(output['x'][0, ind], 0.2578, places=3)
+
+        hessian = numerical_hessian(self._objective_func, output['x'])
+        np.testing.assert_allclose(output['hessian'], hessian, rtol=1e-2)
+        np.testing.assert_allclose(output['covariance'][0], np.linalg.inv(output['hessian'][0]), rtol=1e-6)
+        self.assertFalse(output['is_singular'][0])
+
+    def test_fit_with_uncertainty_rounds(self):
+        x0 = np.array([[0.3, 0.4], [0.2, 0.3], [0.4, 0.1]])
+        for nmr_rounds in (2, 100):
+            output = fit_with_uncertainty(self._objective_func, x0, method='Nelder-Mead',
+                                          nmr_observations=self._nmr_observations, options={'patience': 1},
+                                          nmr_rounds=nmr_rounds)
+            expected = minimize(self._objective_func, x0, method='Nelder-Mead',
+                                nmr_observations=self._nmr_observations, options={'patience': 1},
+                                nmr_rounds=nmr_rounds)
+            np.testing.assert_allclose(output['x'], expected['x'])
+
+            hessian = numerical_hessian(self._objective_func, output['x'])
+            np.testing.assert_allclose(output['hessian'], hessian, rtol=1e-2)
+
+
+class TestCovariance(CLRoutineTestCase):
+
+    def test_compute_covariance(self):
+        random = np.random.RandomState(0)
+        matrices = random.normal(size=(10, 4, 4))
+        hessian = np.matmul(matrices, matrices.transpose(0, 2, 1)) + np.eye(4)
+        hessian[0] = 0
+        hessian[1] *= -1
+
+        covariance, is_singular = compute_covariance(hessian, output_singularity=True)
+        expected, expected_singular = hessian_to_covariance(hessian, output_singularity=True)
+
+        np.testing.assert_allclose(covariance, expected, atol=1e-10)
+        np.testing.assert_array_equal(is_singular, expected_singular)
+        self.assertTrue(is_singular[0])
+        self.assertFalse(np.any(is_singular[1:]))
+
+    def test_ill_conditioned_hessian(self):
+        hessian = np.array([[[1, 0], [0, 1e-17]], [[2, 0], [0, 4]]])
+
+        covariance, is_singular = compute_covariance(hessian, output_singularity=True)
+        expected, expected_singular = hessian_to_covariance(hessian, output_singularity=True)
+
+        np.testing.assert_allclose(covariance, expected, atol=1e-10)
+        np.testing.assert_array_equal(is_singular, [True, False])
+
+
+class TestSampling(CLRoutineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self._ll_func = SimpleCLFunction.from_string('''
+            double gaussian_ll(local const mot_float_type* const x, void* data){
+                return -0.5 * (pown(x[0], 2) + pown(x[1] - 1, 2) / 4.0);
+            }
+        ''')
+        self._log_prior_func = SimpleCLFunction.from_string('''
+            mot_float_type uniform_prior(local const mot_float_type* const x, void* data){
+                return 0;
+            }
+        ''')
+
+    def test_session(self):
+        sampler = AdaptiveMetropolisWithinGibbs(self._ll_func, self._log_prior_func, np.zeros((2, 2)), np.ones((2, 2)))
+        reference = AdaptiveMetropolisWithinGibbs(self._ll_func, self._log_prior_func, np.zeros((2, 2)),
+                                                  np.ones((2, 2)))
+        reference._rng_state[:] = sampler._rng_state
+
+        expected = reference.sample(1500, burnin=200, thinning=2).get_samples()
+        with SamplerSession(sampler, batch_size=400, thinning=2) as session:
+            session.step(100, return_output=False)
+            samples = np.concatenate([session.step(1000).get_samples(), session.step(500).get_samples()], axis=2)
+
+        np.testing.assert_allclose(samples, expected)
+        np.testing.assert_allclose(sampler._current_chain_position, reference._current_chain_position)
+        np.testing.assert_allclose(sampler._proposal_stds, reference._proposal_stds)
+
+    def test_streaming_output(self):
+        samplers = [AdaptiveMetropolisWithinGibbs(self._ll_func, self._log_prior_func, np.zeros((2, 2)),
+                                                  np.ones((2, 2))) for _ in range(3)]
+        for sampler in samplers[1:]:
+            sampler._rng_state[:] = samplers[0]._rng_state
+
+        expected = samplers[0].sample(2500, burnin=100)
+
+        batches = list(samplers[1].sample_iter(2500, burnin=100))
+        self.assertGreater(len(batches), 1)
+        np.testing.assert_allclose(np.concatenate([b.get_samples() for b in batches], axis=2),
+                                   expected.get_samples())
+
+        writer = ArraySampleOutputWriter(np.zeros((2, 2, 2500)), np.zeros((2, 2500)), np.zeros((2, 2500)))
+        output = samplers[2].sample(2500, burnin=100, output=writer)
+        np.testing.assert_allclose(output.get_samples(), expected.get_samples())
+        np.testing.assert_allclose(output.get_log_likelihoods(), expected.get_log_likelihoods())
+
+    def test_summary(self):
+        samplers = [AdaptiveMetropolisWithinGibbs(self._ll_func, self._log_prior_func, np.zeros((2, 2)),
+                                                  np.ones((2, 2))) for _ in range(2)]
+        samplers[1]._rng_state[:] = samplers[0]._rng_state
+
+        samples = samplers[0].sample(2500, burnin=100, thinning=2).get_samples().astype(np.float64)
+        summary = samplers[1].sample(2500, burnin=100, thinning=2, summary='covariance')
+
+        np.testing.assert_array_equal(summary.get_nmr_samples(), 2500)
+        np.testing.assert_allclose(summary.get_means(), np.mean(samples, axis=2), atol=1e-10)
+        np.testing.assert_allclose(summary.get_variances(), np.var(samples, axis=2, ddof=1), rtol=1e-8)
+        np.testing.assert_allclose(summary.get_covariances(), [np.cov(s) for s in samples], rtol=1e-8, atol=1e-10)
+
+    def test_multiple_chains(self):
+        ll_func = SimpleCLFunction.from_string('''
+            double shifted_gaussian_ll(local const mot_float_type* const x, void* data){
+                return -0.5 * (pown(x[0] - *((_model_data*)data)->mean, 2) + pown(x[1], 2));
+            }
+        ''')
+        x0 = np.random.uniform(-3, 3, size=(2, 4, 2))
+        sampler = AdaptiveMetropolisWithinGibbs(ll_func, self._log_prior_func, x0, np.ones((2, 2)),
+                                                data=Struct({'mean': Array(np.array([0, 10]), 'mot_float_type')},
+                                                            '_model_data'),
+                                                nmr_chains=4)
+        samples = sampler.sample(4000, burnin=500).get_samples().astype(np.float64)
+        self.assertEqual(samples.shape, (8, 2, 4000))
+        np.testing.assert_allclose(np.mean(samples.reshape(2, 4, 2, 4000), axis=(1, 3)), [[0, 0], [10, 0]], atol=0.3)
+
+        split_chains = np.concatenate(np.split(samples.reshape(2, 4, 2, 4000), 2, axis=3), axis=1)
+        within = np.mean(np.var(split_chains, axis=3, ddof=1), axis=1)
+        between = 2000 * np.var(np.mean(split_chains, axis=3), axis=1, ddof=1)
+        rhat = np.sqrt((1999 / 2000. * within + between / 2000.) / within)
+
+        diagnostics = sampler.get_convergence_diagnostics()
+        np.testing.assert_allclose(diagnostics['within_chain_variance'], within, rtol=1e-6)
+        np.testing.assert_allclose(diagnostics['between_chain_variance'], between, rtol=1e-6)
+        np.testing.assert_allclose(diagnostics['rhat'], rhat, rtol=1e-6)
+        self.assertTrue(np.all(diagnostics['rhat'] < 1.1))
+
+    def test_proposal_shape(self):
+        sampler = AdaptiveMetropolisWithinGibbs(self._ll_func, self._log_prior_func, np.zeros((2, 2)),
+                                                np.ones((2, 2)), nmr_chains=3)
+        self.assertEqual(sampler._proposal_stds.shape, (6, 2))
+
+        for nmr_chains in (1, 3):
+            self.assertRaises(ValueError, AdaptiveMetropolisWithinGibbs, self._ll_func, self._log_prior_func,
+                              np.zeros((2, 2)), np.ones((4, 2)), nmr_chains=nmr_chains)
+            self.assertRaises(ValueError, AdaptiveMetropolis, self._ll_func, self._log_prior_func,
+                              np.zeros((2, 2)), np.ones((4, 2)), nmr_chains=nmr_chains)
+            self.assertRaises(ValueError, HamiltonianMonteCarlo, self._ll_func, self._log_prior_func,
+                              np.zeros((2, 2)), step_size=np.ones(4), nmr_chains=nmr_chains)
+
+    def test_adaptive_metropolis(self):
+        ll_func = SimpleCLFunction.from_string('''
+            double correlated_gaussian_ll(local const mot_float_type* const x, void* data){
+                return -0.5 * (pown(x[0], 2) - 1.6 * x[0] * x[1] + pown(x[1], 2)) / 0.36;
+            }
+        ''')
+        sampler = AdaptiveMetropolis(ll_func, self._log_prior_func, np.zeros((2, 2)), np.ones((2, 2)) * 0.1)
+        samples = sampler.sample(20000, burnin=2000).get_samples().astype(np.float64)
+
+        covariances = np.array([np.cov(s) for s in samples])
+        np.testing.assert_allclose(np.mean(samples, axis=2), 0, atol=0.15)
+        np.testing.assert_allclose(covariances, [[[1, 0.8], [0.8, 1]]] * 2, atol=0.15)
+        np.testing.assert_allclose(sampler.get_proposal_covariances(), 2.4 ** 2 / 2 * covariances, rtol=0.2)
+
+    def test_hamiltonian_monte_carlo(self):
+        gradient_func = SimpleCLFunction.from_string('''
+            void gaussian_ll_gradient(local const mot_float_type* const x, void* data,
+                                      local mot_float_type* gradient){
+                if(get_local_id(0) == 0){
+                    gradient[0] = -x[0];
+                    gradient[1] = -(x[1] - 1) / 4.0;
+                }
+            }
+        ''')
+        for func in [gradient_func, None]:
+            sampler = HamiltonianMonteCarlo(self._ll_func, self._log_prior_func, np.zeros((2, 2)),
+                                            gradient_func=func)
+            samples = sampler.sample(4000, burnin=1000).get_samples().astype(np.float64)
+
+            np.testing.assert_allclose(np.mean(samples, axis=2), [[0, 1]] * 2, atol=0.15)
+            np.testing.assert_allclose(np.var(samples, axis=2), [[1, 4]] * 2, rtol=0.2)
+            np.testing.assert_allclose(sampler.get_inverse_metrics(), [[1, 4]] * 2, rtol=0.5)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -4,7 +4,7 @@ import numpy as np
 import pyopencl as cl
 
 from mot.lib.utils import device_type_from_string, device_supports_double, get_float_type_def, is_scalar, \
-    all_elements_equal, get_single_value, topological_sort
+    all_elements_equal, get_single_value, topological_sort, hessian_to_covariance
 
 __author__ = 'Robbert Harms'
 __date__ = "2017-03-28"
@@ -123,3 +123,17 @@ class test_topological_sort(unittest.TestCase):
     def test_empty_input(self):
         data = {}
         self.assertFalse(topological_sort(data))
+
+
+class test_hessian_to_covariance(unittest.TestCase):
+
+    def test_integer_hessian(self):
+        covariance, is_singular = hessian_to_covariance(np.array([[[2, 0], [0, 4]], [[1, 1], [1, 1]]]),
+                                                        output_singularity=True)
+        np.testing.assert_allclose(covariance[0], [[0.5, 0], [0, 0.25]])
+        np.testing.assert_array_equal(is_singular, [False, True])
+
+    def test_ill_conditioned_hessian(self):
+        covariance, is_singular = hessian_to_covariance(np.array([[[1, 0], [0, 1e-17]]]), output_singularity=True)
+        np.testing.assert_allclose(covariance[0], [[1, 0], [0, 0]])
+        np.testing.assert_array_equal(is_singular, [True])